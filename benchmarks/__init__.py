@@ -0,0 +1,3 @@
+# -*- coding: UTF-8 -*-
+
+"""Benchmarks for dozup: run with `python -m benchmarks.run`."""
@@ -0,0 +1,75 @@
+# -*- coding: UTF-8 -*-
+
+"""Synthetic `todo` trees for benchmarks."""
+
+import os
+import random
+import zipfile
+
+
+def make_payload(rand, size):
+    """Some compressible text of about this many bytes."""
+    words = [b'alpha', b'bravo', b'charlie', b'delta', b'echo', b'foxtrot', b'golf', b'hotel']
+    parts = []
+    length = 0
+    while length < size:
+        word = rand.choice(words)
+        parts.append(word)
+        length += len(word) + 1
+    return b' '.join(parts)[:size]
+
+
+def make_small_files(todo_dir, count, size=1024, depth=2, fanout=10, seed=0):
+    """Create `count` files of `size` bytes spread over nested subdirectories.
+
+    Files are placed in directories `depth` levels deep, with
+    `fanout` subdirectories at each level.
+
+    Returns --
+        total number of bytes written.
+    """
+    rand = random.Random(seed)
+    payload = make_payload(rand, size)
+    for i in range(count):
+        parts = []
+        n = i
+        for level in range(depth):
+            parts.append('d%02d' % (n % fanout))
+            n //= fanout
+        dir_path = os.path.join(todo_dir, *parts)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        with open(os.path.join(dir_path, 'f%07d.json' % i), 'wb') as strm:
+            strm.write(payload)
+    return count * size
+
+
+def make_zip(file_path, member_count, size=1024, seed=0):
+    """Create a ZIP archive with `member_count` deflated members of `size` bytes.
+
+    Returns --
+        total uncompressed size of the members.
+    """
+    rand = random.Random(seed)
+    dir_path = os.path.dirname(file_path)
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    with zipfile.ZipFile(file_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for i in range(member_count):
+            archive.writestr('m%07d.json' % i, make_payload(rand, size))
+    return member_count * size
+
+
+def make_large_file(file_path, size, seed=0):
+    """Create a single file of `size` bytes, written in pieces."""
+    rand = random.Random(seed)
+    block = make_payload(rand, 1024 * 1024)
+    dir_path = os.path.dirname(file_path)
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    with open(file_path, 'wb') as strm:
+        remaining = size
+        while remaining > 0:
+            strm.write(block[:remaining])
+            remaining -= len(block)
+    return size
@@ -0,0 +1,261 @@
+# -*- coding: UTF-8 -*-
+
+"""Measure dozup against a local stub server.
+
+    python -m benchmarks.run                         # every scenario
+    python -m benchmarks.run --scenario zip-members --members 50000
+    python -m benchmarks.run --output results.json   # save results
+    python -m benchmarks.run --baseline results.json # fail on regressions
+
+Each scenario runs in a process of its own, so that its peak RSS is
+its own, and reports tasks and bytes per second, p50 and p99 latency
+and peak RSS. Latencies of scenarios that go through `cli.main` come
+from its metrics histograms and so are bucket upper bounds.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from dozup import DozupPoster, DozupQueue
+from dozup.cli import main as cli_main
+
+from .generate import make_large_file, make_small_files, make_zip
+from .stub_server import StubServer
+
+
+SCENARIOS = []
+
+
+def scenario(func):
+    SCENARIOS.append((func.__name__.replace('_', '-'), func))
+    return func
+
+
+@scenario
+def small_files(options, data_dir, server):
+    """Many small files in a shallow tree, posted by `cli.main`."""
+    byte_count = make_small_files(os.path.join(data_dir, 'todo'), options.files, options.size)
+    return run_cli(options, data_dir, server, options.files, byte_count)
+
+
+@scenario
+def deep_tree(options, data_dir, server):
+    """Small files spread thinly through deeply nested subdirectories."""
+    byte_count = make_small_files(os.path.join(data_dir, 'todo'), options.files, options.size, depth=6, fanout=4)
+    return run_cli(options, data_dir, server, options.files, byte_count)
+
+
+@scenario
+def zip_members(options, data_dir, server):
+    """One ZIP archive with many members."""
+    byte_count = make_zip(os.path.join(data_dir, 'todo', 'big.zip'), options.members, options.size)
+    return run_cli(options, data_dir, server, options.members, byte_count)
+
+
+@scenario
+def large_file(options, data_dir, server):
+    """One large file, to check that memory use stays flat."""
+    byte_count = make_large_file(os.path.join(data_dir, 'todo', 'large.bin'), options.large_size)
+    return run_cli(options, data_dir, server, 1, byte_count)
+
+
+@scenario
+def queue_only(options, data_dir, server):
+    """`DozupQueue.iter_tasks` reading every task, with no HTTP at all."""
+    byte_count = make_small_files(os.path.join(data_dir, 'todo'), options.files, options.size)
+    latencies = []
+    started = time.time()
+    before = started
+    for task in DozupQueue(data_dir).iter_tasks():
+        task.input.read()
+        now = time.time()
+        latencies.append(now - before)
+        before = now
+    return summarize(options.files, byte_count, time.time() - started, latencies)
+
+
+@scenario
+def queue_and_poster(options, data_dir, server):
+    """`DozupQueue.iter_tasks` and `DozupPoster.post` in one thread, timing each post."""
+    byte_count = make_small_files(os.path.join(data_dir, 'todo'), options.files, options.size)
+    queue = DozupQueue(data_dir, retry_delay=0 if options.error_rate else None)
+    poster = DozupPoster(server.url)
+    poster.circuit_breaker.failure_threshold = sys.maxsize
+    latencies = []
+    started = time.time()
+    for task in queue.iter_tasks():
+        before = time.time()
+        if not poster.post(task.name, task.input):
+            task.push_back()
+        latencies.append(time.time() - before)
+    return summarize(options.files, byte_count, time.time() - started, latencies)
+
+
+def run_cli(options, data_dir, server, task_count, byte_count):
+    metrics_path = os.path.join(data_dir, 'metrics.json')
+    argv = [
+        data_dir, server.url,
+        '--workers', str(options.workers),
+        '--metrics-json', metrics_path,
+        '--circuit-threshold', str(sys.maxsize),
+    ]
+    if options.error_rate:
+        argv += ['--retry-delay', '0']
+    started = time.time()
+    cli_main(argv)
+    seconds = time.time() - started
+    with open(metrics_path) as strm:
+        histogram = json.load(strm)['histograms'].get('post')
+    result = summarize(task_count, byte_count, seconds, [])
+    if histogram:
+        result['p50_ms'] = histogram_percentile(histogram, 0.50) * 1000
+        result['p99_ms'] = histogram_percentile(histogram, 0.99) * 1000
+    return result
+
+
+def summarize(task_count, byte_count, seconds, latencies):
+    latencies = sorted(latencies)
+    result = {
+        'tasks': task_count,
+        'bytes': byte_count,
+        'seconds': seconds,
+        'tasks_per_second': task_count / seconds if seconds else None,
+        'bytes_per_second': byte_count / seconds if seconds else None,
+        'p50_ms': None,
+        'p99_ms': None,
+    }
+    if latencies:
+        result['p50_ms'] = latencies[int(0.50 * (len(latencies) - 1))] * 1000
+        result['p99_ms'] = latencies[int(0.99 * (len(latencies) - 1))] * 1000
+    return result
+
+
+def histogram_percentile(histogram, q):
+    """Upper bound of the bucket containing the q-th quantile."""
+    target = q * histogram['count']
+    total = 0
+    for bound, count in zip(histogram['buckets'] + [float('inf')], histogram['counts']):
+        total += count
+        if total >= target:
+            return bound
+    return float('inf')
+
+
+def peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+def run_scenario(name, options):
+    """Run one scenario in this process and return its results."""
+    func = dict(SCENARIOS)[name]
+    data_dir = tempfile.mkdtemp('.bench', 'dozup.')
+    server = StubServer(latency=options.latency, error_rate=options.error_rate, seed=0).start()
+    try:
+        result = func(options, data_dir, server)
+    finally:
+        server.stop()
+        shutil.rmtree(data_dir)
+    result['scenario'] = name
+    result['requests'] = server.request_count
+    result['status_counts'] = dict((str(k), v) for k, v in server.status_counts.items())
+    result['peak_rss_kb'] = peak_rss_kb()
+    return result
+
+
+def run_in_child(name, argv):
+    output = subprocess.check_output(
+        [sys.executable, '-m', 'benchmarks.run', '--child', name] + argv,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return json.loads(output.decode('UTF-8').splitlines()[-1])
+
+
+def find_regressions(results, baseline, tolerance):
+    """Compare with earlier results, returning a description of each regression."""
+    earlier = dict((result['scenario'], result) for result in baseline)
+    regressions = []
+    for result in results:
+        before = earlier.get(result['scenario'])
+        if not before:
+            continue
+        if result['tasks_per_second'] < before['tasks_per_second'] * (1 - tolerance):
+            regressions.append('%s: %.1f tasks/s, was %.1f' % (
+                result['scenario'], result['tasks_per_second'], before['tasks_per_second']))
+        if result['peak_rss_kb'] > before['peak_rss_kb'] * (1 + tolerance):
+            regressions.append('%s: peak RSS %d KiB, was %d' % (
+                result['scenario'], result['peak_rss_kb'], before['peak_rss_kb']))
+    return regressions
+
+
+def format_result(result):
+    def ms(value):
+        return '-' if value is None else '%.2f' % value
+    return '%-17s %9d tasks %10.1f tasks/s %8.2f MB/s  p50 %8s ms  p99 %8s ms  peak RSS %7d KiB' % (
+        result['scenario'], result['tasks'], result['tasks_per_second'],
+        result['bytes_per_second'] / 1e6, ms(result['p50_ms']), ms(result['p99_ms']), result['peak_rss_kb'])
+
+
+def create_parser():
+    parser = argparse.ArgumentParser('python -m benchmarks.run', description='Benchmark dozup')
+    parser.add_argument(
+        '--scenario', action='append', choices=[name for name, func in SCENARIOS],
+        help='scenario to run (may be repeated; default all)')
+    parser.add_argument('--files', type=int, default=100000, help='number of small files (default 100000)')
+    parser.add_argument('--members', type=int, default=10000, help='number of ZIP members (default 10000)')
+    parser.add_argument('--size', type=int, default=1024, help='size of small files and members (default 1024)')
+    parser.add_argument(
+        '--large-size', type=int, default=256 * 1024 * 1024,
+        help='size of the large file in bytes (default 256 MiB)')
+    parser.add_argument('--workers', type=int, default=1, help='workers for cli.main (default 1)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the server holds each request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that fail with 503')
+    parser.add_argument('--output', metavar='PATH', help='save results as JSON')
+    parser.add_argument('--baseline', metavar='PATH', help='compare with results saved earlier')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help='fractional slowdown or growth in RSS counted as a regression (default 0.2)')
+    parser.add_argument('--child', metavar='SCENARIO', help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv):
+    options = create_parser().parse_args(argv)
+    if options.child:
+        print(json.dumps(run_scenario(options.child, options)))
+        return 0
+
+    child_argv = [
+        '--files', str(options.files), '--members', str(options.members),
+        '--size', str(options.size), '--large-size', str(options.large_size),
+        '--workers', str(options.workers), '--latency', str(options.latency),
+        '--error-rate', str(options.error_rate),
+    ]
+    results = []
+    for name in options.scenario or [name for name, func in SCENARIOS]:
+        result = run_in_child(name, child_argv)
+        print(format_result(result))
+        results.append(result)
+    if options.output:
+        with open(options.output, 'w') as strm:
+            json.dump(results, strm, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as strm:
+            regressions = find_regressions(results, json.load(strm), options.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,212 @@
+# -*- coding: UTF-8 -*-
+
+"""A local HTTP server to post to, with configurable latency and errors.
+
+As well as single posts, it implements the protocol `DozupPoster` uses
+to upload large files in ranges:
+- POST with an Upload-Length header starts an upload, whose URL is returned in Location;
+- PUT to that URL with a Content-Range header stores a range;
+- POST to that URL completes the upload (400 if any bytes are missing).
+"""
+
+import itertools
+import random
+import re
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+UPLOADS_PATH = '/uploads/'
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+)$')
+
+
+class StubHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Benchmarks open many connections at once.
+    request_queue_size = 128
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers are written a line at a time; without this each response
+    # waits out the client's delayed ACK.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        stub = self.server.stub
+        if self.path.startswith(UPLOADS_PATH):
+            self.read_body()
+            status = stub.complete_upload(self.path[len(UPLOADS_PATH):])
+            stub.record(status, 0)
+            self.send_status(status)
+            return
+        if 'Upload-Length' in self.headers:
+            self.read_body()
+            upload_id = stub.start_upload(int(self.headers['Upload-Length']))
+            stub.record(201, 0)
+            self.send_status(201, {'Location': UPLOADS_PATH + upload_id})
+            return
+        body_size = self.read_body()
+        stub.wait()
+        status = stub.choose_status()
+        stub.record(status, body_size)
+        self.send_status(status)
+
+    def do_PUT(self):
+        stub = self.server.stub
+        data = self.read_body(keep=True)
+        match = CONTENT_RANGE.match(self.headers.get('Content-Range', ''))
+        if not self.path.startswith(UPLOADS_PATH) or not match:
+            status = 400
+        else:
+            status = stub.store_range(self.path[len(UPLOADS_PATH):], int(match.group(1)), data)
+        stub.record(status, len(data))
+        self.send_status(status)
+
+    def send_status(self, status, headers=None):
+        body = b'' if status == 204 else b'OK' if status < 400 else b'Nope'
+        self.send_response(status)
+        for name, value in sorted((headers or {}).items()):
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self, keep=False):
+        """Read the request body, returning it if `keep` is set, else discarding it and returning its size."""
+        chunks = []
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            size = 0
+            while True:
+                chunk_size = int(self.rfile.readline().split(b';')[0], 16)
+                if chunk_size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks) if keep else size
+                chunk = self.rfile.read(chunk_size)
+                size += len(chunk)
+                if keep:
+                    chunks.append(chunk)
+                self.rfile.readline()
+        remaining = int(self.headers.get('Content-Length', 0))
+        size = 0
+        while remaining > 0:
+            data = self.rfile.read(min(remaining, 64 * 1024))
+            if not data:
+                break
+            size += len(data)
+            remaining -= len(data)
+            if keep:
+                chunks.append(data)
+        return b''.join(chunks) if keep else size
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(object):
+    """Accepts POST requests on a local port in a background thread.
+
+    Each request is held for `latency` seconds and then fails with
+    `error_status` with probability `error_rate`, else succeeds with 201.
+
+    Ranges of uploads are stored, and completed uploads appended to
+    `uploaded`. A PUT of a range starting at an offset in
+    `failing_ranges` fails with 503, once.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=503, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.byte_count = 0
+        self.status_counts = {}
+        self.upload_ids = itertools.count(1)
+        self.uploads = {}
+        self.uploaded = []
+        self.failing_ranges = set()
+        self.httpd = StubHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.httpd.stub = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/drop/' % self.httpd.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='stub-server')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def wait(self):
+        if self.latency:
+            threading.Event().wait(self.latency)
+
+    def choose_status(self):
+        with self.lock:
+            return self.error_status if self.random.random() < self.error_rate else 201
+
+    def record(self, status, body_size):
+        with self.lock:
+            self.request_count += 1
+            self.byte_count += body_size
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    def start_upload(self, size):
+        with self.lock:
+            upload_id = str(next(self.upload_ids))
+            self.uploads[upload_id] = bytearray(size), {}
+            return upload_id
+
+    def store_range(self, upload_id, first, data):
+        with self.lock:
+            if upload_id not in self.uploads:
+                return 404
+            if first in self.failing_ranges:
+                self.failing_ranges.remove(first)
+                return 503
+            content, received = self.uploads[upload_id]
+            content[first:first + len(data)] = data
+            # Offset of the end of each range received, by its start.
+            received[first] = max(received.get(first, first), first + len(data))
+            return 204
+
+    def complete_upload(self, upload_id):
+        with self.lock:
+            if upload_id not in self.uploads:
+                return 404
+            content, received = self.uploads[upload_id]
+            if not covers(received, len(content)):
+                return 400
+            del self.uploads[upload_id]
+            self.uploaded.append(bytes(content))
+            return 201
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def covers(ranges, size):
+    """Whether ranges (a dict mapping start to end offset) between them cover every byte up to `size`."""
+    covered = 0
+    for first in sorted(ranges):
+        if first > covered:
+            return False
+        covered = max(covered, ranges[first])
+    return covered >= size
@@ -0,0 +1,82 @@
+# -*- coding: UTF-8 -*-
+
+"""Asyncio counterparts of `DozupQueue.iter_tasks` and `DozupPoster.post`.
+
+This module needs Python 3.5 or later, so it is not imported by the
+package itself.
+
+The same `Task` objects are produced and the same push-back contract
+applies: a task pushed back before asking the iterator for the next one
+returns its file to `todo`. To have many posts in flight, run several
+consumers, each with its own iterator over the one shared queue, and
+let the poster’s semaphore bound how many are actually sent at once.
+"""
+
+import asyncio
+import concurrent.futures
+
+from .poster import DozupPoster, Endpoint, Endpoints
+
+
+class AsyncTaskIterator(object):
+    """Async iterator over the tasks of a `DozupQueue`.
+
+    Each step of the underlying `iter_tasks` generator (which claims,
+    opens and files away files) runs in an executor so that the
+    event loop is never blocked on the file system.
+    """
+    def __init__(self, queue, executor=None):
+        self.tasks = queue.iter_tasks()
+        self.executor = executor
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        loop = asyncio.get_event_loop()
+        task = await loop.run_in_executor(self.executor, next, self.tasks, None)
+        if task is None:
+            raise StopAsyncIteration
+        return task
+
+
+def iter_tasks_async(queue, executor=None):
+    """Return an async iterator over the tasks in this queue."""
+    return AsyncTaskIterator(queue, executor)
+
+
+class AsyncDozupPoster(object):
+    """Posts files without blocking the event loop.
+
+    At most `concurrency` posts are in flight at any moment; the rest
+    wait on a semaphore rather than each occupying a thread.
+    """
+    def __init__(self, url, concurrency=10):
+        self.concurrency = concurrency
+        self.poster = DozupPoster(Endpoints([Endpoint(url, pool_size=concurrency)]))
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self.semaphore = None
+
+    @property
+    def url(self):
+        return self.poster.url
+
+    @property
+    def errors(self):
+        return self.poster.errors
+
+    async def post(self, file_name, stream):
+        """Post the stream, returning True if the server accepted it.
+
+        As with `DozupPoster.post`, errors are appended to `errors`.
+        """
+        if self.semaphore is None:
+            # Created here so it belongs to the running loop.
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, self.poster.post, file_name, stream)
+
+    def close(self):
+        self.executor.shutdown()
+        self.poster.endpoints.close()
@@ -1,8 +1,21 @@
 # -*- coding: UTF-8 -*-
 
 import argparse
+import os
+import sys
+import threading
+import time
 
 from dozup import DozupQueue, DozupPoster
+from dozup.compaction import BUCKET_FORMATS, Compactor
+from dozup.dedup import DedupIndex, content_digest
+from dozup.hooks import Hooks
+from dozup.journal import Journal
+from dozup.metrics import Metrics
+from dozup.poster import CircuitBreaker, Endpoint, Endpoints, Pacer
+from dozup.stats import BacklogStats
+from dozup.trace import TraceWriter
+from dozup.transform import TransformStage, load_transform
 
 
 def create_parser():
@@ -11,23 +24,405 @@ def create_parser():
         'data_dir', metavar='PATH', type=str,
         help='root directory containing ‘todo’, ‘doing’ and ‘done’ directories')
     parser.add_argument(
-        'url', metavar='URL', type=str,
-        help='URL to send POST requests to')
+        'url', metavar='URL', type=str, nargs='+',
+        help='URL to send POST requests to (or several, replicas of one service, to spread them over)')
+    parser.add_argument(
+        '--workers', metavar='N', type=int, default=1,
+        help='number of files to post concurrently (default 1)')
+    parser.add_argument(
+        '--transform', metavar='MODULE:FUNCTION', type=parse_transform,
+        help='replace the content of each task with the result of calling this function '
+        'with its name and content, in a pool of worker processes (content is read in to memory, '
+        'and files are claimed one at a time)')
+    parser.add_argument(
+        '--transform-processes', metavar='N', type=int,
+        help='number of processes to run transforms in (default one per CPU)')
+    parser.add_argument(
+        '--transform-prefetch', metavar='N', type=int,
+        help='number of tasks to read ahead and transform while others are posted '
+        '(default two per process)')
+    parser.add_argument(
+        '--claim-count', metavar='N', type=int, default=1,
+        help='claim up to N files at a time for each worker, returning any not started to todo '
+        'when stopping (default 1; not with --transform or --batch-size)')
+    parser.add_argument(
+        '--batch-size', metavar='N', type=int, default=1,
+        help='post up to N files in each request (default 1, no batching)')
+    parser.add_argument(
+        '--batch-bytes', metavar='BYTES', type=int, default=1024 * 1024,
+        help='when batching, stop adding files once a batch has this much content')
+    parser.add_argument(
+        '--content-encoding', choices=['gzip', 'deflate'],
+        help='compress uploads (deflated ZIP members are sent without recompressing with gzip)')
+    parser.add_argument(
+        '--watch', action='store_true',
+        help='keep running, waiting for new files instead of exiting when todo is empty')
+    parser.add_argument(
+        '--poll-interval', metavar='SECONDS', type=float, default=5.0,
+        help='with --watch, how often to rescan todo where inotify is unavailable')
+    parser.add_argument(
+        '--retry-delay', metavar='SECONDS', type=float,
+        help='park files that fail in ‘retry’ for this long (doubling with each attempt) '
+        'and carry on with other files, instead of stopping')
+    parser.add_argument(
+        '--max-retry-delay', metavar='SECONDS', type=float, default=3600.0,
+        help='longest delay before retrying a file (default 3600)')
+    parser.add_argument(
+        '--circuit-threshold', metavar='N', type=int, default=5,
+        help='stop posting to an endpoint after N consecutive server failures (default 5)')
+    parser.add_argument(
+        '--circuit-reset', metavar='SECONDS', type=float, default=30.0,
+        help='how long to stop posting to it once the threshold is reached (default 30)')
+    parser.add_argument(
+        '--pool-size', metavar='N', type=int, default=10,
+        help='number of keep-alive connections to keep open to each endpoint (default 10)')
+    parser.add_argument(
+        '--adaptive', action='store_true',
+        help='start with one request in flight and adjust up to --workers as the server copes or not')
+    parser.add_argument(
+        '--max-rate', metavar='N', type=float,
+        help='make no more than N requests per second')
+    parser.add_argument(
+        '--upload-threshold', metavar='BYTES', type=int,
+        help='upload files this big or bigger in ranges, in parallel, resuming after failures')
+    parser.add_argument(
+        '--upload-chunk-size', metavar='BYTES', type=int, default=8 * 1024 * 1024,
+        help='size of the ranges files are uploaded in (default 8 MiB)')
+    parser.add_argument(
+        '--upload-parallelism', metavar='N', type=int, default=4,
+        help='number of ranges of each file to upload at once (default 4)')
+    parser.add_argument(
+        '--lease-timeout', metavar='SECONDS', type=float, default=300.0,
+        help='return files in ‘doing’ to ‘todo’ if whoever claimed them has not been heard from '
+        'for this long (default 300)')
+    parser.add_argument(
+        '--shard', metavar='I/N', type=parse_shard,
+        help='when N instances share PATH, prefer files in shard I (counting from 0), '
+        'taking from other shards only once it is empty')
+    parser.add_argument(
+        '--lanes', metavar='DIR,DIR', type=parse_lanes,
+        help='claim files from these top-level subdirectories of todo first, in this order, '
+        'and oldest first within each (implies --oldest-first)')
+    parser.add_argument(
+        '--oldest-first', action='store_true',
+        help='claim the oldest files first rather than going through todo in name order')
+    parser.add_argument(
+        '--dedup', action='store_true',
+        help='skip content the server has already accepted, remembered in ‘dedup.sqlite3’ in PATH')
+    parser.add_argument(
+        '--dedup-max-entries', metavar='N', type=int, default=1000000,
+        help='forget the least recently seen content once this many are remembered (default 1000000)')
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='keep counts of files waiting, in flight and done in ‘stats.sqlite3’ in PATH '
+        '(see ‘dozup stats’); files in ‘todo’ are counted once a pass over the tree reaches them, '
+        'and an archive counts as one file until its members are done')
+    parser.add_argument(
+        '--journal', metavar='PATH',
+        help='append a line of JSON to this file recording the outcome of each task as it happens')
+    parser.add_argument(
+        '--trace', metavar='PATH',
+        help='write a timeline of each file claimed and task posted, per worker, to this file '
+        'as trace-event JSON (for chrome://tracing or Perfetto)')
+    parser.add_argument(
+        '--metrics-textfile', metavar='PATH',
+        help='write counters and latency histograms to this file in Prometheus text format')
+    parser.add_argument(
+        '--metrics-json', metavar='PATH',
+        help='write counters and latency histograms to this file as JSON')
+    parser.add_argument(
+        '--metrics-interval', metavar='SECONDS', type=float, default=15.0,
+        help='with --watch, how often to write metrics (default 15)')
+    return parser
+
+
+def parse_shard(value):
+    """Parse a shard given as I/N, returning the pair (I, N)."""
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected I/N, got %r' % value)
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError('shard %d/%d: need 0 <= I < N' % (index, count))
+    return index, count
+
+
+def parse_lanes(value):
+    """Parse a comma-separated list of lanes, most urgent first."""
+    return [name for name in value.split(',') if name]
+
+
+def create_compact_parser():
+    parser = argparse.ArgumentParser('dozup compact', description='Roll old files in ‘done’ up in to archive segments')
+    parser.add_argument(
+        'data_dir', metavar='PATH', type=str,
+        help='root directory containing ‘done’ (segments are written to ‘archive’ beside it)')
+    parser.add_argument(
+        '--bucket', choices=sorted(BUCKET_FORMATS), default='day',
+        help='start a new series of segments every day (the default) or hour')
+    parser.add_argument(
+        '--min-age', metavar='SECONDS', type=float, default=3600.0,
+        help='only archive files that have been in ‘done’ this long (default 3600)')
+    parser.add_argument(
+        '--max-segment-bytes', metavar='BYTES', type=int, default=256 * 1024 * 1024,
+        help='start a new segment after this much content (default 256 MiB)')
+    return parser
+
+
+def compact(argv, out=None):
+    """Compact as directed by the command-line arguments, printing the number of files archived."""
+    options = create_compact_parser().parse_args(argv)
+    out = out or sys.stdout
+    compactor = Compactor(
+        options.data_dir, options.bucket, options.min_age, options.max_segment_bytes)
+    try:
+        file_count = compactor.compact()
+    finally:
+        compactor.close()
+    out.write('%d files archived\n' % file_count)
+
+
+def create_stats_parser():
+    parser = argparse.ArgumentParser(
+        'dozup stats', description='Print counts of files waiting, in flight and done, as kept with --stats. '
+        'Files waiting in ‘todo’ are counted only once a worker has listed their directory (or whatever '
+        'writes them has noted them with BacklogStats.add_pending), so may be undercounted; use --resync '
+        'for a full count. An archive waiting or in flight counts as one file; its members are counted '
+        'as tasks once done. Counts are written about once a second, so may lag that much.')
+    parser.add_argument(
+        'data_dir', metavar='PATH', type=str,
+        help='root directory containing ‘todo’, ‘doing’ and ‘done’ directories')
+    parser.add_argument(
+        '--resync', action='store_true',
+        help='first recount the files waiting and in flight by walking ‘todo’, ‘retry’ and ‘doing’')
     return parser
 
 
+def stats(argv, out=None):
+    options = create_stats_parser().parse_args(argv)
+    out = out or sys.stdout
+    backlog_stats = BacklogStats(os.path.join(options.data_dir, 'stats.sqlite3'))
+    try:
+        if options.resync:
+            backlog_stats.resync(
+                [os.path.join(options.data_dir, 'todo'), os.path.join(options.data_dir, 'retry')],
+                os.path.join(options.data_dir, 'doing'))
+        counts = backlog_stats.read()
+    finally:
+        backlog_stats.close()
+    for name, value in sorted(counts.items()):
+        out.write('%s %s\n' % (name, value))
+
+
+def parse_transform(value):
+    """Import a transform function given as MODULE:FUNCTION."""
+    try:
+        return load_transform(value)
+    except (ValueError, ImportError, AttributeError) as err:
+        raise argparse.ArgumentTypeError(str(err))
+
+
 def main(argv):
+    if argv and argv[0] == 'compact':
+        return compact(argv[1:])
+    if argv and argv[0] == 'stats':
+        return stats(argv[1:])
     parser = create_parser()
     options = parser.parse_args(argv)
+    if options.transform and options.claim_count > 1:
+        parser.error('--claim-count cannot be combined with --transform, which reads tasks ahead itself')
+    if options.batch_size > 1 and options.claim_count > 1:
+        parser.error('--claim-count cannot be combined with --batch-size, which claims files as it fills each batch')
 
-    queue = DozupQueue(options.data_dir)
-    poster = DozupPoster(options.url)
+    metrics = None
+    if options.metrics_textfile or options.metrics_json:
+        metrics = Metrics()
+    hooks = Hooks()
+    trace = None
+    if options.trace:
+        trace = TraceWriter(options.trace)
+        hooks.register(trace.record)
+    backlog_stats = None
+    if options.stats:
+        backlog_stats = BacklogStats(os.path.join(options.data_dir, 'stats.sqlite3'))
+    queue = DozupQueue(
+        options.data_dir, poll_interval=options.poll_interval,
+        retry_delay=options.retry_delay, max_retry_delay=options.max_retry_delay,
+        metrics=metrics, shard=options.shard,
+        lanes=options.lanes or ([] if options.oldest_first else None),
+        lease_timeout=options.lease_timeout, stats=backlog_stats, hooks=hooks)
+    queue.recover_claims()
+    stage = None
+    if options.transform:
+        # Before any other threads are started, since the pool forks.
+        stage = TransformStage(options.transform, options.transform_processes, options.transform_prefetch)
+    dedup = None
+    if options.dedup:
+        dedup = DedupIndex(os.path.join(options.data_dir, 'dedup.sqlite3'), options.dedup_max_entries)
+    journal = Journal(options.journal) if options.journal else None
+    if stage and journal:
+        stage.journal = journal
+    endpoints = Endpoints([
+        Endpoint(url, CircuitBreaker(options.circuit_threshold, options.circuit_reset), options.pool_size)
+        for url in options.url])
+    # Ranges of a large file count towards the requests in flight.
+    max_in_flight = options.workers * (options.upload_parallelism if options.upload_threshold else 1)
+    pacer = Pacer(max_in_flight, options.adaptive, options.max_rate)
+    stop_writing = None
+    if metrics and options.watch:
+        stop_writing = start_writing_metrics(metrics, options)
+    try:
+        if options.workers <= 1:
+            errors = run_worker(queue, options, endpoints, dedup, journal, pacer, stage)
+        else:
+            errors = run_workers(queue, options, endpoints, options.workers, dedup, journal, pacer, stage)
+        return errors + list(stage.errors) if stage else errors
+    finally:
+        if stage:
+            stage.close()
+        queue.close()
+        endpoints.close()
+        if backlog_stats:
+            backlog_stats.close()
+        if trace:
+            trace.close()
+        if dedup:
+            dedup.close()
+        if journal:
+            journal.close()
+        if stop_writing:
+            stop_writing.set()
+        if metrics:
+            write_metrics(metrics, options)
+
+
+def write_metrics(metrics, options):
+    if options.metrics_textfile:
+        metrics.write_textfile(options.metrics_textfile)
+    if options.metrics_json:
+        metrics.write_json(options.metrics_json)
 
-    errors = []
-    for task in queue.iter_tasks():
-        is_ok = poster.post(task.name, task.input)
-        if not is_ok:
-            task.push_back()
-            errors += poster.errors
 
+def start_writing_metrics(metrics, options):
+    """Write metrics every `metrics_interval` seconds until the returned event is set."""
+    stop = threading.Event()
+
+    def write_periodically():
+        while not stop.wait(options.metrics_interval):
+            write_metrics(metrics, options)
+
+    thread = threading.Thread(target=write_periodically, name='dozup-metrics')
+    thread.daemon = True
+    thread.start()
+    return stop
+
+
+def run_worker(queue, options, endpoints, dedup=None, journal=None, pacer=None, stage=None):
+    """Post tasks from the queue until it is empty or a task is pushed back.
+
+    With the `watch` option, carry on regardless. Stops early if the
+    circuit breakers of all the endpoints open (or, with `watch`, waits
+    for one to close). With a `dedup` index, tasks whose content the
+    service has already accepted are filed away without being posted.
+    With a transform `stage`, what is posted is the transformed content.
+
+    Returns --
+        list of the most recent errors reported by the server.
+    """
+    poster = DozupPoster(
+        endpoints, content_encoding=options.content_encoding, metrics=queue.metrics, journal=journal, pacer=pacer,
+        upload_threshold=options.upload_threshold, upload_chunk_size=options.upload_chunk_size,
+        upload_parallelism=options.upload_parallelism, hooks=queue.hooks)
+    if options.batch_size > 1:
+        batches = queue.iter_batches(options.batch_size, options.batch_bytes, watch=options.watch)
+        for batch in batches:
+            if stage:
+                batch = stage.transform_batch(batch)
+            digests = [dedup and content_digest(task.input) for task in batch]
+            fresh = [
+                (task, digest) for task, digest in zip(batch, digests)
+                if not (digest and is_duplicate(dedup, digest, task, poster))]
+            if not fresh:
+                continue
+            if not wait_until_available(poster, options.watch):
+                batches.close()
+                break
+            for (task, digest), is_ok in zip(fresh, poster.post_batch([task for task, digest in fresh])):
+                if not is_ok:
+                    task.push_back()
+                elif digest:
+                    dedup.add(digest, poster.url)
+    else:
+        if stage:
+            tasks = stage.iter_tasks(queue, watch=options.watch)
+        else:
+            tasks = queue.iter_tasks(watch=options.watch, claim_count=options.claim_count)
+        for task in tasks:
+            digest = dedup and content_digest(task.input)
+            if digest and is_duplicate(dedup, digest, task, poster):
+                continue
+            if not wait_until_available(poster, options.watch):
+                tasks.close()
+                break
+            is_ok = poster.post(task.name, task.input, task.state_path)
+            if not is_ok:
+                task.push_back()
+            elif digest:
+                dedup.add(digest, poster.url)
+    return list(poster.errors)
+
+
+def is_duplicate(dedup, digest, task, poster):
+    """Whether the poster’s service has already accepted the task’s content, which has this digest.
+
+    Replicas share what they have accepted, recorded under the first URL.
+    """
+    if dedup.is_known(digest, poster.url):
+        poster.metrics.increment('deduplicated')
+        poster.journal.record(task.name, 'duplicate')
+        return True
+    return False
+
+
+def wait_until_available(poster, watch):
+    """Whether the poster’s endpoint may be posted to now.
+
+    With `watch`, waits until it is instead.
+    """
+    delay = poster.time_until_available()
+    if delay and watch:
+        time.sleep(delay)
+        return True
+    return not delay
+
+
+def run_workers(queue, options, endpoints, count, dedup=None, journal=None, pacer=None, stage=None):
+    """Run `count` workers in parallel threads sharing the one queue.
+
+    Each worker has its own poster, but they share the endpoints (with
+    their connection pools and circuit breakers), the pacer and the
+    transform stage.
+
+    Returns --
+        list of errors reported by the server to any of the workers.
+    """
+    results = [None] * count
+
+    def work(i):
+        try:
+            results[i] = run_worker(queue, options, endpoints, dedup, journal, pacer, stage)
+        except Exception as err:
+            results[i] = err
+
+    threads = [threading.Thread(target=work, args=(i,), name='dozup-worker-%d' % i) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    errors = []
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+        errors += result
     return errors
@@ -0,0 +1,209 @@
+# -*- coding: UTF-8 -*-
+
+"""Rolling the contents of `done` up in to archive segments.
+
+Left alone, `done` grows by a file per task for ever. `Compactor`
+moves files that have been there a while in to ZIP archives, one series
+of segments per day (or hour) in which they were filed, under `archive`
+in the data directory:
+
+    archive/2024-05-01/000001.zip
+    archive/2024-05-01/000002.zip
+    archive/index.sqlite3
+
+The index maps each file’s path (relative to `done`) to the segment
+holding it, so it can be found again with `find` or `read`.
+
+Compaction is incremental: each run takes whatever has become old
+enough since the last, and a run that is interrupted is taken up by the
+next. Only files filed at least `min_age` seconds ago are touched, so
+it is safe to run while workers are still filing files in `done`;
+but only one compaction should run at a time.
+"""
+
+import errno
+import os
+import sqlite3
+import time
+import zipfile
+
+try:
+    from os import scandir
+except ImportError:  # Python 2
+    from scandir import scandir
+
+from .queue import ensure_dir
+
+
+BUCKET_FORMATS = {
+    'day': '%Y-%m-%d',
+    'hour': '%Y-%m-%dT%H',
+}
+
+# Files already compressed are stored as they are.
+STORED_EXTENSIONS = ('.zip', '.gz', '.bz2', '.xz', '.tgz', '.jpg', '.png')
+
+
+class Segment(object):
+    """An archive segment being written, and the files going in to it."""
+    def __init__(self, dir_path, name):
+        self.dir_path = dir_path
+        self.name = name
+        self.temp_path = os.path.join(dir_path, '.%s.tmp' % name)
+        self.archive = zipfile.ZipFile(self.temp_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.members = []
+        self.byte_count = 0
+
+    def add(self, file_path, rel_path, done_at, size):
+        compress_type = zipfile.ZIP_STORED if rel_path.lower().endswith(STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED
+        self.archive.write(file_path, rel_path, compress_type)
+        self.members.append((file_path, rel_path, done_at))
+        self.byte_count += size
+
+    def close(self):
+        """Finish writing the segment and move it in to place."""
+        self.archive.close()
+        with open(self.temp_path, 'rb') as strm:
+            os.fsync(strm.fileno())
+        os.rename(self.temp_path, os.path.join(self.dir_path, self.name))
+
+
+class Compactor(object):
+    """Moves old files from `done` in to time-bucketed archive segments.
+
+    Segments hold up to `max_segment_bytes` of content (before
+    compression) or `max_segment_files` files.
+    """
+    def __init__(
+            self, dir_path, bucket='day', min_age=3600.0,
+            max_segment_bytes=256 * 1024 * 1024, max_segment_files=10000):
+        if bucket not in BUCKET_FORMATS:
+            raise ValueError('Unknown bucket %r' % (bucket,))
+        self.done_dir = os.path.join(dir_path, 'done')
+        self.archive_dir = os.path.join(dir_path, 'archive')
+        self.bucket_format = BUCKET_FORMATS[bucket]
+        self.min_age = min_age
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_files = max_segment_files
+        ensure_dir(self.archive_dir)
+        self.connection = sqlite3.connect(os.path.join(self.archive_dir, 'index.sqlite3'), timeout=30.0)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS members ('
+                ' path TEXT PRIMARY KEY, segment TEXT NOT NULL, done_at REAL NOT NULL)')
+
+    def compact(self):
+        """Move files old enough from `done` in to segments.
+
+        Empty directories left behind are removed once they too are
+        old enough, which is usually on the following run.
+
+        Returns --
+            number of files archived.
+        """
+        now = time.time()
+        segments = {}
+        file_count = 0
+        dir_paths = []
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            try:
+                entries = sorted(scandir(os.path.join(self.done_dir, rel_dir)), key=lambda e: e.name)
+            except OSError as err:
+                if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name)
+                if entry.is_dir():
+                    stack.append(rel_path)
+                    dir_paths.append(rel_path)
+                    continue
+                try:
+                    entry_stat = entry.stat()
+                except OSError as err:
+                    if err.errno == errno.ENOENT:
+                        continue
+                    raise
+                # Renaming the file in to `done` updated its ctime.
+                done_at = entry_stat.st_ctime
+                if now - done_at < self.min_age:
+                    continue
+                if self.is_archived(rel_path, done_at):
+                    # A previous run stopped before removing it.
+                    remove_file(entry.path)
+                    continue
+                bucket = time.strftime(self.bucket_format, time.gmtime(done_at))
+                segment = segments.get(bucket)
+                if segment is None:
+                    segment = segments[bucket] = self.start_segment(bucket)
+                segment.add(entry.path, rel_path, done_at, entry_stat.st_size)
+                file_count += 1
+                if segment.byte_count >= self.max_segment_bytes or len(segment.members) >= self.max_segment_files:
+                    self.finish_segment(bucket, segment)
+                    del segments[bucket]
+        for bucket, segment in segments.items():
+            self.finish_segment(bucket, segment)
+        for rel_dir in reversed(dir_paths):
+            self.remove_dir_if_old(os.path.join(self.done_dir, rel_dir), now)
+        return file_count
+
+    def is_archived(self, rel_path, done_at):
+        row = self.connection.execute('SELECT segment, done_at FROM members WHERE path = ?', (rel_path,)).fetchone()
+        return (
+            row is not None and row[1] == done_at
+            and os.path.exists(os.path.join(self.archive_dir, row[0])))
+
+    def start_segment(self, bucket):
+        dir_path = os.path.join(self.archive_dir, bucket)
+        ensure_dir(dir_path)
+        numbers = [int(name[:-4]) for name in os.listdir(dir_path) if name.endswith('.zip') and name[:-4].isdigit()]
+        return Segment(dir_path, '%06d.zip' % (max(numbers or [0]) + 1))
+
+    def finish_segment(self, bucket, segment):
+        """Close the segment, index its members and only then remove the originals."""
+        segment.close()
+        segment_path = os.path.join(bucket, segment.name)
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO members (path, segment, done_at) VALUES (?, ?, ?)',
+                [(rel_path, segment_path, done_at) for file_path, rel_path, done_at in segment.members])
+        for file_path, rel_path, done_at in segment.members:
+            remove_file(file_path)
+
+    def remove_dir_if_old(self, dir_path, now):
+        # A directory modified lately may be about to have a file filed in it.
+        try:
+            if now - os.stat(dir_path).st_mtime >= self.min_age:
+                os.rmdir(dir_path)
+        except OSError as err:
+            if err.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST):
+                raise
+
+    def find(self, rel_path):
+        """Return the path of the segment holding this file (relative to `archive`), or None."""
+        row = self.connection.execute('SELECT segment FROM members WHERE path = ?', (rel_path,)).fetchone()
+        return row and row[0]
+
+    def read(self, rel_path):
+        """Return the content of an archived file.
+
+        Raises KeyError if it is not in the archive.
+        """
+        segment_path = self.find(rel_path)
+        if segment_path is None:
+            raise KeyError(rel_path)
+        with zipfile.ZipFile(os.path.join(self.archive_dir, segment_path), 'r') as archive:
+            return archive.read(rel_path)
+
+    def close(self):
+        self.connection.close()
+
+
+def remove_file(file_path):
+    try:
+        os.remove(file_path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+
+"""Remembering content the server has already accepted.
+
+Producers sometimes drop the same document more than once, as loose
+files or inside archives. A `DedupIndex` records a hash of the content
+of each task accepted by each endpoint, so that later copies can go
+straight to `done` without being posted again.
+
+The index is an SQLite database, usually `dedup.sqlite3` in the data
+directory, and may be shared by several processes. It is bounded:
+once it holds more than `max_entries` entries, those least recently
+seen are evicted. Losing entries (to eviction or a crash) only means
+some content is posted twice, so writes are not synced to disk.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def content_digest(stream):
+    """Hash the content of a stream and rewind it, ready to be posted.
+
+    Returns --
+        hex SHA-256 digest, or None if the stream cannot be rewound
+        (a large member of a tar archive, say) so is left unread.
+    """
+    if not getattr(stream, 'can_rewind', True):
+        return None
+    digest = hashlib.sha256()
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+class DedupIndex(object):
+    """Persistent set of (content digest, endpoint URL) pairs, least recently seen evicted first."""
+    # Evict this fraction more than needed, so eviction is occasional.
+    eviction_slack = 0.1
+
+    def __init__(self, path, max_entries=1000000):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('PRAGMA synchronous = OFF')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS accepted ('
+                ' digest TEXT NOT NULL, url TEXT NOT NULL, seen_at REAL NOT NULL,'
+                ' PRIMARY KEY (digest, url))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS accepted_seen_at ON accepted (seen_at)')
+        self.entry_count = self.connection.execute('SELECT COUNT(*) FROM accepted').fetchone()[0]
+
+    def is_known(self, digest, url):
+        """Whether this content has been accepted by this endpoint (noting that it was seen again)."""
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                'UPDATE accepted SET seen_at = ? WHERE digest = ? AND url = ?', (time.time(), digest, url))
+            return cursor.rowcount > 0
+
+    def add(self, digest, url):
+        """Note that this content has been accepted by this endpoint."""
+        with self.lock, self.connection:
+            now = time.time()
+            cursor = self.connection.execute(
+                'INSERT OR IGNORE INTO accepted (digest, url, seen_at) VALUES (?, ?, ?)', (digest, url, now))
+            if not cursor.rowcount:
+                self.connection.execute(
+                    'UPDATE accepted SET seen_at = ? WHERE digest = ? AND url = ?', (now, digest, url))
+                return
+            self.entry_count += 1
+            if self.entry_count > self.max_entries:
+                self.evict()
+
+    def evict(self):
+        # Other processes add entries too, so count afresh.
+        self.entry_count = self.connection.execute('SELECT COUNT(*) FROM accepted').fetchone()[0]
+        excess = self.entry_count - self.max_entries
+        if excess > 0:
+            excess += int(self.max_entries * self.eviction_slack)
+            self.connection.execute(
+                'DELETE FROM accepted WHERE rowid IN'
+                ' (SELECT rowid FROM accepted ORDER BY seen_at LIMIT ?)', (excess,))
+            self.entry_count = max(0, self.entry_count - excess)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,53 @@
+# -*- coding: UTF-8 -*-
+
+"""Callbacks told of each task as it goes through the queue and poster.
+
+Metrics count and time in aggregate; hooks instead report each event
+as it happens, so that a slow run can be followed file by file (see
+`dozup.trace` for writing them out as a trace). The events are:
+- claimed: a file was moved to `doing` (name is the file’s path)
+- opened: a task was read from a claimed file (name is the task’s,
+  with the file’s path as `file_path`)
+- post_start: a task is about to be posted
+- post_end: the outcome of posting a task is known, with its `status`,
+  `seconds` and `bytes` as for the journal
+- done: a claimed file was filed in `done`, with the number of `tasks` posted
+- pushed_back: a claimed file was returned for another attempt, likewise
+- released: a claimed file was returned unprocessed
+
+Callbacks are called in the thread where the event happened, as
+`callback(event, name, time, details)`, where `details` is a dict of the
+other values. They should be quick, and must be thread-safe if the queue
+is shared between threads. Until one is registered, each event costs a
+test of `active`.
+"""
+
+import time
+
+
+EVENTS = ('claimed', 'opened', 'post_start', 'post_end', 'done', 'pushed_back', 'released')
+
+
+class Hooks(object):
+    """The callbacks registered for a queue and its posters.
+
+    Register callbacks before starting work; the same `Hooks` may be
+    passed to the queue and to each poster.
+    """
+    def __init__(self):
+        self.callbacks = []
+        self.active = False
+
+    def register(self, callback, events=EVENTS):
+        """Have `callback` called for each of these events (by default, all of them)."""
+        unknown = set(events).difference(EVENTS)
+        if unknown:
+            raise ValueError('Unknown events %s' % ', '.join(sorted(unknown)))
+        self.callbacks.append((frozenset(events), callback))
+        self.active = True
+
+    def emit(self, event, name, **details):
+        when = time.time()
+        for events, callback in self.callbacks:
+            if event in events:
+                callback(event, name, when, details)
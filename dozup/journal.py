@@ -0,0 +1,94 @@
+# -*- coding: UTF-8 -*-
+
+"""A running record of what became of each task.
+
+A `Journal` appends a line of JSON per task to a file as tasks are
+posted, so progress and failures can be followed (with `tail -f`, say)
+while a long run is still going. Each entry has:
+- time: when the outcome was known (seconds since the epoch)
+- path: the task’s name
+- status: the server’s status code, ‘error’ if no response was had,
+  ‘duplicate’ if the task was not posted because the server had
+  already accepted its content, or ‘transform_failed’ if it was not
+  posted because its transform failed
+- seconds: how long the request took
+- bytes: how many bytes of content were sent
+- error: the server’s error messages, if any, joined with ‘; ’
+
+Entries are buffered, and written out and synced to disk in batches,
+every `flush_count` entries or `flush_interval` seconds, and when the
+journal is closed. When no journal is wanted, `NULL_JOURNAL` stands in.
+"""
+
+import json
+import os
+import threading
+import time
+
+
+class Journal(object):
+    """Thread-safe append-only JSON Lines file of task outcomes."""
+    def __init__(self, path, flush_count=100, flush_interval=1.0):
+        self.path = path
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+        self.strm = open(path, 'a')
+        self.lines = []
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.flush_periodically, name='dozup-journal')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, path, status, seconds=None, byte_count=None, error=None):
+        line = json.dumps({
+            'time': time.time(),
+            'path': path,
+            'status': status,
+            'seconds': seconds,
+            'bytes': byte_count,
+            'error': error,
+        }, sort_keys=True)
+        with self.lock:
+            self.lines.append(line)
+            if len(self.lines) >= self.flush_count:
+                self.write_lines()
+
+    def flush(self):
+        """Write out and sync any buffered entries."""
+        with self.lock:
+            self.write_lines()
+
+    def write_lines(self):
+        if not self.lines:
+            return
+        self.strm.write('\n'.join(self.lines) + '\n')
+        self.lines = []
+        self.strm.flush()
+        os.fsync(self.strm.fileno())
+
+    def flush_periodically(self):
+        while not self.stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+        with self.lock:
+            self.write_lines()
+            self.strm.close()
+
+
+class NullJournal(object):
+    """Stand-in for `Journal` that records nothing."""
+    def record(self, path, status, seconds=None, byte_count=None, error=None):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_JOURNAL = NullJournal()
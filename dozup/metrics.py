@@ -0,0 +1,244 @@
+# -*- coding: UTF-8 -*-
+
+"""Counters and per-stage latency histograms.
+
+A `Metrics` object is shared by the queue and the posters of a run and
+can be written out as a Prometheus textfile (for the node exporter’s
+textfile collector) or as a JSON snapshot. When metrics are not wanted,
+`NULL_METRICS` stands in and every call is a no-op.
+
+The stages timed are:
+- scan: finding the next file in `todo`
+- claim: moving it to `doing`
+- read: reading the task’s input while posting it
+- post: the whole of each request to the server
+"""
+
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+COUNTER_HELP = {
+    'claimed': 'Files claimed from todo.',
+    'stolen': 'Files claimed from another shard.',
+    'recovered': 'Files returned to todo after their claims expired.',
+    'lease_lost': 'Files recovered by another process before they could be filed away.',
+    'pushed_back': 'Files with a task pushed back.',
+    'unreadable': 'Archives pushed back because they could not be read.',
+    'deduplicated': 'Tasks not posted because their content had already been accepted.',
+    'posts': 'Requests made to the server, by status code.',
+    'backed_off': 'Times the number of requests in flight was cut because the server was overloaded.',
+    'bytes_sent': 'Bytes read from task inputs and sent, by status code.',
+}
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        result = []
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+
+class StageTimer(object):
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.stage, time.time() - self.started)
+
+
+class MeteredStream(object):
+    """Wraps a task’s input to count the bytes read and the time spent reading."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+
+    def read(self, size=-1):
+        started = time.time()
+        data = self.stream.read(size)
+        self.read_seconds += time.time() - started
+        self.bytes_read += len(data)
+        return data
+
+    @property
+    def iter_raw(self):
+        # A property so that it is missing when the stream’s is.
+        iter_raw = self.stream.iter_raw
+
+        def metered(chunk_size):
+            for chunk in iter_raw(chunk_size):
+                self.bytes_read += len(chunk)
+                yield chunk
+        return metered
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class Metrics(object):
+    """Thread-safe counters and histograms."""
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, status=None):
+        key = name, status
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def timer(self, stage):
+        """Context manager that records how long its block takes."""
+        return StageTimer(self, stage)
+
+    def meter(self, stream):
+        return MeteredStream(stream)
+
+    def record_post(self, status, seconds, metered_stream):
+        """Record a request for a single task (status is the code, or ‘error’)."""
+        self.increment('posts', status=status)
+        self.increment('bytes_sent', metered_stream.bytes_read, status=status)
+        self.observe('read', metered_stream.read_seconds)
+        self.observe('post', seconds)
+
+    def record_batch(self, status, seconds, byte_count):
+        self.increment('posts', status=status)
+        self.increment('bytes_sent', byte_count, status=status)
+        self.observe('post', seconds)
+
+    def snapshot(self):
+        """Return the current values as a JSON-compatible dict."""
+        with self.lock:
+            counters = {}
+            for (name, status), value in sorted(self.counters.items(), key=sort_key):
+                if status is None:
+                    counters[name] = value
+                else:
+                    counters.setdefault(name, {})[str(status)] = value
+            histograms = {}
+            for stage, histogram in sorted(self.histograms.items()):
+                histograms[stage] = {
+                    'buckets': list(self.buckets),
+                    'counts': list(histogram.counts),
+                    'sum': histogram.sum,
+                    'count': histogram.count,
+                }
+        return {'time': time.time(), 'counters': counters, 'histograms': histograms}
+
+    def prometheus_text(self):
+        """Return the current values in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            names = sorted(set(name for name, status in self.counters))
+            for name in names:
+                metric = 'dozup_%s_total' % name
+                lines.append('# HELP %s %s' % (metric, COUNTER_HELP.get(name, name)))
+                lines.append('# TYPE %s counter' % metric)
+                for (counter_name, status), value in sorted(self.counters.items(), key=sort_key):
+                    if counter_name != name:
+                        continue
+                    if status is None:
+                        lines.append('%s %d' % (metric, value))
+                    else:
+                        lines.append('%s{status="%s"} %d' % (metric, status, value))
+            if self.histograms:
+                lines.append('# HELP dozup_stage_seconds Time spent in each stage of processing a task.')
+                lines.append('# TYPE dozup_stage_seconds histogram')
+            for stage, histogram in sorted(self.histograms.items()):
+                for bound, count in zip(self.buckets + ('+Inf',), histogram.cumulative_counts()):
+                    lines.append('dozup_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, bound, count))
+                lines.append('dozup_stage_seconds_sum{stage="%s"} %r' % (stage, histogram.sum))
+                lines.append('dozup_stage_seconds_count{stage="%s"} %d' % (stage, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, file_path):
+        write_atomically(file_path, self.prometheus_text())
+
+    def write_json(self, file_path):
+        write_atomically(file_path, json.dumps(self.snapshot(), indent=2, sort_keys=True) + '\n')
+
+
+class NullTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class NullMetrics(object):
+    """Stands in for `Metrics` when they are not wanted."""
+    timer_instance = NullTimer()
+
+    def increment(self, name, value=1, status=None):
+        pass
+
+    def observe(self, stage, seconds):
+        pass
+
+    def timer(self, stage):
+        return self.timer_instance
+
+    def meter(self, stream):
+        return stream
+
+    def record_post(self, status, seconds, metered_stream):
+        pass
+
+    def record_batch(self, status, seconds, byte_count):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def sort_key(item):
+    (name, status), value = item
+    return name, str(status)
+
+
+def write_atomically(file_path, text):
+    """Replace the file with this text so that readers never see it half written."""
+    dir_path = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=dir_path)
+    try:
+        with os.fdopen(fd, 'w') as strm:
+            strm.write(text)
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, file_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
@@ -1,11 +1,178 @@
 # -*- coding: UTF-8 -*-
 
+import collections
+import email.utils
+import errno
+import io
+import json
+import os
 import re
+import stat
+import struct
+import threading
+import time
+import zipfile
+import zlib
 import requests
+from requests.compat import urljoin, urlsplit
+
+from .hooks import Hooks
+from .journal import NULL_JOURNAL
+from .metrics import NULL_METRICS, MeteredStream, write_atomically
+
+try:
+    from http.client import responses as REASONS
+except ImportError:  # Python 2
+    from httplib import responses as REASONS
 
 
 SUCCESSFUL_CODES = requests.codes.ok, requests.codes.created, requests.codes.accepted
+BATCH_CODES = SUCCESSFUL_CODES + (requests.codes.multi_status,)
+OVERLOAD_CODES = requests.codes.too_many_requests, requests.codes.service_unavailable
+# The server has forgotten an upload, which must be started again.
+FORGOTTEN_CODES = requests.codes.not_found, requests.codes.gone
+# Longest a Retry-After header may hold up posting.
+MAX_RETRY_AFTER = 300.0
+DEFAULT_PORTS = {'http': 80, 'https': 443}
 JSON_CONTENT_TYPES = re.compile(r'application/(\w+\+)?json')
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_chunks(stream, chunk_size=CHUNK_SIZE):
+    """Yield the content of the stream in pieces of at most `chunk_size` bytes."""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def has_known_size(stream):
+    """Whether requests can find the size of this stream without reading it."""
+    if hasattr(stream, 'getvalue'):
+        return True
+    try:
+        return stat.S_ISREG(os.fstat(stream.fileno()).st_mode)
+    except (AttributeError, OSError, IOError, io.UnsupportedOperation):
+        return False
+
+
+# Window bits for zlib.compressobj giving each Content-Encoding.
+ENCODING_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def iter_compressed(chunks, content_encoding, level=6):
+    """Yield the chunks compressed with this content encoding."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODING_WBITS[content_encoding])
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def iter_gzip_passthrough(member, chunk_size=CHUNK_SIZE):
+    """Yield a gzip stream made from a deflated ZIP member without recompressing it.
+
+    Gzip and ZIP use the same raw deflate data, and the ZIP directory
+    already has the CRC-32 and size that end a gzip stream.
+    """
+    yield GZIP_HEADER
+    for chunk in member.iter_raw(chunk_size):
+        yield chunk
+    yield struct.pack('<LL', member.info.CRC, member.info.file_size & 0xffffffff)
+
+
+def can_pass_through(stream, content_encoding):
+    """Whether the stream’s stored bytes can be sent as they are in this encoding."""
+    if content_encoding != 'gzip' or not hasattr(stream, 'iter_raw') or not stream.archive_path:
+        # Members of nested archives have no file to read from.
+        return False
+    info = stream.info
+    return info.compress_type == zipfile.ZIP_DEFLATED and not info.flag_bits & 0x1
+
+
+def encoded_body(stream, content_encoding):
+    """Return the body for this stream compressed with the content encoding.
+
+    Deflated members of ZIP archives are sent as stored when
+    the encoding is gzip; anything else is compressed as it is sent.
+    """
+    if can_pass_through(stream, content_encoding):
+        return iter_gzip_passthrough(stream)
+    return iter_compressed(iter_chunks(stream), content_encoding)
+
+
+def request_body(stream):
+    """Return the body to pass to requests for this stream.
+
+    A regular file is passed as it is: requests takes the Content-Length
+    from `fstat` and the file is sent in blocks straight from the OS,
+    never held in memory as a whole. Streams of unknown length, such as
+    members of ZIP archives, are sent with chunked transfer encoding in
+    fixed-size chunks (left to itself, requests would iterate over them
+    line by line, which for binary data may mean the entire payload).
+    """
+    if has_known_size(stream):
+        return stream
+    return iter_chunks(stream)
+
+
+def is_regular_file(stream):
+    """Whether this is a regular file, which can be opened again by name to read parts of it."""
+    try:
+        return bool(stream.name) and stat.S_ISREG(os.fstat(stream.fileno()).st_mode)
+    except (AttributeError, OSError, IOError, io.UnsupportedOperation):
+        return False
+
+
+class UploadState(object):
+    """Where a file being uploaded in ranges has got to.
+
+    Records the URL of the upload and which chunks the server has
+    acknowledged, in a JSON sidecar file rewritten as each is
+    acknowledged, so that a task pushed back after a failure can resume
+    from there. Also recorded are the size and modification time of the
+    file and the chunk size, so that a different file reusing the name
+    (or a change of chunk size) starts a fresh upload.
+    """
+    def __init__(self, path, file_path, chunk_size):
+        self.path = path
+        file_stat = os.stat(file_path)
+        self.file_size = file_stat.st_size
+        self.key = [file_stat.st_size, int(file_stat.st_mtime), chunk_size]
+        self.upload_url = None
+        self.acknowledged = set()
+        try:
+            with open(path, 'r') as strm:
+                data = json.load(strm)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            pass  # Half written by a version that did not write atomically; start again.
+        else:
+            if data.get('key') == self.key:
+                self.upload_url = data['url']
+                self.acknowledged = set(data['acknowledged'])
+
+    def save(self):
+        write_atomically(self.path, json.dumps({
+            'key': self.key,
+            'url': self.upload_url,
+            'acknowledged': sorted(self.acknowledged),
+        }))
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
 
 
 class DozupError(object):
@@ -28,26 +195,581 @@ class DozupError(object):
         return '%d (%s)' % (self.status_code, self.message)
 
 
-class DozupPoster(object):
-    def __init__(self, url):
+def error_messages(obj, default):
+    """The error messages in a JSON object from the server."""
+    if 'errors' in obj:
+        return obj['errors']
+    if 'error' in obj:
+        return [obj['error']]
+    return [default]
+
+
+def errors_from_response(response):
+    """The errors described by an unsuccessful response, as a list of `DozupError`."""
+    if response.headers.get('Content-Type') == 'text/plain':
+        return [DozupError(response.status_code, response.text)]
+    if JSON_CONTENT_TYPES.match(response.headers.get('Content-Type')):
+        return [DozupError(response.status_code, msg) for msg in error_messages(response.json(), response.reason)]
+    return []
+
+
+def batch_results(response):
+    """The list of results in the reply to a batch, or None if it is not as expected."""
+    try:
+        body = response.json()
+    except ValueError:
+        return None
+    results = body.get('results', []) if isinstance(body, dict) else None
+    return results if isinstance(results, list) else None
+
+
+def join_messages(errors, default):
+    """The messages of a list of `DozupError` as one string, for the journal."""
+    return '; '.join('%s' % (error.message,) for error in errors) or default
+
+
+def parse_retry_after(value, now):
+    """Seconds to wait according to a Retry-After header (delay or date), or None if unparsable."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(parsed) - now)
+
+
+def is_server_failure(status_code):
+    """Whether this status means the server (rather than the file) is at fault."""
+    return status_code >= 500 or status_code == requests.codes.too_many_requests
+
+
+class CircuitBreaker(object):
+    """Stops a poster hammering an endpoint that keeps failing.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    no requests should be made for `reset_timeout` seconds. After that,
+    requests are let through again; the first failure reopens the
+    circuit and the first success closes it. May be shared between
+    posters in different threads.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_count = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def time_until_retry(self):
+        """Seconds until requests may be made again (0 if they may be made now)."""
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.opened_at + self.reset_timeout - time.time())
+
+    def record_success(self):
+        with self.lock:
+            self.failure_count = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failure_count += 1
+            if self.failure_count >= self.failure_threshold:
+                self.opened_at = time.time()
+
+    def record(self, status_code):
+        if is_server_failure(status_code):
+            self.record_failure()
+        else:
+            self.record_success()
+
+
+class Endpoint(object):
+    """A URL to post to, with its own pool of keep-alive connections and circuit breaker.
+
+    Up to `pool_size` connections are kept open for reuse by `adapter`,
+    which the sessions of posters mount. May be shared between posters
+    in different threads.
+    """
+    def __init__(self, url, circuit_breaker=None, pool_size=10):
         self.url = url
-        self.session = requests.Session()
-        self.errors = []
+        self.origin = origin_of(url)
+        self.path = urlsplit(url).path
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.outstanding = 0
+
+    def __repr__(self):
+        return 'Endpoint(%r)' % (self.url,)
+
+
+def origin_of(url):
+    """The scheme, host and port of a URL (the port filled in if it is the default)."""
+    parts = urlsplit(url)
+    return parts.scheme, parts.hostname, parts.port or DEFAULT_PORTS.get(parts.scheme)
 
-    def post(self, file_name, stream):
-        response = self.session.post(self.url, stream)
+
+class Endpoints(object):
+    """Replicas of a service, requests to be spread over them.
+
+    Each request goes to whichever endpoint has fewest requests
+    outstanding, taking turns among those with equally few. An endpoint
+    whose circuit breaker is open is passed over until it closes again,
+    unless all are open. May be shared between posters in different threads.
+    """
+    def __init__(self, endpoints):
+        if not endpoints:
+            raise ValueError('Need at least one endpoint')
+        self.endpoints = list(endpoints)
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        """The URL of the first endpoint, standing for the service as a whole."""
+        return self.endpoints[0].url
+
+    def time_until_available(self):
+        """Seconds until some endpoint may be posted to (0 if one may be now)."""
+        return min(endpoint.circuit_breaker.time_until_retry() for endpoint in self.endpoints)
+
+    def acquire(self, url=None):
+        """Choose the endpoint for the next request, counting it as outstanding.
+
+        A request to a `url` given by an endpoint (such as that of an
+        upload it started) goes to the endpoint on the same host and port,
+        or if several are, the one whose path is the longest prefix of it.
+
+        Returns --
+            the `Endpoint`, to be passed to `release` once the request is done.
+        """
+        with self.lock:
+            count = len(self.endpoints)
+            chosen = self.owner_of(url) if url else None
+            if chosen is None:
+                best_key = None
+                for i in range(count):
+                    index = (self.next_index + i) % count
+                    endpoint = self.endpoints[index]
+                    key = endpoint.circuit_breaker.time_until_retry(), endpoint.outstanding
+                    if best_key is None or key < best_key:
+                        chosen, best_key, chosen_index = endpoint, key, index
+                self.next_index = (chosen_index + 1) % count
+            chosen.outstanding += 1
+            return chosen
+
+    def owner_of(self, url):
+        origin = origin_of(url)
+        path = urlsplit(url).path
+        owners = [e for e in self.endpoints if e.origin == origin]
+        return max(owners, key=lambda e: len(e.path) if path.startswith(e.path) else -1) if owners else None
+
+    def release(self, endpoint):
+        with self.lock:
+            endpoint.outstanding -= 1
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.adapter.close()
+
+
+class Pacer(object):
+    """Limits how many requests are in flight and how often they are made.
+
+    Up to `max_in_flight` requests (any number if None) may be in flight
+    at once. If `adaptive` is set, the limit instead starts at 1 and is adjusted by additive
+    increase, multiplicative decrease (AIMD): it grows by about one
+    per round of successful responses whose latency stays within
+    `latency_tolerance` times the lowest seen lately, and is cut by
+    `decrease_factor` on a 429 or 503, a failed request, or a slow
+    response. Only one cut is made for requests sent before the last.
+
+    With `max_rate`, requests are spaced to make no more than that many
+    each second. A Retry-After header on any response holds up every
+    request for that long (up to `MAX_RETRY_AFTER` seconds).
+
+    May be shared between posters in different threads.
+    """
+    def __init__(
+            self, max_in_flight=None, adaptive=False, max_rate=None, latency_tolerance=2.0, decrease_factor=0.5):
+        if adaptive and not max_in_flight:
+            raise ValueError('Adaptive pacing needs a maximum number of requests in flight')
+        self.max_in_flight = max_in_flight
+        self.adaptive = adaptive
+        self.max_rate = max_rate
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.limit = 1.0 if adaptive else max_in_flight
+        self.in_flight = 0
+        self.baseline = None
+        self.decreased_at = 0.0
+        self.blocked_until = 0.0
+        self.next_slot = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait until a request may be made.
+
+        Returns --
+            when the request was let through, to be passed to `release`.
+        """
+        with self.condition:
+            while True:
+                now = time.time()
+                delay = self.blocked_until - now
+                if delay <= 0 and (self.limit is None or self.in_flight < int(self.limit)):
+                    break
+                self.condition.wait(delay if delay > 0 else None)
+            self.in_flight += 1
+            slot = now
+            if self.max_rate:
+                slot = max(now, self.next_slot)
+                self.next_slot = slot + 1.0 / self.max_rate
+        if slot > now:
+            time.sleep(slot - now)
+        return time.time()
+
+    def release(self, started, status_code=None, retry_after=None):
+        """Note the outcome of a request (`status_code` None if it failed outright).
+
+        Returns --
+            whether the limit was cut.
+        """
+        now = time.time()
+        seconds = now - started
+        is_cut = False
+        with self.condition:
+            self.in_flight -= 1
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + min(retry_after, MAX_RETRY_AFTER))
+            if self.adaptive:
+                is_ok = status_code in SUCCESSFUL_CODES or status_code == requests.codes.multi_status
+                is_slow = self.baseline is not None and seconds > self.latency_tolerance * self.baseline
+                if status_code is None or status_code in OVERLOAD_CODES or (is_ok and is_slow):
+                    if started >= self.decreased_at:
+                        self.limit = max(1.0, self.limit * self.decrease_factor)
+                        self.decreased_at = now
+                        is_cut = True
+                elif is_ok:
+                    self.limit = min(float(self.max_in_flight), self.limit + 1.0 / self.limit)
+                if is_ok:
+                    # Drops at once to a new low, drifts slowly up.
+                    if self.baseline is None or seconds < self.baseline:
+                        self.baseline = seconds
+                    else:
+                        self.baseline += (seconds - self.baseline) * 0.01
+            self.condition.notify_all()
+        return is_cut
+
+
+class DozupPoster(object):
+    """Posts files to a URL, keeping the most recent errors reported by the server.
+
+    The URL may instead be `Endpoints`, to spread requests over replicas.
+
+    Only the last `max_errors` errors are kept in `errors`; pass a
+    `dozup.journal.Journal` as `journal` to have the outcome of every
+    task recorded as it happens.
+
+    Responses are fed to a `CircuitBreaker` (one per endpoint); callers
+    should check `time_until_available` before posting. Requests are paced by a
+    `Pacer`, which may be shared with other posters.
+
+    If `content_encoding` is ‘gzip’ or ‘deflate’, single posts are
+    compressed and sent with that Content-Encoding.
+
+    Files of `upload_threshold` bytes or more (if set) are instead
+    uploaded in ranges of `upload_chunk_size` bytes, up to
+    `upload_parallelism` at once, when `post` is given a path to record
+    progress in (see `post_in_ranges`).
+
+    Pass a `dozup.metrics.Metrics` instance as `metrics` to have posts
+    timed and counted by status code, and `dozup.hooks.Hooks` as `hooks`
+    to have callbacks told as each task’s post starts and ends.
+
+    Each thread posting (including those uploading ranges) has its own
+    `requests.Session` for each endpoint, sharing the endpoint’s pool of
+    connections; close the endpoints to close the connections.
+    """
+    def __init__(
+            self, url, circuit_breaker=None, content_encoding=None, metrics=None, journal=None, max_errors=1000,
+            pacer=None, upload_threshold=None, upload_chunk_size=8 * 1024 * 1024, upload_parallelism=4, hooks=None):
+        if content_encoding is not None and content_encoding not in ENCODING_WBITS:
+            raise ValueError('Unsupported content encoding %r' % (content_encoding,))
+        if not isinstance(url, Endpoints):
+            url = Endpoints([Endpoint(url, circuit_breaker)])
+        self.endpoints = url
+        self.url = url.url
+        self.errors = collections.deque(maxlen=max_errors)
+        self.content_encoding = content_encoding
+        self.metrics = metrics or NULL_METRICS
+        self.journal = journal or NULL_JOURNAL
+        self.hooks = hooks if hooks is not None else Hooks()
+        self.pacer = pacer or Pacer()
+        self.upload_threshold = upload_threshold
+        self.upload_chunk_size = upload_chunk_size
+        self.upload_parallelism = upload_parallelism
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        return self.session_for(self.endpoints.endpoints[0])
+
+    def session_for(self, endpoint):
+        """Return this thread’s session for the endpoint, mounted on its adapter."""
+        sessions = getattr(self.local, 'sessions', None)
+        if sessions is None:
+            sessions = self.local.sessions = {}
+        session = sessions.get(endpoint)
+        if session is None:
+            session = sessions[endpoint] = requests.Session()
+            session.mount('http://', endpoint.adapter)
+            session.mount('https://', endpoint.adapter)
+        return session
+
+    @property
+    def circuit_breaker(self):
+        return self.endpoints.endpoints[0].circuit_breaker
+
+    def time_until_available(self):
+        """Seconds until an endpoint should be posted to again (0 if one can be now)."""
+        return self.endpoints.time_until_available()
+
+    def record_outcome(self, file_name, status, seconds, byte_count, error=None):
+        """Record the outcome of posting a task in the journal and tell the hooks."""
+        self.journal.record(file_name, status, seconds, byte_count, error)
+        if self.hooks.active:
+            self.hooks.emit('post_end', file_name, status=status, seconds=seconds, bytes=byte_count, error=error)
+
+    def send(self, method='POST', url=None, **kwargs):
+        started = self.pacer.acquire()
+        status_code = retry_after = None
+        try:
+            endpoint = self.endpoints.acquire(url)
+            try:
+                response = self.session_for(endpoint).request(method, url or endpoint.url, **kwargs)
+            except requests.RequestException:
+                endpoint.circuit_breaker.record_failure()
+                raise
+            finally:
+                self.endpoints.release(endpoint)
+            endpoint.circuit_breaker.record(response.status_code)
+            status_code = response.status_code
+            retry_after = parse_retry_after(response.headers.get('Retry-After'), time.time())
+        finally:
+            # Whatever went wrong (even reading the body), the request is no longer in flight.
+            if self.pacer.release(started, status_code, retry_after):
+                self.metrics.increment('backed_off')
+        return response
+
+    def post(self, file_name, stream, state_path=None):
+        """Post the content of the stream.
+
+        With a `state_path`, large enough files are uploaded in ranges.
+
+        Returns --
+            whether the server accepted it.
+        """
+        if self.hooks.active:
+            self.hooks.emit('post_start', file_name)
+        if state_path and self.upload_threshold is not None and is_regular_file(stream):
+            if os.fstat(stream.fileno()).st_size >= self.upload_threshold:
+                return self.post_in_ranges(file_name, stream.name, state_path)
+        stream = MeteredStream(stream)
+        started = time.time()
+        try:
+            response = self.post_stream(stream)
+        except requests.RequestException as err:
+            seconds = time.time() - started
+            self.metrics.record_post('error', seconds, stream)
+            self.record_outcome(file_name, 'error', seconds, stream.bytes_read, str(err))
+            raise
+        seconds = time.time() - started
+        self.metrics.record_post(response.status_code, seconds, stream)
         if response.status_code in SUCCESSFUL_CODES:
+            self.record_outcome(file_name, response.status_code, seconds, stream.bytes_read)
             return True
-        if response.headers.get('Content-Type') == 'text/plain':
-            self.errors.append(DozupError(response.status_code, response.text))
-        if JSON_CONTENT_TYPES.match(response.headers.get('Content-Type')):
-            obj = response.json()
-            if 'errors' in obj:
-                msgs = obj['errors']
-            elif 'error' in obj:
-                msgs = [obj['error']]
-            else:
-                msgs = [response.reason]
-            for msg in msgs:
-                self.errors.append(DozupError(response.status_code, msg))
+        errors = errors_from_response(response)
+        self.errors.extend(errors)
+        self.record_outcome(
+            file_name, response.status_code, seconds, stream.bytes_read, join_messages(errors, response.reason))
         return False
+
+    def post_in_ranges(self, file_name, file_path, state_path):
+        """Upload a file in chunks, resuming an upload recorded in `state_path`.
+
+        The upload is started by posting with an Upload-Length header and
+        no body; the server replies with the upload’s URL in Location.
+        Chunks are then PUT to that URL, several at once, each with a
+        Content-Range header. Finally an empty POST to the upload’s URL
+        completes it, and its response is taken as for a single post.
+        If the server replies 404 or 410 the upload is forgotten, and the
+        next attempt starts again from scratch. A server that accepts the
+        first POST without giving a Location does not do ranged uploads,
+        so the task fails.
+
+        Returns --
+            whether the server accepted it.
+        """
+        state = UploadState(state_path, file_path, self.upload_chunk_size)
+        started = time.time()
+        try:
+            response, byte_count = self.upload_ranges(file_path, state)
+        except requests.RequestException as err:
+            seconds = time.time() - started
+            self.metrics.record_batch('error', seconds, 0)
+            self.record_outcome(file_name, 'error', seconds, None, str(err))
+            raise
+        seconds = time.time() - started
+        self.metrics.record_batch(response.status_code, seconds, byte_count)
+        if response.status_code in FORGOTTEN_CODES:
+            state.remove()
+        if state.upload_url is None and response.status_code in SUCCESSFUL_CODES:
+            # Taken as an empty post of the whole file.
+            errors = [DozupError(response.status_code, 'No Location for upload of %s' % file_name)]
+            self.errors.extend(errors)
+            self.record_outcome(file_name, response.status_code, seconds, byte_count, join_messages(errors, None))
+            return False
+        if response.status_code in SUCCESSFUL_CODES:
+            self.record_outcome(file_name, response.status_code, seconds, byte_count)
+            return True
+        errors = errors_from_response(response)
+        self.errors.extend(errors)
+        self.record_outcome(
+            file_name, response.status_code, seconds, byte_count, join_messages(errors, response.reason))
+        return False
+
+    def upload_ranges(self, file_path, state):
+        """Send the chunks not yet acknowledged and complete the upload.
+
+        Returns --
+            pair of the final (or first unsuccessful) response and the number of bytes of content sent.
+        """
+        if state.upload_url is None:
+            response = self.send(headers={'Upload-Length': str(state.file_size)})
+            if response.status_code not in SUCCESSFUL_CODES or 'Location' not in response.headers:
+                return response, 0
+            state.upload_url = urljoin(response.url, response.headers['Location'])
+            state.save()
+        chunk_size = self.upload_chunk_size
+        pending = collections.deque(
+            index for index in range((state.file_size + chunk_size - 1) // chunk_size)
+            if index not in state.acknowledged)
+        lock = threading.Lock()
+        failures = []
+        byte_counts = []
+
+        def upload_chunks():
+            try:
+                with open(file_path, 'rb') as strm:
+                    while True:
+                        with lock:
+                            if failures or not pending:
+                                return
+                            index = pending.popleft()
+                        strm.seek(index * chunk_size)
+                        data = strm.read(chunk_size)
+                        first = index * chunk_size
+                        response = self.send(
+                            'PUT', state.upload_url, data=data, headers={
+                                'Content-Range': 'bytes %d-%d/%d' % (first, first + len(data) - 1, state.file_size)})
+                        with lock:
+                            byte_counts.append(len(data))
+                            if response.status_code not in SUCCESSFUL_CODES + (requests.codes.no_content,):
+                                failures.append(response)
+                                return
+                            state.acknowledged.add(index)
+                            state.save()
+            except Exception as err:
+                with lock:
+                    failures.append(err)
+
+        threads = [
+            threading.Thread(target=upload_chunks, name='dozup-upload')
+            for i in range(min(self.upload_parallelism, len(pending)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if failures:
+            if isinstance(failures[0], Exception):
+                raise failures[0]
+            return failures[0], sum(byte_counts)
+        response = self.send(url=state.upload_url)
+        if response.status_code in SUCCESSFUL_CODES:
+            state.remove()
+        return response, sum(byte_counts)
+
+    def post_stream(self, stream):
+        if self.content_encoding:
+            return self.send(
+                data=encoded_body(stream, self.content_encoding),
+                headers={'Content-Encoding': self.content_encoding})
+        return self.send(data=request_body(stream))
+
+    def post_batch(self, tasks):
+        """Post several tasks in one multipart/form-data request.
+
+        Each task is sent as a part named ‘file’ with the task’s name as
+        its file name. The server is expected to reply with a JSON object
+        whose ‘results’ member has an object per part, in the same order,
+        each with a ‘status’ code and optional ‘error’ or ‘errors’ as for
+        a single post.
+
+        Returns --
+            list with True for each task the server accepted, else False.
+        """
+        files = [('file', (task.name, task.input)) for task in tasks]
+        sizes = [len(task.input.getvalue()) if hasattr(task.input, 'getvalue') else None for task in tasks]
+        byte_count = sum(size for size in sizes if size)
+        if self.hooks.active:
+            for task in tasks:
+                self.hooks.emit('post_start', task.name)
+        started = time.time()
+        try:
+            response = self.send(files=files)
+        except requests.RequestException as err:
+            seconds = time.time() - started
+            self.metrics.record_batch('error', seconds, byte_count)
+            for task, size in zip(tasks, sizes):
+                self.record_outcome(task.name, 'error', seconds, size, str(err))
+            raise
+        seconds = time.time() - started
+        self.metrics.record_batch(response.status_code, seconds, byte_count)
+        if response.status_code not in BATCH_CODES:
+            errors = errors_from_response(response)
+            self.errors.extend(errors)
+            for task, size in zip(tasks, sizes):
+                self.record_outcome(
+                    task.name, response.status_code, seconds, size, join_messages(errors, response.reason))
+            return [False] * len(tasks)
+        results = batch_results(response)
+        if results is None:
+            error = DozupError(response.status_code, 'Malformed batch response')
+            for task, size in zip(tasks, sizes):
+                self.errors.append(error)
+                self.record_outcome(task.name, response.status_code, seconds, size, error.message)
+            return [False] * len(tasks)
+        oks = []
+        for i, task in enumerate(tasks):
+            if i >= len(results):
+                errors = [DozupError(response.status_code, 'No result for %s' % task.name)]
+                status_code = response.status_code
+            elif not isinstance(results[i], dict):
+                errors = [DozupError(response.status_code, 'Malformed result for %s' % task.name)]
+                status_code = response.status_code
+            else:
+                status_code = results[i].get('status')
+                if status_code in SUCCESSFUL_CODES:
+                    self.record_outcome(task.name, status_code, seconds, sizes[i])
+                    oks.append(True)
+                    continue
+                reason = REASONS.get(status_code, 'Unknown')
+                errors = [DozupError(status_code, msg) for msg in error_messages(results[i], reason)]
+            self.errors.extend(errors)
+            self.record_outcome(task.name, status_code, seconds, sizes[i], join_messages(errors, 'Unknown'))
+            oks.append(False)
+        return oks
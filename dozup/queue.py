@@ -9,102 +9,1294 @@ Run with something like the following:
 """
 
 
+import collections
 import errno
+import hashlib
+import heapq
+import io
 import os
+import shutil
+import socket
+import struct
+import tarfile
+import tempfile
+import threading
+import time
 import zipfile
+import zlib
+
+try:
+    from os import scandir
+except ImportError:  # Python 2
+    from scandir import scandir
+
+try:
+    import lzma
+except ImportError:  # Python 2
+    lzma = None
+
+from .hooks import Hooks
+from .metrics import NULL_METRICS
+from .watch import PATH_ERRORS, create_watcher
+
+
+def ensure_dir(dir_path):
+    """Create a directory (and its parents) unless it already exists."""
+    try:
+        os.makedirs(dir_path)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+
+def move_into(source_path, dest_path):
+    """Rename a file, creating the destination directory if need be.
+
+    The directory is created afresh if it is removed (by compaction of
+    `done`, say) between creating it and moving the file in to it.
+    """
+    dest_dir = os.path.dirname(dest_path)
+    for attempt in range(3):
+        ensure_dir(dest_dir)
+        try:
+            os.rename(source_path, dest_path)
+            return
+        except OSError as err:
+            if err.errno != errno.ENOENT or not os.path.exists(source_path) or attempt == 2:
+                raise
+
+
+def local_host_id():
+    """Identify this host (or container) for the leases of its claims.
+
+    This is the host name, plus on Linux the PID namespace, since
+    containers sharing a host name may not see each other’s processes.
+    """
+    try:
+        return '%s/%s' % (socket.gethostname(), os.readlink('/proc/self/ns/pid'))
+    except (OSError, AttributeError):
+        return socket.gethostname()
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+def shard_of(file_path, shard_count):
+    """Which of `shard_count` shards a file belongs to, by a hash of its relative path.
+
+    The hash is the same in every process and on every host. (MD5 is
+    used for its even spread: a CRC gives similar names similar hashes.)
+    """
+    if not isinstance(file_path, bytes):
+        file_path = file_path.encode('UTF-8', PATH_ERRORS)
+    return int(hashlib.md5(file_path).hexdigest()[:8], 16) % shard_count
 
 
 class Task(object):
-    """One file to post to the server."""
+    """One file to post to the server.
+
+    Tasks for whole files have a `state_path` where progress on
+    uploading them in ranges may be kept.
+    """
     is_pushed_back = False
 
-    def __init__(self, name, input_stream):
+    def __init__(self, name, input_stream, claim=None, index=0, state_path=None):
         self.name = name
         self.input = input_stream
+        self.claim = claim
+        self.index = index
+        self.state_path = state_path
 
     def push_back(self):
         self.is_pushed_back = True
 
 
+class ZipMember(object):
+    """Input stream for a member of a ZIP archive.
+
+    As well as reading the uncompressed content, the compressed bytes
+    stored in the archive can be had with `iter_raw`, when the archive
+    was opened from `archive_path` (rather than a stream). The only seek
+    supported is back to the start.
+    """
+    # Offsets of the name and extra field lengths in a local file header.
+    name_length_index = 10
+    extra_length_index = 11
+
+    def __init__(self, archive, info, archive_path=None):
+        self.archive = archive
+        self.archive_path = archive_path
+        self.info = info
+        self.strm = archive.open(info)
+
+    def read(self, size=-1):
+        return self.strm.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if offset != 0 or whence != os.SEEK_SET:
+            raise IOError(errno.EINVAL, 'can only rewind a ZIP member')
+        self.strm.close()
+        self.strm = self.archive.open(self.info)
+        return 0
+
+    def close(self):
+        self.strm.close()
+
+    def iter_raw(self, chunk_size):
+        """Yield the member’s data as stored in the archive (for example, raw deflate)."""
+        with open(self.archive_path, 'rb') as strm:
+            strm.seek(self.info.header_offset)
+            header = struct.unpack(zipfile.structFileHeader, strm.read(zipfile.sizeFileHeader))
+            strm.seek(header[self.name_length_index] + header[self.extra_length_index], os.SEEK_CUR)
+            remaining = self.info.compress_size
+            while remaining > 0:
+                chunk = strm.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise IOError('%s: truncated member %s' % (self.archive_path, self.info.filename))
+                remaining -= len(chunk)
+                yield chunk
+
+
+class TarMember(object):
+    """Input stream for a member of a tar archive, read as the archive is streamed.
+
+    Members of up to `rewind_limit` bytes are read in to memory when
+    first read, so that they can be rewound (to be hashed and then
+    posted, say); larger ones are streamed, and can only be rewound
+    before they are read (`can_rewind` is False). The only seek supported
+    is back to the start.
+    """
+    rewind_limit = 8 * 1024 * 1024
+
+    def __init__(self, strm, info):
+        self.strm = strm
+        self.info = info
+        self.can_rewind = info.size <= self.rewind_limit
+        self.is_started = False
+
+    def read(self, size=-1):
+        if not self.is_started:
+            self.is_started = True
+            if self.can_rewind:
+                self.strm = io.BytesIO(self.strm.read())
+        return self.strm.read(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if offset != 0 or whence != os.SEEK_SET:
+            raise IOError(errno.EINVAL, 'can only rewind a tar member')
+        if self.is_started:
+            if not self.can_rewind:
+                raise IOError(errno.EINVAL, 'cannot rewind a tar member of %d bytes' % self.info.size)
+            self.strm.seek(0)
+        return 0
+
+    def close(self):
+        self.strm.close()
+
+
+class ZipReader(object):
+    """Reads the members of a ZIP archive, given its path or a seekable stream."""
+    suffixes = ('.zip',)
+    needs_random_access = True
+
+    def __init__(self, source):
+        self.archive = zipfile.ZipFile(source, 'r')
+        # The name of a stream (a spooled file, say) is not a path to reopen.
+        self.archive_path = None if hasattr(source, 'read') else source
+
+    def __iter__(self):
+        for info in self.archive.infolist():
+            yield info.filename, ZipMember(self.archive, info, self.archive_path)
+
+    def close(self):
+        self.archive.close()
+
+
+class TarReader(object):
+    """Streams the members of a tar archive, plain or compressed, given its path or a stream.
+
+    Only regular files are read. Compression with xz needs Python 3:
+    without it, files named as xz-compressed tar archives are posted whole.
+    """
+    suffixes = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2') + (('.tar.xz', '.txz') if lzma else ())
+    needs_random_access = False
+
+    def __init__(self, source):
+        if hasattr(source, 'read'):
+            self.archive = tarfile.open(fileobj=source, mode='r|*')
+        else:
+            self.archive = tarfile.open(source, mode='r|*')
+
+    def __iter__(self):
+        for info in self.archive:
+            if info.isfile():
+                yield info.name, TarMember(self.archive.extractfile(info), info)
+
+    def close(self):
+        self.archive.close()
+
+
+# Readers for the kinds of archive whose members are posted as tasks.
+# Each is a class constructed with the path of an archive (or a stream,
+# seekable if `needs_random_access`) that yields the name and input
+# stream of each member in turn, with a `close` method. Others may be added.
+ARCHIVE_READERS = [ZipReader, TarReader]
+
+# Errors from reading an archive that is corrupt or truncated.
+ARCHIVE_ERRORS = (tarfile.TarError, zipfile.BadZipfile, EOFError, zlib.error) + ((lzma.LZMAError,) if lzma else ())
+
+# Archives within archives that need random access are copied to a
+# temporary file, kept in memory up to this size.
+NESTED_ARCHIVE_SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def find_archive_reader(name):
+    """The reader for an archive with this name, or None if it is not one."""
+    name = name.lower()
+    for reader_class in ARCHIVE_READERS:
+        if name.endswith(reader_class.suffixes):
+            return reader_class
+    return None
+
+
+def iter_archive_members(reader_class, source, prefix=''):
+    """Yield the name and input stream of each member of an archive in turn.
+
+    Archives within the archive are expanded in their place, their
+    members named as if the archive were a directory. Each input stream
+    is closed when the next member is requested.
+    """
+    reader = reader_class(source)
+    try:
+        for name, member in reader:
+            try:
+                nested_class = find_archive_reader(name)
+                if nested_class is None:
+                    yield prefix + name, member
+                    continue
+                if not nested_class.needs_random_access:
+                    for item in iter_archive_members(nested_class, member, prefix + name + '/'):
+                        yield item
+                    continue
+                with tempfile.SpooledTemporaryFile(NESTED_ARCHIVE_SPOOL_SIZE) as spool:
+                    shutil.copyfileobj(member, spool)
+                    spool.seek(0)
+                    for item in iter_archive_members(nested_class, spool, prefix + name + '/'):
+                        yield item
+            finally:
+                member.close()
+    finally:
+        reader.close()
+
+
+class MemberCheckpoint(object):
+    """Bitmap of the members of a claimed archive that have been posted.
+
+    Bit N is set once member N has been accepted, so when an archive that
+    was pushed back is claimed again its finished members can be skipped.
+    Each update rewrites a single byte of the file.
+
+    The file starts with the size and modification time of the archive,
+    which survive being renamed between directories, so that a different
+    archive that happens to reuse the name does not inherit the progress.
+    """
+    header_struct = struct.Struct('>QQ')
+
+    def __init__(self, path, archive_path):
+        self.path = path
+        archive_stat = os.stat(archive_path)
+        self.header = self.header_struct.pack(archive_stat.st_size, int(archive_stat.st_mtime))
+        self.bits = bytearray()
+        self.strm = None
+        try:
+            with open(path, 'rb') as strm:
+                data = strm.read()
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                raise
+        else:
+            if data[:self.header_struct.size] == self.header:
+                self.bits = bytearray(data[self.header_struct.size:])
+
+    def is_done(self, index):
+        byte_index = index >> 3
+        return byte_index < len(self.bits) and bool(self.bits[byte_index] & (1 << (index & 7)))
+
+    def mark_done(self, index):
+        byte_index = index >> 3
+        if byte_index >= len(self.bits):
+            self.bits.extend(bytearray(byte_index + 1 - len(self.bits)))
+        self.bits[byte_index] |= 1 << (index & 7)
+        if self.strm is None:
+            self.strm = open(self.path, 'wb')
+            self.strm.write(self.header + bytes(self.bits))
+        else:
+            self.strm.seek(self.header_struct.size + byte_index)
+            self.strm.write(bytes(self.bits[byte_index:byte_index + 1]))
+        self.strm.flush()
+
+    def close(self):
+        if self.strm is not None:
+            self.strm.close()
+            self.strm = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+
+class TodoIndex(object):
+    """Cursor over the files waiting in a `todo` directory.
+
+    Directories are listed one at a time with `scandir` and only when the
+    files already found have all been handed out, so claiming a file costs
+    amortised O(1) directory operations rather than a walk of the whole tree.
+    Once a pass over the tree is exhausted the next request starts a new one,
+    which is how files added behind the cursor are found.
+
+    Entries may be stale (another process may have claimed the file since it
+    was listed); callers discard them when the rename fails.
+
+    When the tree is being watched for new files, they are added as they
+    arrive and a new pass is made only after `invalidate` is called.
+
+    With `shard` set to a pair (index, count), files are offered only if
+    they belong to that shard (see `shard_of`), so that instances draining
+    the same directory do not all race for the same file. Once a pass finds
+    nothing left in the shard, files from other shards are stolen, starting
+    from the end of the pass so as to keep clear of their owners.
+
+    If `observer` is set, it is called with a list of pairs (relative
+    path, `scandir` entry or None) for the files found in each directory
+    listed and each lot of arrivals added.
+    """
+    is_ordered = False
+    observer = None
+
+    def __init__(self, todo_dir, shard=None):
+        self.todo_dir = todo_dir
+        self.shard = shard
+        self.pending = collections.deque()
+        self.stealable = collections.deque()
+        self.unscanned_dirs = []
+        self.is_watched = False
+        self.needs_pass = True
+
+    def in_shard(self, file_path):
+        return self.shard is None or shard_of(file_path, self.shard[1]) == self.shard[0]
+
+    def peek(self):
+        """Return the relative path of the next file, or None if there are none."""
+        if not self.pending and (self.unscanned_dirs or not self.stealable):
+            self.refill()
+        if self.pending:
+            return self.pending[0]
+        if self.stealable:
+            return self.stealable[-1]
+
+    def discard(self, file_path):
+        """Forget the file at the head of the index (claimed or vanished)."""
+        if self.pending and self.pending[0] == file_path:
+            self.pending.popleft()
+        elif self.stealable and self.stealable[-1] == file_path:
+            self.stealable.pop()
+
+    def add(self, file_paths):
+        """Note files that have arrived since the index was filled."""
+        for file_path in file_paths:
+            self.append(file_path)
+        if self.observer and file_paths:
+            self.observer([(file_path, None) for file_path in file_paths])
+
+    def append(self, file_path, entry=None):
+        if self.in_shard(file_path):
+            self.pending.append(file_path)
+        else:
+            self.stealable.append(file_path)
+
+    def reset(self, file_paths):
+        """Replace the contents of the index with this complete list."""
+        self.clear()
+        self.add(file_paths)
+        self.needs_pass = False
+
+    def invalidate(self):
+        """Drop everything so the next request starts with a fresh pass."""
+        self.clear()
+        self.needs_pass = True
+
+    def clear(self):
+        self.pending.clear()
+        self.stealable.clear()
+        del self.unscanned_dirs[:]
+
+    def refill(self):
+        is_new_pass = False
+        while not self.pending:
+            if not self.unscanned_dirs:
+                if is_new_pass or self.stealable or (self.is_watched and not self.needs_pass):
+                    # Steal what there is before starting another pass.
+                    break
+                # Start a new pass; a pass that finds nothing means empty.
+                self.unscanned_dirs.append('')
+                is_new_pass = True
+                self.needs_pass = False
+            self.scan_dir(self.unscanned_dirs.pop())
+
+    def scan_dir(self, rel_dir):
+        try:
+            entries = sorted(scandir(os.path.join(self.todo_dir, rel_dir)), key=lambda e: e.name)
+        except OSError as err:
+            if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                # Vanished since its parent was listed.
+                return
+            raise
+        subdirs = []
+        found = []
+        for entry in entries:
+            rel_path = os.path.join(rel_dir, entry.name)
+            if entry.is_dir():
+                subdirs.append(rel_path)
+            else:
+                self.append(rel_path, entry)
+                found.append((rel_path, entry))
+        if self.observer and found:
+            self.observer(found)
+        # Stack, so reverse to visit subdirectories in name order.
+        self.unscanned_dirs.extend(reversed(subdirs))
+
+
+class OrderedTodoIndex(TodoIndex):
+    """Index of `todo` handing out files by lane and then oldest first.
+
+    `lanes` is a list of names of top-level subdirectories of `todo`,
+    most urgent first; files elsewhere come after all of them. Within a
+    lane, files are ordered by modification time (which survives being
+    renamed in to `todo`), then by name.
+
+    Ordering needs the whole tree, so files are kept in a heap filled by
+    a pass over the tree, and new arrivals are pushed on to it as they
+    are seen. Without a watcher to report arrivals, a new pass is made
+    when the heap is exhausted or, so that urgent files are not stuck
+    behind a long backlog, once `rescan_interval` seconds have passed.
+    """
+    is_ordered = True
+
+    def __init__(self, todo_dir, lanes, shard=None, rescan_interval=5.0):
+        super(OrderedTodoIndex, self).__init__(todo_dir, shard)
+        self.lane_ranks = dict((name, rank) for rank, name in enumerate(lanes))
+        self.pending = []
+        self.stealable = []
+        self.rescan_interval = rescan_interval
+        self.scanned_at = None
+
+    def lane_of(self, file_path):
+        parts = file_path.split(os.sep, 1)
+        if len(parts) > 1:
+            return self.lane_ranks.get(parts[0], len(self.lane_ranks))
+        return len(self.lane_ranks)
+
+    def peek(self):
+        if self.needs_pass or not self.is_watched and (
+                not (self.pending or self.stealable)
+                or time.time() - self.scanned_at >= self.rescan_interval):
+            self.scan_tree()
+        if self.pending:
+            return self.pending[0][-1]
+        if self.stealable:
+            return self.stealable[0][-1]
+
+    def discard(self, file_path):
+        if self.pending and self.pending[0][-1] == file_path:
+            heapq.heappop(self.pending)
+        elif self.stealable and self.stealable[0][-1] == file_path:
+            heapq.heappop(self.stealable)
+
+    def append(self, file_path, entry=None):
+        try:
+            if entry is None:
+                mtime = os.stat(os.path.join(self.todo_dir, file_path)).st_mtime
+            else:
+                mtime = entry.stat().st_mtime
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                # Claimed by someone else already.
+                return
+            raise
+        item = (self.lane_of(file_path), mtime, file_path)
+        heapq.heappush(self.pending if self.in_shard(file_path) else self.stealable, item)
+
+    def clear(self):
+        del self.pending[:]
+        del self.stealable[:]
+        del self.unscanned_dirs[:]
+
+    def scan_tree(self):
+        self.clear()
+        self.unscanned_dirs.append('')
+        while self.unscanned_dirs:
+            self.scan_dir(self.unscanned_dirs.pop())
+        self.scanned_at = time.time()
+        self.needs_pass = False
+
+
+class RetryIndex(object):
+    """Files parked in the `retry` directory, soonest due first.
+
+    Each parked file has a sidecar recording how many attempts have been
+    made and when it is next due. The directory is rescanned, so as to see
+    files parked by other processes, when nothing is due and at least
+    `rescan_interval` seconds have passed since the last scan.
+    """
+    rescan_interval = 60.0
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.heap = []
+        self.scanned_at = None
+
+    def add(self, file_path, due):
+        heapq.heappush(self.heap, (due, file_path))
+
+    def pop_due(self, now):
+        """Return the relative path of a file that is due, or None."""
+        if not self.heap or self.heap[0][0] > now:
+            if self.scanned_at is None or now - self.scanned_at >= self.rescan_interval:
+                self.rescan(now)
+        if self.heap and self.heap[0][0] <= now:
+            return heapq.heappop(self.heap)[1]
+
+    def time_until_due(self, now):
+        """Seconds until the next file is due, or None if none are parked."""
+        if self.scanned_at is None:
+            self.rescan(now)
+        if self.heap:
+            return max(0.0, self.heap[0][0] - now)
+
+    def rescan(self, now):
+        heap = []
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            try:
+                entries = list(scandir(os.path.join(self.queue.retry_dir, rel_dir)))
+            except OSError as err:
+                if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name)
+                if entry.is_dir():
+                    stack.append(rel_path)
+                elif not entry.name.startswith('.'):
+                    attempts, due = self.queue.read_retry_sidecar(rel_path)
+                    heap.append((due, rel_path))
+        heapq.heapify(heap)
+        self.heap = heap
+        self.scanned_at = now
+
+
 class DozupQueue(object):
     """A queue backed by a directory structure.
 
     The contents of todo are:
     - files representing tasks
-    - zip archives containing task files
+    - archives (ZIP or tar, perhaps compressed) containing task files,
+      or further archives
     - subdirectories containing task files or zip archives.
 
     A task file or zip archive is ‘claimed’ by moving it to
     the `doing` directory. Once processed, it goes to the
     `done` directory, preserving subdirectory structure.
 
+    If `retry_delay` is set, files with tasks pushed back are parked
+    in the `retry` directory rather than returned to `todo`, and are
+    not claimed again until the delay has passed. The delay doubles
+    with each attempt, up to `max_retry_delay`. Meanwhile other files
+    continue to be processed.
+
+    Pass a `dozup.metrics.Metrics` instance as `metrics` to have
+    claiming timed and counted.
+
+    When several processes (perhaps on several hosts) share the
+    directory, give each a different `shard`, a pair (index, count)
+    with 0 <= index < count, so that each prefers its own share of
+    the files and takes from the others’ only when it runs out.
+
+    Files are claimed in name order, a directory at a time. Pass a list
+    of top-level subdirectories of `todo` as `lanes` to claim instead
+    from the first of them with any files, oldest first (see
+    `OrderedTodoIndex`); an empty list means oldest first throughout.
+
+    Each claimed file has a lease, a sidecar naming the process that
+    claimed it, renewed every third of `lease_timeout` seconds while the
+    file is being worked on. Use `recover_claims` to return files whose
+    owners have gone away to `todo`.
+
+    Pass a `dozup.stats.BacklogStats` instance as `stats` to have the
+    files waiting, in flight and done counted as they come and go.
+
+    Callbacks registered with `hooks` (a `dozup.hooks.Hooks`, shared
+    with posters) are told as files are claimed, their tasks opened, and
+    the files filed away.
+
     """
-    def __init__(self, dir_path):
+    push_back_pause = 10.0
+
+    def __init__(
+            self, dir_path, poll_interval=5.0, retry_delay=None, max_retry_delay=3600.0, metrics=None,
+            shard=None, lanes=None, lease_timeout=300.0, stats=None, hooks=None):
         self.dir_path = dir_path
+        self.metrics = metrics or NULL_METRICS
+        self.hooks = hooks if hooks is not None else Hooks()
+        self.stats = stats
         self.todo_dir = os.path.join(dir_path, 'todo')
         self.doing_dir = os.path.join(dir_path, 'doing')
         self.done_dir = os.path.join(dir_path, 'done')
+        self.retry_dir = os.path.join(dir_path, 'retry')
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.retry_index = RetryIndex(self) if retry_delay is not None else None
+        if lanes is None:
+            self.todo_index = TodoIndex(self.todo_dir, shard)
+        else:
+            self.todo_index = OrderedTodoIndex(self.todo_dir, lanes, shard, poll_interval)
+        self.found_pending = []
+        if stats is not None:
+            self.todo_index.observer = self.note_pending
+        self.index_lock = threading.Lock()
+        self.poll_interval = poll_interval
+        self.watcher = None
+        self.watch_lock = threading.Lock()
+        self.lease_timeout = lease_timeout
+        self.leases = set()
+        self.heartbeat_stop = None
+        self.recovered_at = None
+
+    def note_pending(self, found):
+        """Keep files found in `todo` to be counted as pending (see `TodoIndex.observer`).
+
+        This is called with `index_lock` held, so they are counted
+        later, by `count_pending`.
+        """
+        self.found_pending.extend(found)
+
+    def count_pending(self):
+        """Count the files kept by `note_pending` as pending."""
+        with self.index_lock:
+            found, self.found_pending = self.found_pending, []
+        if not found:
+            return
+        files = []
+        for file_path, entry in found:
+            try:
+                file_stat = entry.stat() if entry else os.stat(os.path.join(self.todo_dir, file_path))
+            except OSError as err:
+                if err.errno == errno.ENOENT:
+                    # Claimed by someone else already.
+                    continue
+                raise
+            files.append((file_path, file_stat.st_size, file_stat.st_mtime))
+        self.stats.add_pending(files, self.todo_dir)
 
     def find_file(self):
         """Return a file from the TODO directory.
 
         This will not necessarily correspond to a single task.
         """
-        for dir_path, subdirs, files in os.walk(self.todo_dir):
-            if files:
-                file_path = os.path.join(dir_path, files[0])
-                return os.path.relpath(file_path, self.todo_dir)
+        return self.todo_index.peek()
+
+    def start_watching(self):
+        """Arrange to be told of files arriving in `todo`.
+
+        Uses inotify if available, otherwise polls every `poll_interval` seconds.
+        """
+        ensure_dir(self.todo_dir)
+        self.watcher = create_watcher(self.todo_dir, self.poll_interval)
+        file_paths = self.watcher.add_tree('')
+        if file_paths is not None:
+            with self.index_lock:
+                self.todo_index.is_watched = True
+                self.todo_index.reset(file_paths)
+
+    def ensure_watching(self):
+        with self.watch_lock:
+            if self.watcher is None:
+                self.start_watching()
+
+    def wait_for_files(self, timeout=None):
+        """Block until files may have arrived in `todo` (or until the timeout).
+
+        Claims that have expired meanwhile are recovered first.
+        """
+        if self.recovered_at is None or time.time() - self.recovered_at >= self.lease_timeout:
+            self.recover_claims()
+        with self.watch_lock:
+            if self.watcher is None:
+                self.start_watching()
+            with self.index_lock:
+                if self.todo_index.peek():
+                    # Another thread was woken while we waited for the lock.
+                    return
+            file_paths = self.watcher.wait(timeout)
+            with self.index_lock:
+                if file_paths is None:
+                    self.todo_index.invalidate()
+                else:
+                    self.todo_index.add(file_paths)
+
+    def collect_arrivals(self):
+        """Add files that have arrived to the index without waiting.
+
+        Done before each claim when the order matters, so that new
+        urgent files need not wait for the backlog to clear.
+        """
+        if not self.watch_lock.acquire(False):
+            # Another thread is collecting them.
+            return
+        try:
+            file_paths = self.watcher.wait(0)
+            with self.index_lock:
+                if file_paths is None:
+                    self.todo_index.invalidate()
+                else:
+                    self.todo_index.add(file_paths)
+        finally:
+            self.watch_lock.release()
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+        if self.heartbeat_stop is not None:
+            self.heartbeat_stop.set()
+            self.heartbeat_stop = None
+
+    def take_lease(self, file_path):
+        """Record that this process has claimed the file, and keep the record fresh."""
+        with open(self.sidecar_path(file_path, 'lease'), 'w') as strm:
+            strm.write('%s %d\n' % (local_host_id(), os.getpid()))
+        with self.index_lock:
+            self.leases.add(file_path)
+            if self.heartbeat_stop is None:
+                # Started once, and idle while there are no leases, until `close`.
+                self.heartbeat_stop = self.start_heartbeat()
+
+    def drop_lease(self, file_path):
+        with self.index_lock:
+            self.leases.discard(file_path)
+        try:
+            os.remove(self.sidecar_path(file_path, 'lease'))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def renew_leases(self):
+        """Touch the lease of each file this process is working on."""
+        with self.index_lock:
+            file_paths = list(self.leases)
+        for file_path in file_paths:
+            try:
+                os.utime(self.sidecar_path(file_path, 'lease'), None)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+
+    def start_heartbeat(self):
+        """Renew leases from a background thread until the returned event is set."""
+        stop = threading.Event()
+
+        def renew_periodically():
+            while not stop.wait(self.lease_timeout / 3.0):
+                self.renew_leases()
+
+        thread = threading.Thread(target=renew_periodically, name='dozup-heartbeat')
+        thread.daemon = True
+        thread.start()
+        return stop
+
+    def recover_claims(self):
+        """Return files in `doing` whose claims have expired to `todo`.
+
+        A claim has expired if its lease has not been renewed for
+        `lease_timeout` seconds, or if it was taken by a process on this
+        host that has since exited. This is safe to run alongside live
+        workers: their leases are fresh, and if two processes try to
+        recover the same file only one rename succeeds.
+
+        Returns --
+            list of the files returned, relative to `todo`.
+        """
+        now = time.time()
+        host_id = local_host_id()
+        recovered = []
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            try:
+                entries = list(scandir(os.path.join(self.doing_dir, rel_dir)))
+            except OSError as err:
+                if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name)
+                if entry.is_dir():
+                    stack.append(rel_path)
+                elif not entry.name.startswith('.') and self.has_expired(rel_path, entry, now, host_id):
+                    try:
+                        entry_stat = entry.stat()
+                        ensure_dir(os.path.join(self.todo_dir, rel_dir))
+                        os.rename(os.path.join(self.doing_dir, rel_path), os.path.join(self.todo_dir, rel_path))
+                    except OSError as err:
+                        if err.errno != errno.ENOENT:
+                            raise
+                        # Finished or recovered by someone else meanwhile.
+                        continue
+                    self.drop_lease(rel_path)
+                    if self.stats is not None:
+                        self.stats.returned(rel_path, entry_stat.st_size, entry_stat.st_mtime)
+                    recovered.append(rel_path)
+        self.recovered_at = now
+        self.metrics.increment('recovered', len(recovered))
+        return recovered
+
+    def has_expired(self, file_path, entry, now, host_id):
+        with self.index_lock:
+            if file_path in self.leases:
+                return False
+        lease_path = self.sidecar_path(file_path, 'lease')
+        try:
+            lease_mtime = os.stat(lease_path).st_mtime
+            with open(lease_path, 'r') as strm:
+                owner = strm.read().split()
+        except (IOError, OSError) as err:
+            if err.errno != errno.ENOENT:
+                raise
+            # Not yet written, or claimed by a version of dozup without
+            # leases; renaming the file in to `doing` updated its ctime.
+            try:
+                return now - entry.stat().st_ctime >= self.lease_timeout
+            except OSError:
+                return False
+        if now - lease_mtime >= self.lease_timeout:
+            return True
+        if len(owner) == 2 and owner[0] == host_id:
+            return not is_process_alive(int(owner[1]))
+        # Someone else’s, or only partly written.
+        return False
+
+    def sidecar_path(self, file_path, kind, root_dir=None):
+        """Where to keep bookkeeping of this kind for a claimed file.
+
+        Sidecars are dot-files next to the file’s place in `doing`
+        (or `root_dir`), and stay there when the file is pushed back
+        so it can be resumed.
+        """
+        dir_path, name = os.path.split(file_path)
+        return os.path.join(root_dir or self.doing_dir, dir_path, '.%s.%s' % (name, kind))
+
+    def read_retry_sidecar(self, file_path):
+        """Return the number of attempts so far and when the file is next due."""
+        try:
+            with open(self.sidecar_path(file_path, 'retry', self.retry_dir), 'r') as strm:
+                attempts, due = strm.read().split()
+            return int(attempts), float(due)
+        except (IOError, ValueError):
+            return 0, 0.0
+
+    def park(self, file_path):
+        """Move a claimed file to `retry`, due after a delay that grows with each attempt."""
+        attempts, _ = self.read_retry_sidecar(file_path)
+        attempts += 1
+        delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+        due = time.time() + delay
+        ensure_dir(os.path.join(self.retry_dir, os.path.dirname(file_path)))
+        with open(self.sidecar_path(file_path, 'retry', self.retry_dir), 'w') as strm:
+            strm.write('%d %f\n' % (attempts, due))
+        os.rename(os.path.join(self.doing_dir, file_path), os.path.join(self.retry_dir, file_path))
+        with self.index_lock:
+            self.retry_index.add(file_path, due)
+
+    def forget_retries(self, file_path):
+        """Remove the record of failed attempts for a file that is done."""
+        try:
+            os.remove(self.sidecar_path(file_path, 'retry', self.retry_dir))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def time_until_retry(self):
+        """Seconds until a parked file is due, or None if there are none."""
+        if self.retry_index is None:
+            return None
+        with self.index_lock:
+            return self.retry_index.time_until_due(time.time())
 
     def claim_file(self):
         """Transfer a file from `todo` to `doing`.
 
         The idea is to claim the file for processing by this process, in a way
-        that is safe from concurrent scripts operating on the same dir.
+        that is safe from concurrent scripts operating on the same dir,
+        and from threads sharing this queue.
 
         Returns --
             file path relative to the `doing` directory.
         """
-        while True:
-            file_path = self.find_file()
-            if not file_path:
+        file_paths = self.claim_batch(1)
+        return file_paths[0] if file_paths else None
+
+    def claim_batch(self, max_count):
+        """Transfer up to `max_count` files from `todo` to `doing` in one go.
+
+        The files are taken from the index under one acquisition of its
+        lock, and each directory in `doing` is created only once, so
+        claiming many small files this way costs less than claiming them
+        one by one. The files are leased as soon as they are claimed.
+
+        Returns --
+            list of file paths relative to the `doing` directory (empty if there are none).
+        """
+        file_paths = []
+        made_dirs = set()
+        while len(file_paths) < max_count:
+            if self.watcher is not None and self.todo_index.is_watched and self.todo_index.is_ordered:
+                self.collect_arrivals()
+            candidates = []
+            with self.index_lock, self.metrics.timer('scan'):
+                while len(file_paths) + len(candidates) < max_count:
+                    source_dir = self.retry_dir
+                    file_path = self.retry_index and self.retry_index.pop_due(time.time())
+                    if not file_path:
+                        source_dir = self.todo_dir
+                        file_path = self.find_file()
+                        if not file_path:
+                            break
+                        self.todo_index.discard(file_path)
+                    candidates.append((source_dir, file_path))
+            if not candidates:
                 break
-            os.makedirs(os.path.join(self.doing_dir, os.path.dirname(file_path)))
-            try:
-                # The following is an atomic operation.
-                os.rename(os.path.join(self.todo_dir, file_path), os.path.join(self.doing_dir, file_path))
-                return file_path
-            except OSError as err:
-                if err.errno in (errno.ENOENT, ):
-                    # Another process has snatched this file away from us.
-                    pass
-                else:
+            for source_dir, file_path in candidates:
+                dir_path = os.path.dirname(file_path)
+                try:
+                    with self.metrics.timer('claim'):
+                        if dir_path not in made_dirs:
+                            ensure_dir(os.path.join(self.doing_dir, dir_path))
+                            made_dirs.add(dir_path)
+                        # The following is an atomic operation.
+                        os.rename(os.path.join(source_dir, file_path), os.path.join(self.doing_dir, file_path))
+                except OSError as err:
+                    if err.errno in (errno.ENOENT, ):
+                        # Another process has snatched this file away from us.
+                        # Only this entry is stale; carry on from the cursor.
+                        continue
                     raise
+                self.take_lease(file_path)
+                self.metrics.increment('claimed')
+                if self.hooks.active:
+                    self.hooks.emit('claimed', file_path)
+                if source_dir == self.todo_dir and not self.todo_index.in_shard(file_path):
+                    self.metrics.increment('stolen')
+                file_paths.append(file_path)
+        if self.stats is not None:
+            self.count_pending()
+            if file_paths:
+                self.stats.claimed(file_paths)
+        return file_paths
 
-    def iter_tasks(self):
+    def release_files(self, file_paths):
+        """Return claimed files that were not worked on to `todo`."""
+        for file_path in file_paths:
+            Claim(self, file_path).release()
+
+    def iter_tasks(self, watch=False, claim_count=1):
+        """Yield tasks from claimed files until the queue is empty.
+
+        A task’s file is filed away when the next task is requested,
+        so the task must be pushed back (or not) before then. Iteration
+        stops after a task is pushed back.
+
+        With `watch`, iteration instead continues indefinitely, waiting
+        for new files when the queue is empty and pausing for
+        `push_back_pause` seconds after a task is pushed back.
+
+        With retries (see `retry_delay`), pushed-back files are parked
+        and iteration continues with the next file.
+
+        Files are claimed `claim_count` at a time (see `claim_batch`) and
+        worked through in turn; those not yet started when iteration
+        stops are returned to `todo`. If iteration is abandoned, the
+        current file is returned to `todo` as well.
+        """
+        if watch:
+            self.ensure_watching()
+        batch = collections.deque()
+        try:
+            while True:
+                if not batch:
+                    batch.extend(self.claim_batch(claim_count))
+                if not batch:
+                    if watch:
+                        self.wait_for_files(self.time_until_retry())
+                        continue
+                    break
+                claim = Claim(self, batch.popleft())
+                tasks = claim.iter_tasks()
+                for task in tasks:
+                    try:
+                        yield task
+                    except GeneratorExit:
+                        tasks.close()
+                        claim.release()
+                        raise
+                    claim.settle(task)
+                    if claim.is_pushed_back:
+                        tasks.close()
+                        break
+                claim.finish()
+                if claim.is_pushed_back and self.retry_index is None:
+                    if not watch:
+                        break
+                    time.sleep(self.push_back_pause)
+        finally:
+            self.release_files(batch)
+
+    def iter_batches(self, max_count=100, max_bytes=1024 * 1024, watch=False):
+        """Yield lists of up to `max_count` tasks or about `max_bytes` of content.
+
+        The content of each task is read in to memory so that a batch can
+        span several files. As with `iter_tasks`, tasks must be pushed
+        back (or not) before the next batch is requested; files are filed
+        away once all their tasks have been through a batch. Iteration
+        stops after a batch with a task pushed back, unless retries are
+        enabled.
+
+        With `watch`, iteration continues as for `iter_tasks`; a partial
+        batch is yielded before waiting for new files.
+        """
+        if watch:
+            self.ensure_watching()
+        batch = []
+        batch_size = 0
+        claims = []
         while True:
             file_path = self.claim_file()
-            if not file_path:
-                break
-            is_pushed_back = False
-            if file_path.endswith('.zip'):
-                archive = zipfile.ZipFile(os.path.join(self.doing_dir, file_path), 'r')
-                for info in archive.infolist():
-                    task = Task(file_path + '/' + info.filename, archive.open(info))
-                    yield task
-                    if task.is_pushed_back:
-                        is_pushed_back = True
-                        break
-                archive.close()
+            if not file_path and batch:
+                # Send what there is rather than hold it while waiting.
+                try:
+                    yield batch
+                except GeneratorExit:
+                    self.release_claims(claims)
+                    raise
+                is_pushed_back = self.settle_batch(batch, claims)
+                batch = []
+                batch_size = 0
+                claims = []
+            elif not file_path:
+                for claim in claims:
+                    claim.finish()
+                claims = []
+                if not watch:
+                    break
+                self.wait_for_files(self.time_until_retry())
+                continue
             else:
-                strm = open(os.path.join(self.doing_dir, file_path), 'rb')
-                task = Task(file_path, strm)
-                yield task
-                strm.close()
-                if task.is_pushed_back:
+                is_pushed_back = False
+                claim = Claim(self, file_path)
+                claims.append(claim)
+                tasks = claim.iter_tasks()
+                for task in tasks:
+                    if is_pushed_back:
+                        # Leave this and later members to be resumed.
+                        claim.is_pushed_back = True
+                        tasks.close()
+                        break
+                    task.input = io.BytesIO(task.input.read())
+                    batch.append(task)
+                    batch_size += len(task.input.getvalue())
+                    if len(batch) >= max_count or batch_size >= max_bytes:
+                        try:
+                            yield batch
+                        except GeneratorExit:
+                            tasks.close()
+                            self.release_claims(claims)
+                            raise
+                        # Only the current claim may have tasks still to come.
+                        is_pushed_back = self.settle_batch(batch, claims[:-1])
+                        batch = []
+                        batch_size = 0
+                        claims = claims[-1:]
+                if is_pushed_back:
+                    claim.finish()
+                    claims = []
+                elif claim.is_pushed_back:
+                    # The archive could not be read. Send what there is
+                    # and stop as if one of its tasks were pushed back.
+                    if batch:
+                        try:
+                            yield batch
+                        except GeneratorExit:
+                            self.release_claims(claims)
+                            raise
+                        self.settle_batch(batch, claims)
+                        batch = []
+                        batch_size = 0
+                    else:
+                        claim.finish()
+                    claims = []
                     is_pushed_back = True
-            if is_pushed_back:
-                os.rename(os.path.join(self.doing_dir, file_path), os.path.join(self.todo_dir, file_path))
-                break
+                elif not batch or batch[-1].claim is not claim:
+                    # Its tasks were all in batches already settled, so
+                    # file it now rather than return it if abandoned.
+                    claim.finish()
+                    claims.pop()
+            if is_pushed_back and self.retry_index is None:
+                if not watch:
+                    break
+                time.sleep(self.push_back_pause)
+
+    def settle_batch(self, batch, finished_claims):
+        """Record the outcome of each task and file away claims with none outstanding.
+
+        Returns --
+            whether any task was pushed back.
+        """
+        is_pushed_back = False
+        for task in batch:
+            task.claim.settle(task)
+            is_pushed_back = is_pushed_back or task.is_pushed_back
+        for claim in finished_claims:
+            claim.finish()
+        return is_pushed_back
+
+    def release_claims(self, claims):
+        for claim in claims:
+            claim.release()
+
+
+class Claim(object):
+    """A file claimed from `todo`, and what has become of its tasks."""
+    def __init__(self, queue, file_path):
+        self.queue = queue
+        self.file_path = file_path
+        self.path = os.path.join(queue.doing_dir, file_path)
+        self.checkpoint = None
+        self.is_pushed_back = False
+        self.task_count = 0
+
+    def iter_tasks(self):
+        """Yield a task for the file, or for each unfinished member of an archive.
+
+        Archives are those with a reader in `ARCHIVE_READERS`; archives
+        within them are expanded too, their members numbered in one
+        sequence for the checkpoint. A task’s input is closed when the next task is requested.
+
+        If an archive cannot be read, the claim is marked as pushed back
+        (and counted in the `unreadable` metric), and no more tasks are yielded.
+        """
+        hooks = self.queue.hooks
+        reader_class = find_archive_reader(self.file_path)
+        if reader_class is None:
+            with open(self.path, 'rb') as strm:
+                if hooks.active:
+                    hooks.emit('opened', self.file_path, file_path=self.file_path)
+                yield Task(self.file_path, strm, self, state_path=self.queue.sidecar_path(self.file_path, 'upload'))
+            return
+        self.checkpoint = MemberCheckpoint(self.queue.sidecar_path(self.file_path, 'progress'), self.path)
+        members = iter_archive_members(reader_class, self.path, self.file_path + '/')
+        try:
+            for index, (name, member) in enumerate(members):
+                if not self.checkpoint.is_done(index):
+                    if hooks.active:
+                        hooks.emit('opened', name, file_path=self.file_path)
+                    yield Task(name, member, self, index)
+        except ARCHIVE_ERRORS:
+            self.queue.metrics.increment('unreadable')
+            self.is_pushed_back = True
+        finally:
+            members.close()
+
+    def settle(self, task):
+        """Note whether this task, handed out by `iter_tasks`, was pushed back."""
+        if task.is_pushed_back:
+            self.is_pushed_back = True
+            return
+        self.task_count += 1
+        if self.checkpoint is not None:
+            self.checkpoint.mark_done(task.index)
+
+    def finish(self):
+        """Move the file to `done`, or back to `todo` if any task was pushed back.
+
+        With retries enabled, pushed-back files are parked in `retry` instead.
+        """
+        queue = self.queue
+        file_stat = self.stat() if queue.stats is not None else None
+        try:
+            if self.is_pushed_back:
+                queue.metrics.increment('pushed_back')
+                if self.checkpoint is not None:
+                    self.checkpoint.close()
+                if queue.retry_index is not None:
+                    queue.park(self.file_path)
+                else:
+                    os.rename(self.path, os.path.join(queue.todo_dir, self.file_path))
             else:
-                os.makedirs(os.path.join(self.done_dir, os.path.dirname(file_path)))
-                os.rename(os.path.join(self.doing_dir, file_path), os.path.join(self.done_dir, file_path))
+                if self.checkpoint is not None:
+                    self.checkpoint.remove()
+                if queue.retry_index is not None:
+                    queue.forget_retries(self.file_path)
+                move_into(self.path, os.path.join(queue.done_dir, self.file_path))
+        except OSError as err:
+            self.check_lease_lost(err)
+        else:
+            if queue.stats is not None and not self.is_pushed_back:
+                queue.stats.finished(self.task_count)
+            elif file_stat is not None:
+                queue.stats.returned(
+                    self.file_path, file_stat.st_size, file_stat.st_mtime, self.task_count, is_pushed_back=True)
+            if queue.hooks.active:
+                event = 'pushed_back' if self.is_pushed_back else 'done'
+                queue.hooks.emit(event, self.file_path, tasks=self.task_count)
+        queue.drop_lease(self.file_path)
+
+    def release(self):
+        """Return the file to `todo` unprocessed (without counting an attempt)."""
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+        file_stat = self.stat() if self.queue.stats is not None else None
+        try:
+            os.rename(self.path, os.path.join(self.queue.todo_dir, self.file_path))
+        except OSError as err:
+            self.check_lease_lost(err)
+        else:
+            if file_stat is not None:
+                self.queue.stats.returned(self.file_path, file_stat.st_size, file_stat.st_mtime, self.task_count)
+            if self.queue.hooks.active:
+                self.queue.hooks.emit('released', self.file_path, tasks=self.task_count)
+        self.queue.drop_lease(self.file_path)
+
+    def stat(self):
+        """Return the claimed file’s `os.stat` result, or None if it has gone."""
+        try:
+            return os.stat(self.path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def check_lease_lost(self, err):
+        """Re-raise this error from filing the claim away unless the file was recovered by another process."""
+        if err.errno != errno.ENOENT or os.path.exists(self.path):
+            raise err
+        # Our lease expired (perhaps we were stopped for a while)
+        # and the file was returned to `todo` from under us.
+        self.queue.metrics.increment('lease_lost')
@@ -0,0 +1,205 @@
+# -*- coding: UTF-8 -*-
+
+"""Counts of the backlog, kept up to date as files move through the queue.
+
+Counting the files in `todo` by walking it is slow on a big tree
+(especially over NFS). A `BacklogStats` instead keeps counts in an
+SQLite database, usually `stats.sqlite3` in the data directory, shared
+by all the processes draining it:
+- pending_files, pending_bytes: files in `todo` or `retry`
+- oldest_pending_seconds: age of the oldest of them (by modification time)
+- in_flight_files: files claimed and in `doing`
+- done_files, done_tasks: files filed in `done` and tasks posted from
+  them (an archive counts once per member)
+- pushed_back_files: files returned for another attempt
+
+Files are counted as pending once a queue has seen them in `todo`; the
+index lists each directory as it goes, so files nobody has yet reached
+are not counted. To have the count complete, whatever writes files in
+to `todo` should note them with `add_pending` as it goes. Reading the
+counts is O(1). Should they drift (because files were moved by hand,
+say), `resync` walks the tree to correct them.
+
+Files are counted, not tasks: an archive waiting or in flight counts
+as one file, however many members it has.
+
+Claims and files filed away are written to the database at most every
+`flush_interval` seconds, in one transaction, rather than one at a
+time; counts read by other processes may lag by that much, and those
+of a process that crashes are lost until the next `resync`.
+"""
+
+import collections
+import errno
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    from os import scandir
+except ImportError:  # Python 2
+    from scandir import scandir
+
+
+COUNTER_NAMES = (
+    'pending_files', 'pending_bytes', 'in_flight_files', 'done_files', 'done_tasks', 'pushed_back_files')
+
+
+class BacklogStats(object):
+    """Persistent counts of files waiting, in flight and done."""
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # Changes to pending (statement, parameters) and to counters, not yet written.
+        self.pending_changes = []
+        self.counter_deltas = collections.Counter()
+        self.flushed_at = time.time()
+        self.connection = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        with self.connection:
+            # Counts that drift after a crash can be resynced.
+            self.connection.execute('PRAGMA synchronous = OFF')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS pending ('
+                ' path TEXT PRIMARY KEY, bytes INTEGER NOT NULL, modified_at REAL NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS pending_modified_at ON pending (modified_at)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)', [(name,) for name in COUNTER_NAMES])
+            self.connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS pending_added AFTER INSERT ON pending BEGIN'
+                " UPDATE counters SET value = value + 1 WHERE name = 'pending_files';"
+                " UPDATE counters SET value = value + NEW.bytes WHERE name = 'pending_bytes';"
+                ' END')
+            self.connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS pending_removed AFTER DELETE ON pending BEGIN'
+                " UPDATE counters SET value = value - 1 WHERE name = 'pending_files';"
+                " UPDATE counters SET value = value - OLD.bytes WHERE name = 'pending_bytes';"
+                ' END')
+
+    def add_pending(self, files, dir_path):
+        """Note files waiting in `dir_path`, each a triple (relative path, size, modification time).
+
+        Files already counted are ignored, so the same file may be noted
+        on every pass over the tree. A file claimed since it was listed
+        is not counted: whether it is still there is checked once the
+        rows are written, so that a claim noted meanwhile (which has to
+        wait for this transaction) removes it again.
+        """
+        with self.lock, self.connection:
+            self.write_changes()
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO pending (path, bytes, modified_at) VALUES (?, ?, ?)', files)
+            self.connection.executemany('DELETE FROM pending WHERE path = ?', [
+                (file_path,) for file_path, size, modified_at in files
+                if not os.path.exists(os.path.join(dir_path, file_path))])
+
+    def claimed(self, file_paths):
+        """Note that these files have been claimed."""
+        with self.lock:
+            self.pending_changes.extend(('DELETE FROM pending WHERE path = ?', (path,)) for path in file_paths)
+            self.counter_deltas['in_flight_files'] += len(file_paths)
+            self.flush_if_due()
+
+    def finished(self, task_count):
+        """Note that a claimed file has been filed in `done`, with this many tasks posted."""
+        with self.lock:
+            self.counter_deltas['in_flight_files'] -= 1
+            self.counter_deltas['done_files'] += 1
+            self.counter_deltas['done_tasks'] += task_count
+            self.flush_if_due()
+
+    def returned(self, file_path, size, modified_at, task_count=0, is_pushed_back=False):
+        """Note that a claimed file is waiting again, with `task_count` of its tasks posted meanwhile."""
+        with self.lock:
+            self.pending_changes.append((
+                'INSERT OR IGNORE INTO pending (path, bytes, modified_at) VALUES (?, ?, ?)',
+                (file_path, size, modified_at)))
+            self.counter_deltas['in_flight_files'] -= 1
+            self.counter_deltas['done_tasks'] += task_count
+            if is_pushed_back:
+                self.counter_deltas['pushed_back_files'] += 1
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        if time.time() - self.flushed_at >= self.flush_interval:
+            with self.connection:
+                self.write_changes()
+
+    def write_changes(self):
+        """Write the changes noted since the last flush, within the caller’s transaction."""
+        for statement, parameters in self.pending_changes:
+            self.connection.execute(statement, parameters)
+        self.connection.executemany(
+            'UPDATE counters SET value = value + ? WHERE name = ?',
+            [(amount, name) for name, amount in self.counter_deltas.items() if amount])
+        self.pending_changes = []
+        self.counter_deltas.clear()
+        self.flushed_at = time.time()
+
+    def read(self):
+        """Return the counts as a dict (having written this process’s changes)."""
+        with self.lock:
+            with self.connection:
+                self.write_changes()
+            counts = dict(self.connection.execute('SELECT name, value FROM counters'))
+            oldest = self.connection.execute('SELECT MIN(modified_at) FROM pending').fetchone()[0]
+        counts['oldest_pending_seconds'] = max(0.0, time.time() - oldest) if oldest is not None else 0.0
+        return counts
+
+    def resync(self, pending_dirs, doing_dir):
+        """Recount the files waiting in `pending_dirs` and in flight in `doing_dir` by walking them.
+
+        The counts of files done are left as they are.
+        """
+        files = []
+        for dir_path in pending_dirs:
+            files.extend(walk_files(dir_path, with_stat=True))
+        in_flight_count = sum(1 for _ in walk_files(doing_dir))
+        with self.lock, self.connection:
+            self.write_changes()
+            self.connection.execute('DELETE FROM pending')
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO pending (path, bytes, modified_at) VALUES (?, ?, ?)', files)
+            self.connection.execute(
+                "UPDATE counters SET value = ? WHERE name = 'in_flight_files'", (in_flight_count,))
+
+    def close(self):
+        with self.lock:
+            with self.connection:
+                self.write_changes()
+            self.connection.close()
+
+
+def walk_files(root_dir, with_stat=False):
+    """Yield the relative path of each file under the directory (skipping sidecars).
+
+    With `with_stat`, yield triples (path, size, modification time) instead.
+    """
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            entries = list(scandir(os.path.join(root_dir, rel_dir)))
+        except OSError as err:
+            if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                continue
+            raise
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            rel_path = os.path.join(rel_dir, entry.name)
+            if entry.is_dir():
+                stack.append(rel_path)
+            elif not with_stat:
+                yield rel_path
+            else:
+                try:
+                    entry_stat = entry.stat()
+                except OSError as err:
+                    if err.errno == errno.ENOENT:
+                        continue
+                    raise
+                yield rel_path, entry_stat.st_size, entry_stat.st_mtime
@@ -0,0 +1,65 @@
+# -*- coding: UTF-8 -*-
+
+"""Writing hook events as a trace to view in Chrome or Perfetto.
+
+A `TraceWriter` registered with `dozup.hooks.Hooks` writes the events
+of a run in the Trace Event Format (a JSON array of events), which can
+be opened with ‘chrome://tracing’ or ‘https://ui.perfetto.dev’. Each
+thread gets its own timeline, named after the thread, on which:
+- each claimed file is a slice, from its first task being opened until
+  it is done, pushed back or released
+- each post is a slice, named after the task, within its file’s
+- claims are instant events
+
+Viewers accept an array that is never closed, so a trace of a run that
+was killed can still be opened.
+"""
+
+import json
+import os
+import threading
+
+
+class TraceWriter(object):
+    """Writes hook events to a trace-event JSON file (pass `record` to `Hooks.register`)."""
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.strm = open(path, 'w')
+        self.strm.write('[')
+        self.lock = threading.Lock()
+        self.thread_ids = set()
+        self.started_at = {}
+        self.is_first = True
+
+    def record(self, event, name, when, details):
+        thread = threading.current_thread()
+        tid = thread.ident
+        ts = when * 1e6
+        with self.lock:
+            if tid not in self.thread_ids:
+                self.thread_ids.add(tid)
+                self.write('M', 'thread_name', tid, args={'name': thread.name})
+            if event == 'claimed':
+                self.write('i', 'claimed', tid, cat='claim', ts=ts, s='t', args={'path': name})
+            elif event == 'opened':
+                self.started_at.setdefault(details['file_path'], ts)
+            elif event == 'post_start':
+                self.started_at[tid, name] = ts
+            elif event == 'post_end':
+                started_at = self.started_at.pop((tid, name), ts)
+                self.write('X', name, tid, cat='post', ts=started_at, dur=ts - started_at, args=details)
+            else:
+                started_at = self.started_at.pop(name, ts)
+                self.write(
+                    'X', name, tid, cat='file', ts=started_at, dur=ts - started_at, args=dict(details, outcome=event))
+
+    def write(self, phase, name, tid, **fields):
+        fields.update(ph=phase, name=name, pid=self.pid, tid=tid)
+        self.strm.write(('\n' if self.is_first else ',\n') + json.dumps(fields, sort_keys=True))
+        self.is_first = False
+
+    def close(self):
+        with self.lock:
+            self.strm.write('\n]\n')
+            self.strm.close()
@@ -0,0 +1,199 @@
+# -*- coding: UTF-8 -*-
+
+"""Transforming the content of tasks before it is posted.
+
+A transform is a function taking a task’s name and content (as bytes)
+and returning the content to post in its place: converting CSV to
+JSON, say, or signing it. It is run in worker processes, so must be a
+module-level function that they can import by name, such as
+`mypackage.convert:csv_to_json`.
+
+A `TransformStage` reads tasks ahead from the queue and has them
+transformed by a pool of processes while earlier tasks are being
+posted, so that preparing them uses every core and overlaps with
+waiting on the network.
+"""
+
+import collections
+import importlib
+import io
+import multiprocessing
+import time
+
+from .journal import NULL_JOURNAL
+from .poster import DozupError
+from .queue import Claim
+
+
+def load_transform(spec):
+    """Import the transform function named by MODULE:FUNCTION."""
+    module_name, _, function_name = spec.partition(':')
+    if not module_name or not function_name:
+        raise ValueError('expected MODULE:FUNCTION, got %r' % (spec,))
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+class TransformError(DozupError):
+    """A task whose transform failed; having had no response, its `status_code` is None."""
+    def __init__(self, name, message):
+        super(TransformError, self).__init__(None, '%s: %s' % (name, message))
+
+    def __repr__(self):
+        return 'TransformError(%r)' % (self.message,)
+
+    def __str__(self):
+        return 'transform failed (%s)' % (self.message,)
+
+
+class TransformStage(object):
+    """Runs a transform over tasks in a pool of `processes` worker processes.
+
+    While each task is being posted, up to `prefetch` tasks after it (or
+    about `prefetch_bytes` of content) are kept read in to memory and in
+    the pool; by default, two for each process. Transformed tasks keep their names and claims, so
+    may be pushed back as usual; their input is the transform’s output.
+
+    A task whose transform raises an exception (or returns other than bytes) is pushed back and a
+    `TransformError` kept in `errors` (the most recent `max_errors` of them) and
+    recorded in the `journal`, if any.
+
+    The pool is started by forking, so create the stage before starting
+    other threads. May be shared between workers in different threads.
+    """
+    def __init__(
+            self, transform, processes=None, prefetch=None, prefetch_bytes=16 * 1024 * 1024, journal=None,
+            max_errors=1000):
+        self.transform = transform
+        self.processes = processes or multiprocessing.cpu_count()
+        self.prefetch = prefetch or 2 * self.processes
+        self.prefetch_bytes = prefetch_bytes
+        self.journal = journal or NULL_JOURNAL
+        self.errors = collections.deque(maxlen=max_errors)
+        self.pool = multiprocessing.Pool(self.processes)
+
+    def iter_tasks(self, queue, watch=False):
+        """Yield tasks from the queue with their content transformed, in order.
+
+        Each task is yielded as soon as it is ready, while those after it
+        are still being transformed; as each is yielded, the next is read
+        and submitted, so that the pool is kept busy. As with
+        `DozupQueue.iter_tasks`, tasks must be pushed back (or not) before
+        the next is requested, and files are filed away once all their
+        tasks have been settled.
+
+        Once a task is pushed back, no more are read (unless the queue
+        has retries enabled); the rest of those already read are
+        yielded, the rest of the members of the last archive read are
+        left for later, and iteration stops (or with `watch`, pauses).
+        The later tasks of the file whose task was pushed back are not
+        yielded.
+        """
+        if watch:
+            queue.ensure_watching()
+        window = collections.deque()  # (task, result, size) in the order read
+        window_bytes = 0
+        claims = collections.deque()  # Claims with tasks not yet settled, oldest first.
+        reading = None  # The claim whose tasks are being read, if any.
+        members = None
+        is_stopping = False
+        try:
+            while True:
+                # One more than `prefetch`, so that many are left in the pool while the next is posted.
+                while not is_stopping and len(window) <= self.prefetch and window_bytes < self.prefetch_bytes:
+                    if reading is None:
+                        file_path = queue.claim_file()
+                        if not file_path:
+                            break
+                        reading = Claim(queue, file_path)
+                        members = reading.iter_tasks()
+                        claims.append(reading)
+                    task = next(members, None)
+                    if task is None:
+                        if reading.is_pushed_back and queue.retry_index is None:
+                            # An archive that could not be read.
+                            is_stopping = True
+                        reading = members = None
+                        self.finish_settled(claims, window, reading)
+                        continue
+                    content = task.input.read()
+                    task.input = None
+                    window.append((task, self.pool.apply_async(self.transform, (task.name, content)), len(content)))
+                    window_bytes += len(content)
+                    if task.state_path is not None:
+                        # A whole file, so its claim has no more tasks.
+                        members.close()
+                        reading = members = None
+                if not window:
+                    if is_stopping and reading is not None:
+                        members.close()
+                        claims.remove(reading)
+                        reading.release()
+                        reading = members = None
+                    if not watch:
+                        break
+                    if is_stopping:
+                        time.sleep(queue.push_back_pause)
+                        is_stopping = False
+                    else:
+                        queue.wait_for_files(queue.time_until_retry())
+                    continue
+                task, result, size = window.popleft()
+                window_bytes -= size
+                if self.collect(task, result):
+                    yield task
+                task.claim.settle(task)
+                if task.is_pushed_back:
+                    while window and window[0][0].claim is task.claim:
+                        window_bytes -= window.popleft()[2]
+                    if task.claim is reading:
+                        members.close()
+                        reading = members = None
+                    if queue.retry_index is None:
+                        is_stopping = True
+                self.finish_settled(claims, window, reading)
+        finally:
+            if members is not None:
+                members.close()
+            for claim in claims:
+                claim.release()
+
+    def finish_settled(self, claims, window, reading):
+        """File away the oldest claims once all their tasks have been read and settled."""
+        while claims and claims[0] is not reading and not (window and window[0][0].claim is claims[0]):
+            claims.popleft().finish()
+
+    def transform_batch(self, batch):
+        """Transform the tasks of a batch from `DozupQueue.iter_batches`.
+
+        Returns --
+            list of the tasks transformed successfully (the others are pushed back).
+        """
+        return [task for task, result in zip(batch, self.submit(batch)) if self.collect(task, result)]
+
+    def submit(self, tasks):
+        return [
+            self.pool.apply_async(self.transform, (task.name, task.input.read()))
+            for task in tasks]
+
+    def collect(self, task, result):
+        """Wait for the task’s transform, replacing its input with the output.
+
+        Returns --
+            whether the transform succeeded.
+        """
+        try:
+            output = result.get()
+            if not isinstance(output, bytes):
+                raise TypeError('transform returned %s, not bytes' % type(output).__name__)
+        except Exception as err:
+            message = '%s: %s' % (type(err).__name__, err)
+            self.errors.append(TransformError(task.name, message))
+            self.journal.record(task.name, 'transform_failed', error=message)
+            task.push_back()
+            return False
+        task.input = io.BytesIO(output)
+        return True
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
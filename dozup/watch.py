@@ -0,0 +1,187 @@
+# -*- coding: UTF-8 -*-
+
+"""Waiting for files to arrive in the `todo` directory.
+
+On Linux the tree is watched with inotify, so new files are noticed
+as soon as they are closed after writing or moved in to place. Elsewhere
+the queue falls back to rescanning at a fixed interval.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+try:
+    from os import scandir
+except ImportError:  # Python 2
+    from scandir import scandir
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# How paths that are not valid in their encoding are converted (Python 2 has no ‘surrogateescape’).
+PATH_ERRORS = 'surrogateescape' if sys.version_info[0] >= 3 else 'strict'
+FILESYSTEM_ENCODING = sys.getfilesystemencoding() or 'UTF-8'
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_STRUCT = struct.Struct('iIII')
+
+
+class PollingWatcher(object):
+    """Stand-in for `InotifyWatcher` where inotify is unavailable."""
+    def __init__(self, root, poll_interval=5.0):
+        self.root = root
+        self.poll_interval = poll_interval
+
+    def add_tree(self, rel_dir):
+        """Returns None: this watcher cannot list files as it goes."""
+
+    def wait(self, timeout=None):
+        """Sleep for the poll interval (or `timeout` if shorter).
+
+        Returns --
+            None, meaning anything might have changed.
+        """
+        time.sleep(self.poll_interval if timeout is None else min(timeout, self.poll_interval))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Watches a directory tree for files arriving, using Linux inotify.
+
+    Call `add_tree('')` to start watching the whole tree.
+    Subdirectories are watched as they are created.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.libc = load_libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise_errno()
+        self.dir_paths = {}
+
+    def add_tree(self, rel_dir):
+        """Watch this directory and those below it.
+
+        Returns --
+            list of the files already in them, relative to the root.
+        """
+        file_paths = []
+        stack = [rel_dir]
+        while stack:
+            rel_dir = stack.pop()
+            dir_path = os.path.join(self.root, rel_dir)
+            wd = self.libc.inotify_add_watch(self.fd, encode_path(dir_path), WATCH_MASK)
+            if wd < 0:
+                if ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise_errno()
+            self.dir_paths[wd] = rel_dir
+            try:
+                entries = sorted(scandir(dir_path), key=lambda e: e.name)
+            except OSError as err:
+                if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise
+            for entry in entries:
+                if entry.is_dir():
+                    stack.append(os.path.join(rel_dir, entry.name))
+                else:
+                    file_paths.append(os.path.join(rel_dir, entry.name))
+        return file_paths
+
+    def wait(self, timeout=None):
+        """Block until files arrive or `timeout` seconds have passed.
+
+        Returns --
+            list of files that arrived, relative to the root,
+            or None if events were lost and anything might have changed.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        file_paths = []
+        for wd, mask, name in self.read_events():
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.dir_paths.pop(wd, None)
+                continue
+            rel_dir = self.dir_paths.get(wd)
+            if rel_dir is None:
+                continue
+            rel_path = os.path.join(rel_dir, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    file_paths.extend(self.add_tree(rel_path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                file_paths.append(rel_path)
+        return file_paths
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return
+            raise
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_len = EVENT_STRUCT.unpack_from(data, offset)
+            offset += EVENT_STRUCT.size
+            name = decode_path(data[offset:offset + name_len].rstrip(b'\0'))
+            offset += name_len
+            yield wd, mask, name
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def encode_path(path):
+    """Return the path as bytes, as passed to the OS."""
+    return path if isinstance(path, bytes) else path.encode(FILESYSTEM_ENCODING, PATH_ERRORS)
+
+
+def decode_path(path):
+    """Return the path as a native string (bytes on Python 2)."""
+    if isinstance(path, str):
+        return path
+    if bytes is str:
+        return path.encode(FILESYSTEM_ENCODING, PATH_ERRORS)
+    return path.decode(FILESYSTEM_ENCODING, PATH_ERRORS)
+
+
+def load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError(errno.ENOSYS, 'inotify is not available')
+    return libc
+
+
+def raise_errno():
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+
+
+def create_watcher(root, poll_interval=5.0):
+    """Return an inotify watcher for this tree, or a polling one if that fails."""
+    try:
+        return InotifyWatcher(root)
+    except (OSError, AttributeError):
+        return PollingWatcher(root, poll_interval)
@@ -0,0 +1,82 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import httpretty
+
+from dozup import DozupQueue, DozupError
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from dozup.aio import AsyncDozupPoster, iter_tasks_async
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio needs Python 3.5')
+class AsyncTests(unittest.TestCase):
+    endpoint_url = 'http://api.example.com/drop/'
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupQueueTests.')
+        self.loop = asyncio.new_event_loop()
+        self.poster = AsyncDozupPoster(self.endpoint_url, concurrency=2)
+
+    def tearDown(self):
+        self.poster.close()
+        self.loop.close()
+        shutil.rmtree(self.dir_path)
+
+    @httpretty.activate
+    def test_posts_every_task_and_files_them_as_done(self):
+        self.given_server_endpoint(201, 'OK')
+        self.given_a_file('todo/a.txt', b'content of a')
+        self.given_a_file('todo/b/c.txt', b'content of c')
+
+        self.when_draining_queue()
+
+        self.assertEqual([('a.txt', True), ('b/c.txt', True)], self.results)
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, 'done', 'a.txt')))
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, 'done', 'b', 'c.txt')))
+
+    @httpretty.activate
+    def test_pushes_back_on_failure_and_keeps_errors(self):
+        self.given_server_endpoint(503, 'Nope')
+        self.given_a_file('todo/a.txt', b'content of a')
+
+        self.when_draining_queue()
+
+        self.assertEqual([('a.txt', False)], self.results)
+        self.assertEqual([DozupError(503, 'Nope')], list(self.poster.errors))
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, 'todo', 'a.txt')))
+
+    # Helpers
+
+    def given_server_endpoint(self, status_code, content):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            status=status_code, content_type='text/plain', body=content)
+
+    def given_a_file(self, relative_path, content):
+        subdir_path = os.path.join(self.dir_path, os.path.dirname(relative_path))
+        if not os.path.exists(subdir_path):
+            os.makedirs(subdir_path)
+        with open(os.path.join(self.dir_path, relative_path), 'wb') as strm:
+            strm.write(content)
+
+    def when_draining_queue(self):
+        tasks = iter_tasks_async(DozupQueue(self.dir_path))
+        self.results = []
+        while True:
+            try:
+                task = self.loop.run_until_complete(tasks.__anext__())
+            except StopAsyncIteration:
+                break
+            is_ok = self.loop.run_until_complete(self.poster.post(task.name, task.input))
+            self.results.append((task.name, is_ok))
+            if not is_ok:
+                task.push_back()
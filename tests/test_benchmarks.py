@@ -0,0 +1,89 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from benchmarks.generate import make_small_files, make_zip
+from benchmarks.run import find_regressions, histogram_percentile, queue_and_poster, small_files
+from benchmarks.stub_server import StubServer, covers
+
+
+class Options(object):
+    files = 20
+    size = 100
+    workers = 2
+    error_rate = 0.0
+
+
+class BenchmarkTests(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupBenchmarkTests.')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def test_spreads_small_files_over_nested_dirs(self):
+        byte_count = make_small_files(os.path.join(self.dir_path, 'todo'), 30, 10, depth=2, fanout=3)
+
+        file_paths = [
+            os.path.join(dir_path, name)
+            for dir_path, dir_names, file_names in os.walk(self.dir_path)
+            for name in file_names]
+        self.assertEqual(300, byte_count)
+        self.assertEqual(30, len(file_paths))
+        self.assertTrue(all(len(os.path.relpath(p, self.dir_path).split(os.sep)) == 4 for p in file_paths))
+
+    def test_checks_upload_ranges_cover_whole_file(self):
+        self.assertTrue(covers({0: 1024, 1024: 2048, 2048: 2500}, 2500))
+        self.assertTrue(covers({0: 1024, 512: 2048}, 2048))
+        self.assertFalse(covers({0: 1024, 2048: 2500}, 2500))
+        self.assertFalse(covers({0: 1024}, 2500))
+        self.assertTrue(covers({}, 0))
+
+    def test_makes_zip_of_members(self):
+        byte_count = make_zip(os.path.join(self.dir_path, 'todo', 'a.zip'), 5, 10)
+
+        self.assertEqual(50, byte_count)
+
+    def test_cli_scenario_posts_every_file(self):
+        with StubServer() as server:
+            result = small_files(Options(), self.dir_path, server)
+
+        self.assertEqual(20, server.request_count)
+        self.assertEqual(2000, server.byte_count)
+        self.assertEqual(20, result['tasks'])
+        self.assertTrue(result['p99_ms'])
+
+    def test_failed_posts_are_retried(self):
+        options = Options()
+        options.error_rate = 0.3
+        with StubServer(error_rate=0.3, seed=1) as server:
+            result = queue_and_poster(options, self.dir_path, server)
+
+        self.assertEqual(20, server.status_counts[201])
+        self.assertTrue(server.status_counts[503])
+        self.assertEqual(20, sum(len(names) for _, _, names in os.walk(os.path.join(self.dir_path, 'done'))))
+        self.assertEqual(20, result['tasks'])
+
+    def test_percentile_is_upper_bound_of_bucket(self):
+        histogram = {'buckets': [0.01, 0.1, 1.0], 'counts': [50, 45, 5, 0], 'count': 100}
+
+        self.assertEqual(0.01, histogram_percentile(histogram, 0.5))
+        self.assertEqual(1.0, histogram_percentile(histogram, 0.99))
+
+    def test_reports_slowdown_and_growth_beyond_tolerance(self):
+        baseline = [
+            {'scenario': 'a', 'tasks_per_second': 100.0, 'peak_rss_kb': 1000},
+            {'scenario': 'b', 'tasks_per_second': 100.0, 'peak_rss_kb': 1000},
+        ]
+        results = [
+            {'scenario': 'a', 'tasks_per_second': 85.0, 'peak_rss_kb': 1100},
+            {'scenario': 'b', 'tasks_per_second': 70.0, 'peak_rss_kb': 1300},
+            {'scenario': 'c', 'tasks_per_second': 1.0, 'peak_rss_kb': 9999},
+        ]
+
+        regressions = find_regressions(results, baseline, 0.2)
+
+        self.assertEqual(['b: 70.0 tasks/s, was 100.0', 'b: peak RSS 1300 KiB, was 1000'], regressions)
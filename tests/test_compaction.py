@@ -0,0 +1,124 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zipfile
+
+from mock import Mock, patch
+
+from dozup.cli import compact
+from dozup.compaction import Compactor
+
+
+class CompactorTests(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupCompactorTests.')
+        self.done_dir = os.path.join(self.dir_path, 'done')
+        self.compactor = Compactor(self.dir_path, min_age=3600.0, max_segment_files=2)
+
+    def tearDown(self):
+        self.compactor.close()
+        shutil.rmtree(self.dir_path)
+
+    def given_done_file(self, rel_path, content=b'content'):
+        file_path = os.path.join(self.done_dir, rel_path)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(file_path, 'wb') as strm:
+            strm.write(content)
+        return file_path
+
+    def when_compacted(self, seconds_later=7200.0):
+        with patch('time.time', return_value=time.time() + seconds_later):
+            return self.compactor.compact()
+
+    def test_moves_old_files_in_to_segment(self):
+        file_path = self.given_done_file(os.path.join('a', 'b.txt'), b'hello')
+
+        file_count = self.when_compacted()
+
+        self.assertEqual(1, file_count)
+        self.assertFalse(os.path.exists(file_path))
+        bucket = time.strftime('%Y-%m-%d', time.gmtime(time.time()))
+        self.assertEqual(os.path.join(bucket, '000001.zip'), self.compactor.find(os.path.join('a', 'b.txt')))
+        self.assertEqual(b'hello', self.compactor.read(os.path.join('a', 'b.txt')))
+
+    def test_leaves_recent_files(self):
+        file_path = self.given_done_file('b.txt')
+
+        file_count = self.when_compacted(60.0)
+
+        self.assertEqual(0, file_count)
+        self.assertTrue(os.path.exists(file_path))
+        self.assertIsNone(self.compactor.find('b.txt'))
+
+    def test_starts_new_segment_when_full(self):
+        for name in ['1.txt', '2.txt', '3.txt']:
+            self.given_done_file(name)
+
+        self.when_compacted()
+
+        self.assertEqual(self.compactor.find('1.txt'), self.compactor.find('2.txt'))
+        self.assertTrue(self.compactor.find('3.txt').endswith('000002.zip'))
+        self.assertEqual([], os.listdir(self.done_dir))
+
+    def test_later_runs_add_segments(self):
+        self.given_done_file('1.txt')
+        self.when_compacted()
+        self.given_done_file('2.txt')
+
+        self.when_compacted()
+
+        self.assertTrue(self.compactor.find('1.txt').endswith('000001.zip'))
+        self.assertTrue(self.compactor.find('2.txt').endswith('000002.zip'))
+        self.assertEqual(b'content', self.compactor.read('1.txt'))
+
+    def test_removes_files_already_archived_by_interrupted_run(self):
+        file_path = self.given_done_file('1.txt')
+        with patch('dozup.compaction.remove_file'):
+            self.when_compacted()
+        self.assertTrue(os.path.exists(file_path))
+
+        file_count = self.when_compacted()
+
+        self.assertEqual(0, file_count)
+        self.assertFalse(os.path.exists(file_path))
+        self.assertTrue(self.compactor.find('1.txt').endswith('000001.zip'))
+
+    def test_removes_empty_dirs_only_when_old(self):
+        self.given_done_file(os.path.join('a', 'b', 'c.txt'))
+        os.makedirs(os.path.join(self.done_dir, 'x'))
+        later = time.time() + 5000.0
+        os.utime(os.path.join(self.done_dir, 'x'), (later, later))
+
+        self.when_compacted()
+
+        # Something was filed in ‘x’ less than an hour ago.
+        self.assertEqual(['x'], os.listdir(self.done_dir))
+
+    def test_stores_compressed_files_as_they_are(self):
+        self.given_done_file('a.gz', b'x' * 1000)
+        self.given_done_file('a.txt', b'x' * 1000)
+
+        self.when_compacted()
+
+        with zipfile.ZipFile(os.path.join(self.dir_path, 'archive', self.compactor.find('a.gz'))) as archive:
+            self.assertEqual(zipfile.ZIP_STORED, archive.getinfo('a.gz').compress_type)
+            self.assertEqual(zipfile.ZIP_DEFLATED, archive.getinfo('a.txt').compress_type)
+
+    def test_raises_key_error_if_not_archived(self):
+        with self.assertRaises(KeyError):
+            self.compactor.read('nope.txt')
+
+    def test_command_prints_number_of_files_archived(self):
+        self.given_done_file('1.txt')
+        self.given_done_file('2.txt')
+        out = Mock()
+
+        with patch('time.time', return_value=time.time() + 7200.0):
+            compact([self.dir_path], out)
+
+        out.write.assert_called_once_with('2 files archived\n')
@@ -0,0 +1,83 @@
+# -*- coding: UTF-8 -*-
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from mock import patch
+
+from dozup.dedup import DedupIndex, content_digest
+from dozup.queue import ZipMember
+
+
+class DedupIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupDedupTests.')
+        self.db_path = os.path.join(self.dir_path, 'dedup.sqlite3')
+        self.index = DedupIndex(self.db_path, max_entries=10)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.dir_path)
+
+    def test_knows_content_once_added_for_that_url(self):
+        self.index.add('d1', 'http://a/')
+
+        self.assertTrue(self.index.is_known('d1', 'http://a/'))
+        self.assertFalse(self.index.is_known('d1', 'http://b/'))
+        self.assertFalse(self.index.is_known('d2', 'http://a/'))
+
+    def test_remembers_across_processes(self):
+        self.index.add('d1', 'http://a/')
+        self.index.close()
+
+        self.index = DedupIndex(self.db_path)
+
+        self.assertTrue(self.index.is_known('d1', 'http://a/'))
+
+    def test_evicts_least_recently_seen_beyond_limit(self):
+        for i in range(10):
+            with patch('time.time', return_value=1000.0 + i):
+                self.index.add('d%d' % i, 'http://a/')
+        with patch('time.time', return_value=2000.0):
+            self.index.is_known('d0', 'http://a/')
+
+        with patch('time.time', return_value=2001.0):
+            self.index.add('d10', 'http://a/')
+
+        # One over the limit, plus 10% slack.
+        self.assertEqual(9, self.index.entry_count)
+        self.assertTrue(self.index.is_known('d0', 'http://a/'))
+        self.assertFalse(self.index.is_known('d1', 'http://a/'))
+        self.assertFalse(self.index.is_known('d2', 'http://a/'))
+        self.assertTrue(self.index.is_known('d3', 'http://a/'))
+        self.assertTrue(self.index.is_known('d10', 'http://a/'))
+
+    def test_adding_again_does_not_count_twice(self):
+        self.index.add('d1', 'http://a/')
+        self.index.add('d1', 'http://a/')
+
+        self.assertEqual(1, self.index.entry_count)
+
+    def test_digest_rewinds_file(self):
+        strm = io.BytesIO(b'content')
+
+        digest = content_digest(strm)
+
+        self.assertEqual('ed7002b439e9ac845f22357d822bac1444730fbdb6016d3ec9432297b9ec9f73', digest)
+        self.assertEqual(b'content', strm.read())
+
+    def test_digest_rewinds_zip_member(self):
+        with zipfile.ZipFile(os.path.join(self.dir_path, 'a.zip'), 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('m.txt', b'content')
+        with zipfile.ZipFile(os.path.join(self.dir_path, 'a.zip'), 'r') as archive:
+            member = ZipMember(archive, archive.infolist()[0])
+
+            digest = content_digest(member)
+
+            self.assertEqual(content_digest(io.BytesIO(b'content')), digest)
+            self.assertEqual(b'content', member.read())
+            member.close()
@@ -4,6 +4,7 @@ from __future__ import unicode_literals
 
 """Tests for the system as a whole."""
 
+import json
 import os
 import shutil
 import tempfile
@@ -76,6 +77,40 @@ class EndToEndSuccessTests(EndToEndTestMixin, unittest.TestCase):
         self.then_exit_code_should_denote_success(exit_code)
         self.then_file_should_be_moved_to_done('hello.txt')
 
+    @httpretty.activate
+    def test_posts_transformed_content(self):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            status=self.status_code,
+            content_type=self.content_type,
+            body=self.content)
+        self.given_a_file('todo/hello.txt', b'this is the message content')
+
+        exit_code = main([
+            self.dir_path, self.endpoint_url, '--transform', 'tests.test_transform:shout', '--transform-processes', '1'])
+
+        self.then_should_post_to_server(b'THIS IS THE MESSAGE CONTENT')
+        self.then_exit_code_should_denote_success(exit_code)
+        self.then_file_should_be_moved_to_done('hello.txt')
+
+    @httpretty.activate
+    def test_recovers_file_left_in_doing_by_a_crashed_worker(self):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            status=self.status_code,
+            content_type=self.content_type,
+            body=self.content)
+        self.given_a_file('doing/hello.txt', b'this is the message content')
+        with open(os.path.join(self.dir_path, 'doing', '.hello.txt.lease'), 'w') as strm:
+            strm.write('elsewhere 123\n')
+        os.utime(os.path.join(self.dir_path, 'doing', '.hello.txt.lease'), (0, 0))
+
+        exit_code = main([self.dir_path, self.endpoint_url])
+
+        self.then_should_post_to_server(b'this is the message content')
+        self.then_exit_code_should_denote_success(exit_code)
+        self.then_file_should_be_moved_to_done('hello.txt')
+
 
 class EndToEndFailTests(EndToEndTestMixin, unittest.TestCase):
     endpoint_path = b'/path/to/endpoint.quux'
@@ -104,3 +139,288 @@ class EndToEndFailTests(EndToEndTestMixin, unittest.TestCase):
         self.then_should_post_to_server(b'spiffy paloo')
         self.then_exit_code_should_denote_error(exit_code)
         self.then_file_should_be_left_in_todo('hello.txt')
+
+
+class EndToEndWorkersTests(EndToEndTestMixin, unittest.TestCase):
+    endpoint_path = b'/path/to/endpoint.quux'
+    endpoint_url = b'http://api.example.com' + endpoint_path
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupQueueTests.')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    @httpretty.activate
+    def test_posts_all_files_with_several_workers(self):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            status=201, content_type=b'text/plain', body='OK')
+        for i in range(7):
+            self.given_a_file('todo/d%d/hello%d.txt' % (i, i), b'message %d' % i)
+
+        exit_code = main([self.dir_path, self.endpoint_url, '--workers', '3'])
+
+        self.then_exit_code_should_denote_success(exit_code)
+        self.assertEqual(7, len(httpretty.HTTPretty.latest_requests))
+        for i in range(7):
+            self.then_file_should_be_moved_to_done('d%d/hello%d.txt' % (i, i))
+
+    @httpretty.activate
+    def test_gathers_errors_from_every_worker(self):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            status=503, content_type=b'text/plain', body='Nope')
+        for i in range(2):
+            self.given_a_file('todo/d%d/hello%d.txt' % (i, i), b'message %d' % i)
+
+        errors = main([self.dir_path, self.endpoint_url, '--workers', '2'])
+
+        self.assertEqual(2, len(errors))
+        for i in range(2):
+            self.then_file_should_be_left_in_todo('d%d/hello%d.txt' % (i, i))
+
+    @httpretty.activate
+    def test_writes_trace_with_timeline_per_worker(self):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            status=201, content_type=b'text/plain', body='OK')
+        for i in range(4):
+            self.given_a_file('todo/d%d/hello%d.txt' % (i, i), b'message %d' % i)
+        trace_path = os.path.join(self.dir_path, 'trace.json')
+
+        main([self.dir_path, self.endpoint_url, '--workers', '2', '--trace', trace_path])
+
+        with open(trace_path) as strm:
+            trace_events = json.load(strm)
+        thread_names = set(e['args']['name'] for e in trace_events if e['ph'] == 'M')
+        self.assertEqual(set(['dozup-worker-0', 'dozup-worker-1']), thread_names)
+        self.assertEqual(4, len([e for e in trace_events if e.get('cat') == 'post']))
+        self.assertEqual(4, len([e for e in trace_events if e.get('cat') == 'file']))
+
+    @httpretty.activate
+    def test_posts_files_of_other_shards_too(self):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            status=201, content_type=b'text/plain', body='OK')
+        for i in range(7):
+            self.given_a_file('todo/d%d/hello%d.txt' % (i, i), b'message %d' % i)
+
+        exit_code = main([self.dir_path, self.endpoint_url, '--workers', '2', '--shard', '1/3'])
+
+        self.then_exit_code_should_denote_success(exit_code)
+        self.assertEqual(7, len(httpretty.HTTPretty.latest_requests))
+        for i in range(7):
+            self.then_file_should_be_moved_to_done('d%d/hello%d.txt' % (i, i))
+
+    @httpretty.activate
+    def test_posts_all_files_with_adaptive_concurrency(self):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            status=201, content_type=b'text/plain', body='OK')
+        for i in range(7):
+            self.given_a_file('todo/d%d/hello%d.txt' % (i, i), b'message %d' % i)
+
+        exit_code = main([self.dir_path, self.endpoint_url, '--workers', '3', '--adaptive', '--max-rate', '1000'])
+
+        self.then_exit_code_should_denote_success(exit_code)
+        self.assertEqual(7, len(httpretty.HTTPretty.latest_requests))
+
+    def test_rejects_shard_out_of_range(self):
+        with self.assertRaises(SystemExit):
+            main([self.dir_path, self.endpoint_url, '--shard', '3/3'])
+
+    def test_rejects_claim_count_with_transform(self):
+        with self.assertRaises(SystemExit):
+            main([self.dir_path, self.endpoint_url, '--transform', 'tests.test_transform:shout', '--claim-count', '5'])
+
+    def test_rejects_claim_count_with_batch_size(self):
+        with self.assertRaises(SystemExit):
+            main([self.dir_path, self.endpoint_url, '--batch-size', '10', '--claim-count', '5'])
+
+
+class EndToEndBatchTests(EndToEndTestMixin, unittest.TestCase):
+    endpoint_path = b'/path/to/endpoint.quux'
+    endpoint_url = b'http://api.example.com' + endpoint_path
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupQueueTests.')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    @httpretty.activate
+    def test_posts_files_in_batches(self):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            status=207, content_type=b'application/json',
+            body='{"results": [{"status": 201}, {"status": 201}]}')
+        for i in range(4):
+            self.given_a_file('todo/d%d/hello%d.txt' % (i, i), b'message %d' % i)
+
+        exit_code = main([self.dir_path, self.endpoint_url, '--batch-size', '2'])
+
+        self.then_exit_code_should_denote_success(exit_code)
+        self.assertEqual(2, len(httpretty.HTTPretty.latest_requests))
+        for i in range(4):
+            self.then_file_should_be_moved_to_done('d%d/hello%d.txt' % (i, i))
+
+
+class EndToEndDedupTests(EndToEndTestMixin, unittest.TestCase):
+    endpoint_path = b'/path/to/endpoint.quux'
+    endpoint_url = b'http://api.example.com' + endpoint_path
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupQueueTests.')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    @httpretty.activate
+    def test_posts_each_content_once(self):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            status=201, content_type=b'text/plain', body='OK')
+        self.given_a_file('todo/a/one.txt', b'same message')
+        self.given_a_file('todo/b/two.txt', b'same message')
+        self.given_a_file('todo/c/three.txt', b'other message')
+        self.given_a_file('todo/d/four.txt', b'same message')
+
+        exit_code = main([self.dir_path, self.endpoint_url, '--dedup'])
+
+        self.then_exit_code_should_denote_success(exit_code)
+        self.assertEqual(
+            [b'same message', b'other message'],
+            [request.body for request in httpretty.HTTPretty.latest_requests])
+        for file_name in ['a/one.txt', 'b/two.txt', 'c/three.txt', 'd/four.txt']:
+            self.then_file_should_be_moved_to_done(file_name)
+
+    @httpretty.activate
+    def test_journals_duplicates(self):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            status=201, content_type=b'text/plain', body='OK')
+        self.given_a_file('todo/a/one.txt', b'same message')
+        self.given_a_file('todo/b/two.txt', b'same message')
+        journal_path = os.path.join(self.dir_path, 'journal.jsonl')
+
+        main([self.dir_path, self.endpoint_url, '--dedup', '--journal', journal_path])
+
+        with open(journal_path) as strm:
+            entries = [json.loads(line) for line in strm]
+        self.assertEqual(
+            [('a/one.txt', 201), ('b/two.txt', 'duplicate')],
+            [(entry['path'], entry['status']) for entry in entries])
+
+    @httpretty.activate
+    def test_leaves_duplicates_out_of_batches(self):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            status=207, content_type=b'application/json',
+            body='{"results": [{"status": 201}, {"status": 201}]}')
+        self.given_a_file('todo/a/one.txt', b'message 1')
+        self.given_a_file('todo/b/two.txt', b'message 2')
+        main([self.dir_path, self.endpoint_url, '--dedup', '--batch-size', '2'])
+        self.given_a_file('todo/c/one.txt', b'message 1')
+        self.given_a_file('todo/d/two.txt', b'message 2')
+        self.given_a_file('todo/e/three.txt', b'message 3')
+
+        exit_code = main([self.dir_path, self.endpoint_url, '--dedup', '--batch-size', '2'])
+
+        self.then_exit_code_should_denote_success(exit_code)
+        self.assertEqual(2, len(httpretty.HTTPretty.latest_requests))
+        self.assertIn(b'message 3', httpretty.last_request().body)
+        self.assertNotIn(b'message 1', httpretty.last_request().body)
+        self.then_file_should_be_moved_to_done('c/one.txt')
+
+
+class EndToEndRetryTests(EndToEndTestMixin, unittest.TestCase):
+    endpoint_path = b'/path/to/endpoint.quux'
+    endpoint_url = b'http://api.example.com' + endpoint_path
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupQueueTests.')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    @httpretty.activate
+    def test_parks_failed_file_and_posts_the_rest(self):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            responses=[
+                httpretty.Response(status=503, content_type=b'text/plain', body='Nope'),
+                httpretty.Response(status=201, content_type=b'text/plain', body='OK'),
+            ])
+        self.given_a_file('todo/a/hello.txt', b'first')
+        self.given_a_file('todo/b/hello.txt', b'second')
+
+        errors = main([self.dir_path, self.endpoint_url, '--retry-delay', '60'])
+
+        self.assertEqual(1, len(errors))
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, 'retry', 'a/hello.txt')))
+        self.then_file_should_be_moved_to_done('b/hello.txt')
+
+    @httpretty.activate
+    def test_stops_when_circuit_opens(self):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            status=503, content_type=b'text/plain', body='Nope')
+        for i in range(4):
+            self.given_a_file('todo/d%d/hello.txt' % i, b'message %d' % i)
+
+        errors = main([self.dir_path, self.endpoint_url, '--retry-delay', '60', '--circuit-threshold', '2'])
+
+        self.assertEqual(2, len(errors))
+        self.then_file_should_be_left_in_todo('d2/hello.txt')
+        self.then_file_should_be_left_in_todo('d3/hello.txt')
+
+    @httpretty.activate
+    def test_spreads_posts_over_endpoints_passing_over_failing_one(self):
+        failing_url = b'http://replica.example.com' + self.endpoint_path
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            status=202, content_type=b'text/plain', body='OK')
+        httpretty.register_uri(
+            httpretty.POST, failing_url,
+            status=503, content_type=b'text/plain', body='Nope')
+        for i in range(6):
+            self.given_a_file('todo/d%d/hello.txt' % i, b'message %d' % i)
+
+        errors = main([
+            self.dir_path, self.endpoint_url, failing_url, '--retry-delay', '60', '--circuit-threshold', '2'])
+
+        # Two posts to the replica open its circuit; the rest go to the first endpoint.
+        self.assertEqual(2, len(errors))
+        done_names = [name for _, _, names in os.walk(os.path.join(self.dir_path, 'done')) for name in names]
+        self.assertEqual(4, len(done_names))
+
+
+class EndToEndMetricsTests(EndToEndTestMixin, unittest.TestCase):
+    endpoint_path = b'/path/to/endpoint.quux'
+    endpoint_url = b'http://api.example.com' + endpoint_path
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupQueueTests.')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    @httpretty.activate
+    def test_writes_metrics(self):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_url,
+            status=201, content_type=b'text/plain', body='OK')
+        self.given_a_file('todo/hello.txt', b'this is the message content')
+        json_path = os.path.join(self.dir_path, 'metrics.json')
+
+        main([self.dir_path, self.endpoint_url, '--metrics-json', json_path])
+
+        with open(json_path) as strm:
+            snapshot = json.load(strm)
+        self.assertEqual(1, snapshot['counters']['claimed'])
+        self.assertEqual({'201': 1}, snapshot['counters']['posts'])
+        self.assertEqual({'201': 27}, snapshot['counters']['bytes_sent'])
+        self.assertEqual(
+            set(['scan', 'claim', 'read', 'post']),
+            set(snapshot['histograms']))
@@ -0,0 +1,123 @@
+# -*- coding: UTF-8 -*-
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import httpretty
+
+from dozup import DozupPoster, DozupQueue
+from dozup.hooks import Hooks
+
+
+class HookRecorderMixin(unittest.TestCase):
+    def setUp(self):
+        super(HookRecorderMixin, self).setUp()
+        self.events = []
+        self.hooks = Hooks()
+        self.hooks.register(self.record)
+
+    def record(self, event, name, when, details):
+        self.events.append((event, name, details))
+
+
+class HooksTests(HookRecorderMixin, unittest.TestCase):
+    def test_is_inactive_until_callback_registered(self):
+        self.assertFalse(Hooks().active)
+        self.assertTrue(self.hooks.active)
+
+    def test_calls_callback_with_details(self):
+        self.hooks.emit('done', 'a.txt', tasks=1)
+
+        self.assertEqual([('done', 'a.txt', {'tasks': 1})], self.events)
+
+    def test_calls_callback_only_for_its_events(self):
+        claims = []
+        self.hooks.register(lambda event, name, when, details: claims.append(name), ['claimed'])
+
+        self.hooks.emit('claimed', 'a.txt')
+        self.hooks.emit('done', 'a.txt', tasks=1)
+
+        self.assertEqual(['a.txt'], claims)
+
+    def test_rejects_unknown_events(self):
+        with self.assertRaises(ValueError):
+            self.hooks.register(self.record, ['finished'])
+
+
+class DozupQueueHooksTests(HookRecorderMixin, unittest.TestCase):
+    def setUp(self):
+        super(DozupQueueHooksTests, self).setUp()
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupQueueHooksTests.')
+        self.dozup_queue = DozupQueue(self.dir_path, hooks=self.hooks)
+
+    def tearDown(self):
+        self.dozup_queue.close()
+        shutil.rmtree(self.dir_path)
+        super(DozupQueueHooksTests, self).tearDown()
+
+    def given_a_file(self, relative_path, content=b'content'):
+        file_path = os.path.join(self.dir_path, 'todo', relative_path)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(file_path, 'wb') as strm:
+            strm.write(content)
+        return file_path
+
+    def test_tells_of_file_claimed_opened_and_done(self):
+        self.given_a_file('a.txt')
+
+        for task in self.dozup_queue.iter_tasks():
+            pass
+
+        self.assertEqual([
+            ('claimed', 'a.txt', {}),
+            ('opened', 'a.txt', {'file_path': 'a.txt'}),
+            ('done', 'a.txt', {'tasks': 1}),
+        ], self.events)
+
+    def test_tells_of_each_member_opened(self):
+        with zipfile.ZipFile(self.given_a_file('a.zip', b''), 'w') as archive:
+            archive.writestr('1.txt', b'one')
+            archive.writestr('2.txt', b'two')
+
+        for task in self.dozup_queue.iter_tasks():
+            if task.name.endswith('2.txt'):
+                task.push_back()
+
+        self.assertEqual([
+            ('claimed', 'a.zip', {}),
+            ('opened', 'a.zip/1.txt', {'file_path': 'a.zip'}),
+            ('opened', 'a.zip/2.txt', {'file_path': 'a.zip'}),
+            ('pushed_back', 'a.zip', {'tasks': 1}),
+        ], self.events)
+
+    def test_tells_of_file_released(self):
+        self.given_a_file('a.txt')
+
+        tasks = self.dozup_queue.iter_tasks()
+        next(tasks)
+        tasks.close()
+
+        self.assertEqual(('released', 'a.txt', {'tasks': 0}), self.events[-1])
+
+
+class DozupPosterHooksTests(HookRecorderMixin, unittest.TestCase):
+    def setUp(self):
+        super(DozupPosterHooksTests, self).setUp()
+        self.poster = DozupPoster('http://example.com/drop/', hooks=self.hooks)
+
+    @httpretty.activate
+    def test_tells_of_post_start_and_end(self):
+        httpretty.register_uri(httpretty.POST, 'http://example.com/drop/', status=201, body='{}')
+
+        self.poster.post('a.txt', io.BytesIO(b'content'))
+
+        self.assertEqual(['post_start', 'post_end'], [event for event, name, details in self.events])
+        event, name, details = self.events[-1]
+        self.assertEqual('a.txt', name)
+        self.assertEqual(201, details['status'])
+        self.assertEqual(7, details['bytes'])
@@ -0,0 +1,61 @@
+# -*- coding: UTF-8 -*-
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from dozup.journal import Journal, NULL_JOURNAL
+
+
+class JournalTests(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupJournalTests.')
+        self.path = os.path.join(self.dir_path, 'journal.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def test_writes_entries_once_enough_have_accumulated(self):
+        journal = Journal(self.path, flush_count=3, flush_interval=60)
+        journal.record('a.txt', 201, 0.5, 10)
+        journal.record('b.txt', 503, 0.25, 20, 'Sorry!')
+
+        self.assertEqual([], self.read_entries())
+        journal.record('c.txt', 'error', 1.0, 0, 'Connection refused')
+
+        entries = self.read_entries()
+        journal.close()
+        self.assertEqual(['a.txt', 'b.txt', 'c.txt'], [e['path'] for e in entries])
+        self.assertEqual(
+            {'path': 'b.txt', 'status': 503, 'seconds': 0.25, 'bytes': 20, 'error': 'Sorry!'},
+            dict((k, v) for k, v in entries[1].items() if k != 'time'))
+
+    def test_writes_remaining_entries_when_closed(self):
+        journal = Journal(self.path, flush_count=100, flush_interval=60)
+        journal.record('a.txt', 201)
+
+        journal.close()
+
+        self.assertEqual(['a.txt'], [e['path'] for e in self.read_entries()])
+
+    def test_appends_to_existing_journal(self):
+        for name in ['a.txt', 'b.txt']:
+            journal = Journal(self.path)
+            journal.record(name, 201)
+            journal.close()
+
+        self.assertEqual(['a.txt', 'b.txt'], [e['path'] for e in self.read_entries()])
+
+    def test_null_journal_records_nothing(self):
+        NULL_JOURNAL.record('a.txt', 201)
+        NULL_JOURNAL.close()
+
+        self.assertFalse(os.path.exists(self.path))
+
+    def read_entries(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as strm:
+            return [json.loads(line) for line in strm]
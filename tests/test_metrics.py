@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from dozup.metrics import Metrics, NULL_METRICS
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupMetricsTests.')
+        self.metrics = Metrics(buckets=(0.1, 1.0))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def test_counts_by_status(self):
+        self.metrics.increment('claimed')
+        self.metrics.increment('claimed')
+        self.metrics.increment('posts', status=201)
+        self.metrics.increment('posts', status=503)
+        self.metrics.increment('posts', status=201)
+
+        counters = self.metrics.snapshot()['counters']
+
+        self.assertEqual({'claimed': 2, 'posts': {'201': 2, '503': 1}}, counters)
+
+    def test_collects_histogram_of_stage_latencies(self):
+        for seconds in [0.05, 0.5, 0.7, 3.0]:
+            self.metrics.observe('post', seconds)
+
+        histogram = self.metrics.snapshot()['histograms']['post']
+
+        self.assertEqual([1, 2, 1], histogram['counts'])
+        self.assertEqual(4, histogram['count'])
+        self.assertAlmostEqual(4.25, histogram['sum'])
+
+    def test_times_block(self):
+        with patch('time.time', side_effect=[100.0, 100.25]):
+            with self.metrics.timer('claim'):
+                pass
+
+        self.assertEqual([0, 1, 0], self.metrics.snapshot()['histograms']['claim']['counts'])
+
+    def test_meters_reading_of_stream(self):
+        stream = self.metrics.meter(io.BytesIO(b'0123456789'))
+
+        stream.read(4)
+        stream.read()
+        self.metrics.record_post(201, 0.5, stream)
+
+        counters = self.metrics.snapshot()['counters']
+        self.assertEqual({'201': 10}, counters['bytes_sent'])
+        self.assertEqual(b'0123456789', stream.getvalue())
+
+    def test_writes_prometheus_textfile(self):
+        self.metrics.increment('claimed', 3)
+        self.metrics.increment('posts', status=201)
+        self.metrics.observe('post', 0.5)
+        file_path = os.path.join(self.dir_path, 'dozup.prom')
+
+        self.metrics.write_textfile(file_path)
+
+        with open(file_path) as strm:
+            lines = strm.read().splitlines()
+        self.assertIn('# TYPE dozup_claimed_total counter', lines)
+        self.assertIn('dozup_claimed_total 3', lines)
+        self.assertIn('dozup_posts_total{status="201"} 1', lines)
+        self.assertIn('dozup_stage_seconds_bucket{stage="post",le="0.1"} 0', lines)
+        self.assertIn('dozup_stage_seconds_bucket{stage="post",le="1.0"} 1', lines)
+        self.assertIn('dozup_stage_seconds_bucket{stage="post",le="+Inf"} 1', lines)
+        self.assertIn('dozup_stage_seconds_count{stage="post"} 1', lines)
+        self.assertEqual([], [name for name in os.listdir(self.dir_path) if name.endswith('.tmp')])
+
+    def test_writes_json_snapshot(self):
+        self.metrics.increment('pushed_back')
+        file_path = os.path.join(self.dir_path, 'dozup.json')
+
+        self.metrics.write_json(file_path)
+
+        with open(file_path) as strm:
+            self.assertEqual({'pushed_back': 1}, json.load(strm)['counters'])
+
+
+class NullMetricsTests(unittest.TestCase):
+    def test_does_nothing(self):
+        stream = io.BytesIO(b'content')
+
+        with NULL_METRICS.timer('scan'):
+            NULL_METRICS.increment('claimed')
+
+        self.assertIs(stream, NULL_METRICS.meter(stream))
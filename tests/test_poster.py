@@ -3,13 +3,26 @@
 from __future__ import unicode_literals
 import io
 import json
+import os
 import shutil
 import tempfile
+import threading
+import time
+import types
 import unittest
+import zipfile
+import zlib
 
 import httpretty
+from mock import patch
+from requests.compat import urljoin
 
 from dozup import DozupPoster, DozupError
+from dozup.journal import Journal
+from dozup.poster import (
+    CircuitBreaker, Endpoint, Endpoints, Pacer, UploadState, encoded_body, parse_retry_after, request_body)
+from dozup.queue import Task, ZipMember, ZipReader
+from benchmarks.stub_server import StubServer
 
 
 class PosterTestMixin(unittest.TestCase):
@@ -58,6 +71,556 @@ class PosterCreatedTests(PosterTestMixin, unittest.TestCase):
         self.assertEqual(b'/drop/', httpretty.last_request().path)
 
 
+class PosterStreamingTests(PosterTestMixin, unittest.TestCase):
+    status_code = 201
+
+    def test_passes_regular_file_through(self):
+        with open(self.given_a_file('big.bin', b'x' * 100), 'rb') as strm:
+            self.assertIs(strm, request_body(strm))
+
+    def test_sends_zip_member_in_chunks(self):
+        with zipfile.ZipFile(self.given_a_zip('a.zip', 'big.txt', b'y\n' * 100000)) as archive:
+            body = request_body(archive.open('big.txt'))
+
+            self.assertIsInstance(body, types.GeneratorType)
+            chunks = list(body)
+
+        self.assertEqual(4, len(chunks))
+        self.assertEqual(64 * 1024, len(chunks[0]))
+        self.assertEqual(b'y\n' * 100000, b''.join(chunks))
+
+    @httpretty.activate
+    def test_posts_zip_member(self):
+        self.given_server_endpoint()
+
+        with zipfile.ZipFile(self.given_a_zip('a.zip', 'member.txt', b'content of member')) as archive:
+            self.result = self.poster.post('member.txt', archive.open('member.txt'))
+
+        self.assertTrue(self.result)
+        self.assertEqual('chunked', httpretty.last_request().headers['Transfer-Encoding'])
+
+    def given_a_file(self, file_name, content):
+        file_path = os.path.join(self.dir_path, file_name)
+        with open(file_path, 'wb') as strm:
+            strm.write(content)
+        return file_path
+
+    def given_a_zip(self, file_name, member_name, content):
+        file_path = os.path.join(self.dir_path, file_name)
+        with zipfile.ZipFile(file_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(member_name, content)
+        return file_path
+
+
+class PosterCompressionTests(PosterTestMixin, unittest.TestCase):
+    status_code = 201
+    content = b'All work and no play makes Jack a dull boy.\n' * 1000
+
+    def test_compresses_with_gzip(self):
+        body = b''.join(encoded_body(io.BytesIO(self.content), 'gzip'))
+
+        self.assertLess(len(body), len(self.content) // 10)
+        self.assertEqual(self.content, zlib.decompress(body, 16 + zlib.MAX_WBITS))
+
+    def test_compresses_with_deflate(self):
+        body = b''.join(encoded_body(io.BytesIO(self.content), 'deflate'))
+
+        self.assertEqual(self.content, zlib.decompress(body))
+
+    def test_sends_deflated_zip_member_without_recompressing(self):
+        with zipfile.ZipFile(self.given_a_zip('a.zip', zipfile.ZIP_DEFLATED)) as archive:
+            member = ZipMember(archive, archive.getinfo('member.txt'), archive.filename)
+            with patch('zlib.compressobj') as mock_compressobj:
+                body = b''.join(encoded_body(member, 'gzip'))
+
+        self.assertFalse(mock_compressobj.called)
+        self.assertEqual(self.content, zlib.decompress(body, 16 + zlib.MAX_WBITS))
+
+    def test_compresses_member_of_zip_read_from_stream(self):
+        with open(self.given_a_zip('a.zip', zipfile.ZIP_DEFLATED), 'rb') as strm:
+            reader = ZipReader(strm)
+            member = dict(reader)['member.txt']
+            with patch.object(member, 'iter_raw') as mock_iter_raw:
+                body = b''.join(encoded_body(member, 'gzip'))
+            reader.close()
+
+        self.assertFalse(mock_iter_raw.called)
+        self.assertEqual(self.content, zlib.decompress(body, 16 + zlib.MAX_WBITS))
+
+    def test_compresses_stored_zip_member(self):
+        with zipfile.ZipFile(self.given_a_zip('a.zip', zipfile.ZIP_STORED)) as archive:
+            member = ZipMember(archive, archive.getinfo('member.txt'))
+            body = b''.join(encoded_body(member, 'gzip'))
+
+        self.assertEqual(self.content, zlib.decompress(body, 16 + zlib.MAX_WBITS))
+
+    @httpretty.activate
+    def test_posts_with_content_encoding(self):
+        self.given_server_endpoint()
+        self.poster = DozupPoster(self.endpoint_uri, content_encoding='gzip')
+
+        self.when_posting(file_content=self.content)
+
+        self.assertTrue(self.result)
+        self.assertEqual('gzip', httpretty.last_request().headers['Content-Encoding'])
+
+    def test_rejects_unknown_encoding(self):
+        with self.assertRaises(ValueError):
+            DozupPoster(self.endpoint_uri, content_encoding='br')
+
+    def given_a_zip(self, file_name, compress_type):
+        file_path = os.path.join(self.dir_path, file_name)
+        with zipfile.ZipFile(file_path, 'w', compress_type) as archive:
+            archive.writestr('ignored.txt', b'spacer')
+            archive.writestr('member.txt', self.content)
+        return file_path
+
+
+class PosterBatchTests(PosterTestMixin, unittest.TestCase):
+    status_code = 207
+
+    @httpretty.activate
+    def test_maps_per_item_results_to_tasks(self):
+        self.given_server_endpoint(json.dumps({'results': [
+            {'status': 201},
+            {'status': 503, 'error': 'Not today'},
+            {'status': 400},
+        ]}))
+
+        self.when_posting_batch(['a.txt', 'b.txt', 'c.txt'])
+
+        self.assertEqual([True, False, False], self.result)
+        self.assertEqual([DozupError(503, 'Not today'), DozupError(400, 'Bad Request')], list(self.poster.errors))
+        body = httpretty.last_request().body
+        self.assertIn(b'filename="a.txt"', body)
+        self.assertIn(b'content of c.txt', body)
+
+    @httpretty.activate
+    def test_fails_every_task_if_request_fails(self):
+        self.status_code = 503
+        self.given_server_endpoint('Sorry!', 'text/plain')
+
+        self.when_posting_batch(['a.txt', 'b.txt'])
+
+        self.assertEqual([False, False], self.result)
+        self.assertEqual([DozupError(503, 'Sorry!')], list(self.poster.errors))
+
+    @httpretty.activate
+    def test_fails_tasks_missing_from_results(self):
+        self.given_server_endpoint(json.dumps({'results': [{'status': 201}]}))
+
+        self.when_posting_batch(['a.txt', 'b.txt'])
+
+        self.assertEqual([True, False], self.result)
+        self.assertEqual([DozupError(207, 'No result for b.txt')], list(self.poster.errors))
+
+    @httpretty.activate
+    def test_fails_every_task_if_response_is_not_json_object(self):
+        for content in ['<html>Hello</html>', json.dumps([{'status': 201}]), json.dumps({'results': 'OK'})]:
+            self.poster.errors.clear()
+            self.given_server_endpoint(content)
+
+            self.when_posting_batch(['a.txt', 'b.txt'])
+
+            self.assertEqual([False, False], self.result)
+            self.assertEqual([DozupError(207, 'Malformed batch response')] * 2, list(self.poster.errors))
+
+    @httpretty.activate
+    def test_fails_tasks_with_malformed_results(self):
+        self.given_server_endpoint(json.dumps({'results': [201, {'status': 201}]}))
+
+        self.when_posting_batch(['a.txt', 'b.txt'])
+
+        self.assertEqual([False, True], self.result)
+        self.assertEqual([DozupError(207, 'Malformed result for a.txt')], list(self.poster.errors))
+
+    def when_posting_batch(self, file_names):
+        tasks = [Task(name, io.BytesIO(b'content of ' + name.encode('UTF-8'))) for name in file_names]
+        self.result = self.poster.post_batch(tasks)
+
+
+class PosterJournalTests(PosterTestMixin, unittest.TestCase):
+    status_code = 503
+
+    def setUp(self):
+        super(PosterJournalTests, self).setUp()
+        self.journal_path = os.path.join(self.dir_path, 'journal.jsonl')
+        self.journal = Journal(self.journal_path)
+        self.poster = DozupPoster(self.endpoint_uri, journal=self.journal, max_errors=2)
+
+    def tearDown(self):
+        self.journal.close()
+        super(PosterJournalTests, self).tearDown()
+
+    @httpretty.activate
+    def test_records_outcome_of_each_post(self):
+        self.given_server_endpoint('Sorry!', 'text/plain')
+        self.when_posting('a.txt', b'content of a')
+        self.status_code = 201
+        self.given_server_endpoint()
+        self.when_posting('b.txt', b'content of b!')
+
+        entries = self.then_journal_entries()
+
+        self.assertEqual(
+            [('a.txt', 503, 12, 'Sorry!'), ('b.txt', 201, 13, None)],
+            [(e['path'], e['status'], e['bytes'], e['error']) for e in entries])
+        self.assertTrue(all(e['seconds'] >= 0 for e in entries))
+
+    @httpretty.activate
+    def test_records_each_task_of_a_batch(self):
+        self.status_code = 207
+        self.given_server_endpoint(json.dumps({'results': [{'status': 201}, {'status': 400, 'error': 'Bad'}]}))
+
+        self.poster.post_batch([Task('a.txt', io.BytesIO(b'aaa')), Task('b.txt', io.BytesIO(b'bb'))])
+
+        self.assertEqual(
+            [('a.txt', 201, 3, None), ('b.txt', 400, 2, 'Bad')],
+            [(e['path'], e['status'], e['bytes'], e['error']) for e in self.then_journal_entries()])
+
+    @httpretty.activate
+    def test_keeps_only_most_recent_errors(self):
+        self.given_server_endpoint('Sorry!', 'text/plain')
+        for content in [b'1', b'2', b'3']:
+            self.when_posting(file_content=content)
+
+        self.assertEqual(2, len(self.poster.errors))
+        self.assertEqual(3, len(self.then_journal_entries()))
+
+    def then_journal_entries(self):
+        self.journal.flush()
+        with open(self.journal_path) as strm:
+            return [json.loads(line) for line in strm]
+
+
+class PacerTests(unittest.TestCase):
+    def setUp(self):
+        self.pacer = Pacer(max_in_flight=4, adaptive=True)
+        self.now = time.time()
+
+    def when_request_completes(self, status_code, seconds=0.1, retry_after=None):
+        with patch('time.time', return_value=self.now):
+            started = self.pacer.acquire()
+        self.now += seconds
+        with patch('time.time', return_value=self.now):
+            return self.pacer.release(started, status_code, retry_after)
+
+    def test_raises_limit_while_responses_are_ok(self):
+        for limit in [2.0, 2.5, 2.9, 3.2448, 3.553, 3.8345, 4.0]:
+            self.when_request_completes(201)
+            self.assertAlmostEqual(limit, self.pacer.limit, delta=0.001)
+
+    def test_halves_limit_on_overload(self):
+        for i in range(4):
+            self.when_request_completes(201)
+
+        is_cut = self.when_request_completes(429)
+
+        self.assertTrue(is_cut)
+        self.assertAlmostEqual(3.2448 / 2, self.pacer.limit, places=3)
+
+    def test_cuts_once_for_requests_sent_before_last_cut(self):
+        for i in range(4):
+            self.when_request_completes(201)
+        with patch('time.time', return_value=self.now):
+            first = self.pacer.acquire()
+            second = self.pacer.acquire()
+        with patch('time.time', return_value=self.now + 0.1):
+            self.assertTrue(self.pacer.release(first, 503))
+            self.assertFalse(self.pacer.release(second, 503))
+
+        self.assertAlmostEqual(3.2448 / 2, self.pacer.limit, places=3)
+
+    def test_cuts_limit_when_latency_rises(self):
+        for i in range(4):
+            self.when_request_completes(201, seconds=0.1)
+
+        self.assertTrue(self.when_request_completes(201, seconds=0.5))
+
+    def test_counts_connection_failure_as_overload(self):
+        self.when_request_completes(201)
+
+        self.assertTrue(self.when_request_completes(None))
+        self.assertEqual(1.0, self.pacer.limit)
+
+    def test_holds_up_requests_for_retry_after(self):
+        self.when_request_completes(503, retry_after=7)
+
+        self.assertAlmostEqual(self.now + 7, self.pacer.blocked_until, delta=0.01)
+
+    def test_fixed_limit_is_not_adjusted(self):
+        self.pacer = Pacer(max_in_flight=4)
+
+        self.when_request_completes(201)
+        self.when_request_completes(503)
+
+        self.assertEqual(4, self.pacer.limit)
+
+    def test_spaces_requests_to_max_rate(self):
+        pacer = Pacer(max_rate=20.0)
+        started = time.time()
+
+        for i in range(4):
+            pacer.release(pacer.acquire(), 201)
+
+        self.assertAlmostEqual(0.15, time.time() - started, delta=0.05)
+
+    def test_parses_retry_after_as_seconds_or_date(self):
+        self.assertEqual(120, parse_retry_after('120', 1000.0))
+        self.assertEqual(30, parse_retry_after('Thu, 01 Jan 1970 00:17:10 GMT', 1000.0))
+        self.assertIsNone(parse_retry_after('soon', 1000.0))
+        self.assertIsNone(parse_retry_after(None, 1000.0))
+
+
+class PosterPacingTests(PosterTestMixin, unittest.TestCase):
+    status_code = 429
+
+    @httpretty.activate
+    def test_honours_retry_after(self):
+        httpretty.register_uri(
+            httpretty.POST, self.endpoint_uri,
+            status=self.status_code, content_type='text/plain', body='Slow down',
+            adding_headers={'Retry-After': '7'})
+
+        self.when_posting()
+
+        self.assertAlmostEqual(time.time() + 7, self.poster.pacer.blocked_until, delta=1)
+
+    def test_frees_slot_when_reading_body_fails(self):
+        self.poster.pacer = Pacer(max_in_flight=4, adaptive=True)
+
+        with patch.object(self.poster.session, 'request', side_effect=IOError('Corrupt member')):
+            with self.assertRaises(IOError):
+                self.when_posting()
+
+        self.assertEqual(0, self.poster.pacer.in_flight)
+        self.assertEqual(0, self.poster.endpoints.endpoints[0].outstanding)
+
+
+class PosterRangeUploadTests(unittest.TestCase):
+    content = bytes(bytearray(i % 251 for i in range(10000)))
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupRangeUploadTests.')
+        self.file_path = os.path.join(self.dir_path, 'big.dat')
+        with open(self.file_path, 'wb') as strm:
+            strm.write(self.content)
+        self.state_path = os.path.join(self.dir_path, '.big.dat.upload')
+        self.server = StubServer().start()
+
+    def tearDown(self):
+        self.poster.endpoints.close()
+        self.server.stop()
+        shutil.rmtree(self.dir_path)
+
+    def given_poster(self, upload_parallelism=3):
+        self.poster = DozupPoster(
+            self.server.url, upload_threshold=5000, upload_chunk_size=1024, upload_parallelism=upload_parallelism)
+
+    def when_posting(self):
+        with open(self.file_path, 'rb') as strm:
+            return self.poster.post('big.dat', strm, self.state_path)
+
+    def test_uploads_large_file_in_ranges(self):
+        self.given_poster()
+
+        self.assertTrue(self.when_posting())
+
+        self.assertEqual([self.content], self.server.uploaded)
+        self.assertEqual(12, self.server.request_count)
+        self.assertFalse(os.path.exists(self.state_path))
+
+    def test_posts_small_file_in_one_go(self):
+        self.given_poster()
+        self.poster.upload_threshold = 20000
+
+        self.assertTrue(self.when_posting())
+
+        self.assertEqual([], self.server.uploaded)
+        self.assertEqual(1, self.server.request_count)
+
+    def test_resumes_from_last_acknowledged_range(self):
+        self.given_poster(upload_parallelism=1)
+        self.server.failing_ranges.add(4096)
+
+        self.assertFalse(self.when_posting())
+        with open(self.state_path, 'r') as strm:
+            self.assertEqual([0, 1, 2, 3], json.load(strm)['acknowledged'])
+        self.assertTrue(self.when_posting())
+
+        self.assertEqual([self.content], self.server.uploaded)
+        # The failed range was sent twice, the others once.
+        self.assertEqual(len(self.content) + 1024, self.server.byte_count)
+
+    def test_sends_ranges_to_endpoint_that_started_upload(self):
+        state = UploadState(self.state_path, self.file_path, 1024)
+        state.upload_url = urljoin(self.server.url, '/uploads/%s' % self.server.start_upload(len(self.content)))
+        state.save()
+        self.poster = DozupPoster(
+            Endpoints([Endpoint(self.server.url), Endpoint('http://127.0.0.1:1/drop/')]),
+            upload_threshold=5000, upload_chunk_size=1024, upload_parallelism=3)
+        starter = self.poster.endpoints.endpoints[0]
+        starter.outstanding = 5  # Otherwise the other would be chosen as the least busy.
+        chosen = []
+        acquire = self.poster.endpoints.acquire
+
+        def record_acquire(url):
+            chosen.append(acquire(url))
+            return chosen[-1]
+
+        with patch.object(self.poster.endpoints, 'acquire', side_effect=record_acquire):
+            self.assertTrue(self.when_posting())
+
+        self.assertEqual([starter] * 11, chosen)
+        self.assertEqual([self.content], self.server.uploaded)
+
+    def test_starts_again_if_server_forgets_upload(self):
+        self.given_poster(upload_parallelism=1)
+        self.server.failing_ranges.add(4096)
+        self.when_posting()
+        self.server.uploads.clear()
+
+        self.assertFalse(self.when_posting())
+        self.assertFalse(os.path.exists(self.state_path))
+        self.assertTrue(self.when_posting())
+
+        self.assertEqual([self.content], self.server.uploaded)
+
+
+class PosterRangeUploadUnsupportedTests(PosterTestMixin, unittest.TestCase):
+    status_code = 201
+
+    @httpretty.activate
+    def test_fails_if_server_gives_no_location_for_upload(self):
+        self.given_server_endpoint()
+        file_path = os.path.join(self.dir_path, 'big.dat')
+        with open(file_path, 'wb') as strm:
+            strm.write(b'x' * 10000)
+        self.poster.upload_threshold = 5000
+
+        with open(file_path, 'rb') as strm:
+            self.result = self.poster.post('big.dat', strm, os.path.join(self.dir_path, '.big.dat.upload'))
+
+        self.then_error_should_be('No Location for upload of big.dat')
+        self.assertEqual(1, len(httpretty.HTTPretty.latest_requests))
+
+
+class EndpointsTests(unittest.TestCase):
+    def setUp(self):
+        self.endpoints = Endpoints([
+            Endpoint('http://a.example.com/drop/', CircuitBreaker(failure_threshold=1)),
+            Endpoint('http://b.example.com/drop/', CircuitBreaker(failure_threshold=1)),
+            Endpoint('http://c.example.com/drop/', CircuitBreaker(failure_threshold=1)),
+        ])
+        self.a, self.b, self.c = self.endpoints.endpoints
+
+    def tearDown(self):
+        self.endpoints.close()
+
+    def test_takes_turns_when_none_outstanding(self):
+        chosen = []
+        for i in range(4):
+            endpoint = self.endpoints.acquire()
+            self.endpoints.release(endpoint)
+            chosen.append(endpoint)
+
+        self.assertEqual([self.a, self.b, self.c, self.a], chosen)
+
+    def test_chooses_endpoint_with_fewest_outstanding(self):
+        self.a.outstanding = 2
+        self.b.outstanding = 1
+        self.c.outstanding = 3
+
+        self.assertIs(self.b, self.endpoints.acquire())
+        self.assertEqual(2, self.b.outstanding)
+
+    def test_passes_over_ejected_endpoint(self):
+        self.a.circuit_breaker.record_failure()
+
+        chosen = [self.endpoints.acquire() for i in range(4)]
+
+        self.assertEqual([self.b, self.c, self.b, self.c], chosen)
+        self.assertEqual(0, self.endpoints.time_until_available())
+
+    def test_chooses_endpoint_soonest_back_if_all_ejected(self):
+        self.b.circuit_breaker.record_failure()
+        with patch('time.time', return_value=time.time() + 1):
+            self.c.circuit_breaker.record_failure()
+            self.a.circuit_breaker.record_failure()
+
+        self.assertIs(self.b, self.endpoints.acquire())
+        self.assertAlmostEqual(30, self.endpoints.time_until_available(), delta=1)
+
+    def test_sends_to_endpoint_owning_url(self):
+        self.assertIs(self.c, self.endpoints.acquire('http://c.example.com/drop/uploads/1'))
+
+    def test_sends_to_endpoint_on_same_host_whatever_the_path(self):
+        self.assertIs(self.b, self.endpoints.acquire('http://b.example.com:80/uploads/1'))
+
+    def test_tells_ports_apart(self):
+        endpoints = Endpoints([Endpoint('http://h:8000/drop/'), Endpoint('http://h/drop/'), Endpoint('http://h:8000/')])
+        self.assertIs(endpoints.endpoints[1], endpoints.acquire('http://h:80/drop/uploads/1'))
+        self.assertIs(endpoints.endpoints[0], endpoints.acquire('http://h:8000/drop/uploads/1'))
+        self.assertIs(endpoints.endpoints[2], endpoints.acquire('http://h:8000/uploads/1'))
+        endpoints.close()
+
+    def test_gives_each_poster_and_thread_its_own_session_sharing_the_pool(self):
+        poster, other_poster = DozupPoster(self.endpoints), DozupPoster(self.endpoints)
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(poster.session_for(self.a)))
+        thread.start()
+        thread.join()
+
+        self.assertIs(poster.session_for(self.a), poster.session_for(self.a))
+        self.assertIsNot(poster.session_for(self.a), other_poster.session_for(self.a))
+        self.assertIsNot(poster.session_for(self.a), sessions[0])
+        for session in [poster.session_for(self.a), other_poster.session_for(self.a), sessions[0]]:
+            self.assertIs(self.a.adapter, session.get_adapter('http://a.example.com/drop/'))
+
+
+class CircuitBreakerTests(PosterTestMixin, unittest.TestCase):
+    status_code = 503
+
+    def setUp(self):
+        super(CircuitBreakerTests, self).setUp()
+        self.poster = DozupPoster(self.endpoint_uri, CircuitBreaker(failure_threshold=2, reset_timeout=30))
+
+    @httpretty.activate
+    def test_opens_after_consecutive_server_failures(self):
+        self.given_server_endpoint('Sorry!', 'text/plain')
+
+        self.when_posting()
+        self.assertEqual(0, self.poster.time_until_available())
+        self.when_posting()
+
+        self.assertAlmostEqual(30, self.poster.time_until_available(), delta=1)
+
+    @httpretty.activate
+    def test_closes_after_success(self):
+        self.given_server_endpoint('Sorry!', 'text/plain')
+        self.when_posting()
+        self.when_posting()
+        self.status_code = 201
+
+        with patch('time.time', return_value=time.time() + 31):
+            self.assertEqual(0, self.poster.time_until_available())
+            self.given_server_endpoint()
+            self.when_posting()
+
+        self.assertEqual(0, self.poster.time_until_available())
+        self.assertEqual(0, self.poster.circuit_breaker.failure_count)
+
+    @httpretty.activate
+    def test_ignores_client_errors(self):
+        self.status_code = 400
+        self.given_server_endpoint('Bad file', 'text/plain')
+
+        self.when_posting()
+        self.when_posting()
+
+        self.assertEqual(0, self.poster.time_until_available())
+
+
 class PosterOKTests(PosterCreatedTests):
     status_code = 201
 
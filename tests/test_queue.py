@@ -1,15 +1,22 @@
 # -*- coding: UTF-8 -*-
 
 import errno
+import io
 import os
 import shutil
+import subprocess
+import sys
+import tarfile
 import tempfile
+import time
 import unittest
 import zipfile
 
 from mock import patch
 
 from dozup import DozupQueue
+from dozup.metrics import Metrics
+from dozup.queue import TarMember, TarReader, find_archive_reader, local_host_id, lzma, scandir, shard_of
 
 
 class OSTests(unittest.TestCase):
@@ -49,12 +56,95 @@ class OSTests(unittest.TestCase):
     given_claimed_file = when_claiming_file
 
 
-class DozupQueueTests(unittest.TestCase):
+class QueueTestMixin(object):
+    def create_a_file(self, relative_path, content=''):
+        subdir_path = os.path.join(self.dir_path, os.path.dirname(relative_path))
+        if not os.path.exists(subdir_path):
+            os.makedirs(subdir_path)
+        with open(os.path.join(self.dir_path, relative_path), 'wb') as strm:
+            strm.write(content)
+    given_a_file = create_a_file
+
+    def given_a_zip_archive(self, relative_path, file_name_contents):
+        subdir_path = os.path.join(self.dir_path, os.path.dirname(relative_path))
+        if not os.path.exists(subdir_path):
+            os.makedirs(subdir_path)
+        with open(os.path.join(self.dir_path, relative_path), 'wb') as strm:
+            archive = zipfile.ZipFile(strm, 'w', zipfile.ZIP_DEFLATED)
+            for file_name, contents in file_name_contents:
+                archive.writestr(file_name, contents.encode('UTF-8'))
+            archive.close()
+
+    def when_claiming_file(self):
+        self.file_path = self.dozup_queue.claim_file()
+
+    def when_claiming_file_but_a_concurrent_thread_snatches_the_first_away(self):
+        # The idea in the following is that another concurrent process claims
+        # the file between the call to find_file and os.rename.
+        real_rename = os.rename
+        spoo = {'first': True}
+
+        def snatched_away(src_path, dst_path):
+            if spoo['first']:
+                # Pretend the following happend on another thread:
+                real_rename(src_path, dst_path)
+                self.create_a_file('todo/lemonsundae/sock.txt')
+                spoo['first'] = False
+            real_rename(src_path, dst_path)
+
+        with patch.object(os, 'rename') as mock_rename:
+            mock_rename.side_effect = snatched_away
+            self.file_path = self.dozup_queue.claim_file()
+
+    def when_iterating_over_tasks(self):
+        self.tasks = set()
+        for task in self.dozup_queue.iter_tasks():
+            self.tasks.add((task, task.input.read()))
+
+    def when_iterating_over_tasks_pushing_them_back(self):
+        self.tasks = set()
+        for task in self.dozup_queue.iter_tasks():
+            self.tasks.add((task, task.input.read()))
+            task.push_back()
+
+    def when_iterating_over_tasks_pushing_back(self, task_name):
+        self.tasks = set()
+        for task in self.dozup_queue.iter_tasks():
+            self.tasks.add((task, task.input.read()))
+            if task.name == task_name:
+                task.push_back()
+
+    def when_iterating_over_tasks_pushing_back_those_in(self, dir_name):
+        self.tasks = set()
+        for task in self.dozup_queue.iter_tasks():
+            self.tasks.add((task, task.input.read()))
+            if task.name.startswith(dir_name + '/'):
+                task.push_back()
+
+    def then_file_should_be_claimed(self, file_path):
+        self.assertFalse(os.path.exists(os.path.join(self.dir_path, "todo", file_path)))
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, "doing", file_path)))
+
+    def then_file_should_be_done(self, file_path):
+        self.assertFalse(os.path.exists(os.path.join(self.dir_path, "doing", file_path)))
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, "done", file_path)))
+
+    def then_file_should_be_todo(self, file_path):
+        self.assertFalse(os.path.exists(os.path.join(self.dir_path, "doing", file_path)))
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, "todo", file_path)))
+
+    def then_tasks_should_have_names_and_contents(self, expected_filename_contents):
+        actual_filename_contents = set((task.name, content) for task, content in self.tasks)
+        self.assertEqual(expected_filename_contents, actual_filename_contents)
+
+
+class DozupQueueTests(QueueTestMixin, unittest.TestCase):
     def setUp(self):
         self.dir_path = tempfile.mkdtemp('.test', 'DozupQueueTests.')
         self.dozup_queue = DozupQueue(self.dir_path)
 
     def tearDown(self):
+        self.dozup_queue.close()
         shutil.rmtree(self.dir_path)
 
     def test_returns_a_false_value_when_no_file(self):
@@ -93,6 +183,42 @@ class DozupQueueTests(unittest.TestCase):
         self.assertEqual('lemonsundae/sock.txt', self.file_path)
         self.then_file_should_be_claimed(self.file_path)
 
+    def test_claims_files_in_name_order(self):
+        self.given_a_file('todo/b.txt')
+        self.given_a_file('todo/a/z.txt')
+        self.given_a_file('todo/a.txt')
+
+        claimed = [self.dozup_queue.claim_file() for i in range(4)]
+
+        self.assertEqual(['a.txt', 'b.txt', 'a/z.txt', None], claimed)
+
+    def test_finds_file_added_behind_the_cursor(self):
+        self.given_a_file('todo/a/one.txt')
+        self.given_a_file('todo/b/two.txt')
+        self.when_claiming_file()
+
+        self.given_a_file('todo/a/three.txt')
+
+        self.assertEqual('b/two.txt', self.dozup_queue.claim_file())
+        self.assertEqual('a/three.txt', self.dozup_queue.claim_file())
+        self.assertFalse(self.dozup_queue.claim_file())
+
+    def test_does_not_rescan_tree_for_each_claim(self):
+        for i in range(10):
+            self.given_a_file('todo/d%d/f%d.txt' % (i % 3, i))
+
+        with patch('dozup.queue.scandir', side_effect=scandir) as mock_scandir:
+            while self.dozup_queue.claim_file():
+                pass
+
+        # One pass over root and 3 subdirectories, plus the final empty pass.
+        self.assertEqual(4 + 4, mock_scandir.call_count)
+
+    def test_shards_are_the_same_everywhere(self):
+        self.assertEqual([1, 0, 0, 0], [shard_of(name, 2) for name in ['a.txt', 'b.txt', 'c.txt', 'd.txt']])
+        self.assertEqual(shard_of('a.txt', 2), shard_of(u'a.txt', 2))
+        self.assertEqual(shard_of(b'caf\xc3\xa9.txt', 7), shard_of(u'caf\xe9.txt', 7))
+
     def test_yields_file_names_and_streams_from_files(self):
         self.given_a_file('todo/foo/bar.txt', 'content of bar')
         self.given_a_zip_archive('todo/b/ar000001.zip', [
@@ -110,6 +236,17 @@ class DozupQueueTests(unittest.TestCase):
         self.then_file_should_be_done('foo/bar.txt')
         self.then_file_should_be_done('b/ar000001.zip')
 
+    def test_keeps_upload_state_of_whole_files_in_sidecar(self):
+        self.given_a_file('todo/foo/bar.txt', 'content of bar')
+        self.given_a_zip_archive('todo/b.zip', [('bee.txt', 'forst')])
+
+        state_paths = dict((task.name, task.state_path) for task in self.dozup_queue.iter_tasks())
+
+        self.assertEqual({
+            'foo/bar.txt': os.path.join(self.dir_path, 'doing', 'foo', '.bar.txt.upload'),
+            'b.zip/bee.txt': None,
+        }, state_paths)
+
     def test_pushes_file_back_to_todo_if_task_pushed_back(self):
         self.given_a_file('todo/foo/bar.txt', 'content of bar')
         self.given_a_file('todo/foo/baz.txt', 'content of baz')
@@ -135,68 +272,568 @@ class DozupQueueTests(unittest.TestCase):
         ]))
         self.then_file_should_be_todo('ar0000/ar000001.zip')
 
-    # Helpers
+    def test_resumes_pushed_back_zip_after_last_finished_member(self):
+        self.given_a_zip_archive('todo/ar0000/ar000001.zip', [
+            ('ar000001/bee.txt', 'forst'),
+            ('ar000001/cat.txt', 'seknd'),
+            ('ar000001/dog.txt', 'thurd'),
+        ])
+        self.when_iterating_over_tasks_pushing_back('ar0000/ar000001.zip/ar000001/cat.txt')
 
-    def create_a_file(self, relative_path, content=''):
-        subdir_path = os.path.join(self.dir_path, os.path.dirname(relative_path))
-        if not os.path.exists(subdir_path):
-            os.makedirs(subdir_path)
-        with open(os.path.join(self.dir_path, relative_path), 'wb') as strm:
-            strm.write(content)
-    given_a_file = create_a_file
+        self.when_iterating_over_tasks()
 
-    def given_a_zip_archive(self, relative_path, file_name_contents):
-        os.makedirs(os.path.join(self.dir_path, os.path.dirname(relative_path)))
-        with open(os.path.join(self.dir_path, relative_path), 'wb') as strm:
-            archive = zipfile.ZipFile(strm, 'w', zipfile.ZIP_DEFLATED)
-            for file_name, contents in file_name_contents:
-                archive.writestr(file_name, contents.encode('UTF-8'))
-            archive.close()
+        self.then_tasks_should_have_names_and_contents(set([
+            ('ar0000/ar000001.zip/ar000001/cat.txt', 'seknd'),
+            ('ar0000/ar000001.zip/ar000001/dog.txt', 'thurd'),
+        ]))
+        self.then_file_should_be_done('ar0000/ar000001.zip')
+        self.assertFalse(os.path.exists(os.path.join(self.dir_path, 'doing', 'ar0000', '.ar000001.zip.progress')))
 
-    def when_claiming_file(self):
-        self.file_path = self.dozup_queue.claim_file()
+    def test_ignores_progress_of_a_different_archive(self):
+        self.given_a_zip_archive('todo/ar0000/ar000001.zip', [
+            ('ar000001/bee.txt', 'forst'),
+            ('ar000001/cat.txt', 'seknd'),
+        ])
+        self.when_iterating_over_tasks_pushing_back('ar0000/ar000001.zip/ar000001/cat.txt')
+        os.remove(os.path.join(self.dir_path, 'todo/ar0000/ar000001.zip'))
+        self.given_a_zip_archive('todo/ar0000/ar000001.zip', [
+            ('ar000001/ant.txt', 'nyoo'),
+        ])
 
-    def when_claiming_file_but_a_concurrent_thread_snatches_the_first_away(self):
-        # The idea in the following is that another concurrent process claims
-        # the file between the call to find_file and os.rename.
-        real_rename = os.rename
-        spoo = {'first': True}
+        self.when_iterating_over_tasks()
 
-        def snatched_away(src_path, dst_path):
-            if spoo['first']:
-                # Pretend the following happend on another thread:
-                real_rename(src_path, dst_path)
-                self.create_a_file('todo/lemonsundae/sock.txt')
-                spoo['first'] = False
-            real_rename(src_path, dst_path)
+        self.then_tasks_should_have_names_and_contents(set([
+            ('ar0000/ar000001.zip/ar000001/ant.txt', 'nyoo'),
+        ]))
 
-        with patch.object(os, 'rename') as mock_rename:
-            mock_rename.side_effect = snatched_away
-            self.file_path = self.dozup_queue.claim_file()
+    def test_yields_batches_spanning_files_and_members(self):
+        self.given_a_file('todo/a.txt', 'content of a')
+        self.given_a_zip_archive('todo/b.zip', [
+            ('bee.txt', 'forst'),
+            ('cat.txt', 'seknd'),
+        ])
+        self.given_a_file('todo/c.txt', 'content of c')
+
+        batches = [[(task.name, task.input.read()) for task in batch]
+                   for batch in self.dozup_queue.iter_batches(max_count=2)]
+
+        self.assertEqual([
+            [('a.txt', 'content of a'), ('b.zip/bee.txt', 'forst')],
+            [('b.zip/cat.txt', 'seknd'), ('c.txt', 'content of c')],
+        ], batches)
+        self.then_file_should_be_done('a.txt')
+        self.then_file_should_be_done('b.zip')
+        self.then_file_should_be_done('c.txt')
+
+    def test_stops_batching_after_push_back_and_resumes_archive(self):
+        self.given_a_zip_archive('todo/b.zip', [
+            ('bee.txt', 'forst'),
+            ('cat.txt', 'seknd'),
+            ('dog.txt', 'thurd'),
+        ])
+        self.given_a_file('todo/c.txt', 'content of c')
 
-    def when_iterating_over_tasks(self):
-        self.tasks = set()
-        for task in self.dozup_queue.iter_tasks():
-            self.tasks.add((task, task.input.read()))
+        for batch in self.dozup_queue.iter_batches(max_count=2):
+            batch[1].push_back()
 
-    def when_iterating_over_tasks_pushing_them_back(self):
-        self.tasks = set()
-        for task in self.dozup_queue.iter_tasks():
-            self.tasks.add((task, task.input.read()))
+        self.then_file_should_be_todo('b.zip')
+        self.then_file_should_be_todo('c.txt')
+        self.when_iterating_over_tasks()
+        self.then_tasks_should_have_names_and_contents(set([
+            ('b.zip/cat.txt', 'seknd'),
+            ('b.zip/dog.txt', 'thurd'),
+            ('c.txt', 'content of c'),
+        ]))
+
+    def test_abandoning_batches_files_away_tasks_already_settled(self):
+        for name in ['a.txt', 'b.txt', 'c.txt', 'd.txt']:
+            self.given_a_file('todo/' + name, 'content of ' + name)
+
+        batches = self.dozup_queue.iter_batches(max_count=2)
+        next(batches)
+        next(batches)
+        batches.close()
+
+        self.then_file_should_be_done('a.txt')
+        self.then_file_should_be_done('b.txt')
+        self.then_file_should_be_todo('c.txt')
+        self.then_file_should_be_todo('d.txt')
+
+    def test_limits_batch_by_bytes(self):
+        self.given_a_file('todo/a.txt', 'x' * 10)
+        self.given_a_file('todo/b.txt', 'y' * 10)
+
+        batches = [[task.name for task in batch]
+                   for batch in self.dozup_queue.iter_batches(max_count=10, max_bytes=10)]
+
+        self.assertEqual([['a.txt'], ['b.txt']], batches)
+
+    def test_abandoning_iteration_returns_file_to_todo(self):
+        self.given_a_file('todo/foo/bar.txt', 'content of bar')
+
+        tasks = self.dozup_queue.iter_tasks()
+        next(tasks)
+        tasks.close()
+
+        self.then_file_should_be_todo('foo/bar.txt')
+
+    def test_claims_batch_of_files_in_one_go(self):
+        for name in ['a.txt', 'b.txt', 'c.txt']:
+            self.given_a_file('todo/foo/' + name, 'content')
+
+        file_paths = self.dozup_queue.claim_batch(2)
+
+        self.assertEqual(['foo/a.txt', 'foo/b.txt'], file_paths)
+        self.then_file_should_be_claimed('foo/a.txt')
+        self.then_file_should_be_claimed('foo/b.txt')
+        self.then_file_should_be_todo('foo/c.txt')
+        self.assertEqual(set(file_paths), self.dozup_queue.leases)
+        self.dozup_queue.release_files(file_paths)
+
+    def test_works_through_claimed_batches(self):
+        for name in ['a.txt', 'b.txt', 'c.txt']:
+            self.given_a_file('todo/' + name, 'content of ' + name)
+
+        names = [task.name for task in self.dozup_queue.iter_tasks(claim_count=2)]
+
+        self.assertEqual(['a.txt', 'b.txt', 'c.txt'], names)
+        self.then_file_should_be_done('c.txt')
+
+    def test_returns_rest_of_batch_to_todo_when_abandoned(self):
+        for name in ['a.txt', 'b.txt', 'c.txt']:
+            self.given_a_file('todo/' + name, 'content of ' + name)
+
+        tasks = self.dozup_queue.iter_tasks(claim_count=3)
+        next(tasks)
+        tasks.close()
+
+        for name in ['a.txt', 'b.txt', 'c.txt']:
+            self.then_file_should_be_todo(name)
+        self.assertEqual(set(), self.dozup_queue.leases)
+
+    def test_returns_rest_of_batch_to_todo_after_push_back(self):
+        for name in ['a.txt', 'b.txt', 'c.txt']:
+            self.given_a_file('todo/' + name, 'content of ' + name)
+
+        for task in self.dozup_queue.iter_tasks(claim_count=3):
             task.push_back()
 
-    def then_file_should_be_claimed(self, file_path):
-        self.assertFalse(os.path.exists(os.path.join(self.dir_path, "todo", file_path)))
-        self.assertTrue(os.path.exists(os.path.join(self.dir_path, "doing", file_path)))
+        for name in ['a.txt', 'b.txt', 'c.txt']:
+            self.then_file_should_be_todo(name)
 
-    def then_file_should_be_done(self, file_path):
-        self.assertFalse(os.path.exists(os.path.join(self.dir_path, "doing", file_path)))
-        self.assertTrue(os.path.exists(os.path.join(self.dir_path, "done", file_path)))
 
-    def then_file_should_be_todo(self, file_path):
-        self.assertFalse(os.path.exists(os.path.join(self.dir_path, "doing", file_path)))
-        self.assertTrue(os.path.exists(os.path.join(self.dir_path, "todo", file_path)))
+def tar_bytes(file_name_contents, mode='w'):
+    buf = io.BytesIO()
+    archive = tarfile.open(fileobj=buf, mode=mode)
+    for file_name, content in file_name_contents:
+        info = tarfile.TarInfo(file_name)
+        info.size = len(content)
+        archive.addfile(info, io.BytesIO(content))
+    archive.close()
+    return buf.getvalue()
 
-    def then_tasks_should_have_names_and_contents(self, expected_filename_contents):
-        actual_filename_contents = set((task.name, content) for task, content in self.tasks)
-        self.assertEqual(expected_filename_contents, actual_filename_contents)
+
+def zip_bytes(file_name_contents):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for file_name, content in file_name_contents:
+            archive.writestr(file_name, content)
+    return buf.getvalue()
+
+
+class DozupQueueArchiveTests(QueueTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupQueueTests.')
+        self.dozup_queue = DozupQueue(self.dir_path)
+
+    def tearDown(self):
+        self.dozup_queue.close()
+        shutil.rmtree(self.dir_path)
+
+    def test_streams_members_of_compressed_tar(self):
+        for suffix, mode in [('.tar', 'w'), ('.tar.gz', 'w:gz'), ('.tbz2', 'w:bz2')]:
+            self.given_a_file('todo/a%s' % suffix, tar_bytes([('x/bee.txt', b'forst'), ('cat.txt', b'seknd')], mode))
+
+        self.when_iterating_over_tasks()
+
+        self.then_tasks_should_have_names_and_contents(set(
+            (name % suffix, content)
+            for suffix in ['.tar', '.tar.gz', '.tbz2']
+            for name, content in [('a%s/x/bee.txt', b'forst'), ('a%s/cat.txt', b'seknd')]))
+        self.then_file_should_be_done('a.tar.gz')
+
+    def test_expands_archives_within_archives(self):
+        self.given_a_file('todo/a.tgz', tar_bytes([
+            ('one.txt', b'forst'),
+            ('inner.zip', zip_bytes([('two.txt', b'seknd'), ('deeper.tar', tar_bytes([('three.txt', b'thurd')]))])),
+        ], 'w:gz'))
+
+        self.when_iterating_over_tasks()
+
+        self.then_tasks_should_have_names_and_contents(set([
+            ('a.tgz/one.txt', b'forst'),
+            ('a.tgz/inner.zip/two.txt', b'seknd'),
+            ('a.tgz/inner.zip/deeper.tar/three.txt', b'thurd'),
+        ]))
+
+    def test_resumes_pushed_back_tar_after_last_finished_member(self):
+        self.given_a_file('todo/a.tar.gz', tar_bytes([
+            ('bee.txt', b'forst'),
+            ('inner.tar', tar_bytes([('cat.txt', b'seknd'), ('dog.txt', b'thurd')])),
+        ], 'w:gz'))
+        self.when_iterating_over_tasks_pushing_back('a.tar.gz/inner.tar/dog.txt')
+
+        self.when_iterating_over_tasks()
+
+        self.then_tasks_should_have_names_and_contents(set([
+            ('a.tar.gz/inner.tar/dog.txt', b'thurd'),
+        ]))
+        self.then_file_should_be_done('a.tar.gz')
+
+    def test_pushes_back_unreadable_archive(self):
+        self.given_a_file('todo/a.txt', 'content of a')
+        self.given_a_file('todo/b.tgz', 'not a tar')
+        self.given_a_file('todo/c.txt', 'content of c')
+
+        self.when_iterating_over_tasks()
+
+        self.then_tasks_should_have_names_and_contents(set([('a.txt', b'content of a')]))
+        self.then_file_should_be_done('a.txt')
+        self.then_file_should_be_todo('b.tgz')
+        self.then_file_should_be_todo('c.txt')
+
+    def test_sends_batch_so_far_before_stopping_at_unreadable_archive(self):
+        self.given_a_file('todo/a.txt', 'content of a')
+        self.given_a_file('todo/b.zip', 'not a zip')
+        self.given_a_file('todo/c.txt', 'content of c')
+
+        batches = list(self.dozup_queue.iter_batches(max_count=10))
+
+        self.assertEqual([['a.txt']], [[task.name for task in batch] for batch in batches])
+        self.then_file_should_be_done('a.txt')
+        self.then_file_should_be_todo('b.zip')
+        self.then_file_should_be_todo('c.txt')
+
+    def test_reads_xz_tar_only_if_lzma_available(self):
+        self.assertEqual(TarReader if lzma else None, find_archive_reader('a.tar.xz'))
+
+    def test_rewinds_small_tar_member(self):
+        with tarfile.open(fileobj=io.BytesIO(tar_bytes([('bee.txt', b'forst')]))) as archive:
+            info = archive.next()
+            member = TarMember(archive.extractfile(info), info)
+
+            self.assertEqual(b'for', member.read(3))
+            member.seek(0)
+            self.assertEqual(b'forst', member.read())
+
+    def test_cannot_rewind_large_tar_member_once_read(self):
+        with tarfile.open(fileobj=io.BytesIO(tar_bytes([('bee.txt', b'forst')]))) as archive:
+            info = archive.next()
+            member = TarMember(archive.extractfile(info), info)
+            member.can_rewind = False
+
+            member.seek(0)
+            self.assertEqual(b'for', member.read(3))
+            with self.assertRaises(IOError):
+                member.seek(0)
+
+
+class DozupQueueShardTests(QueueTestMixin, unittest.TestCase):
+    # a.txt is in shard 1 of 2; b.txt, c.txt and d.txt in shard 0.
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupQueueTests.')
+        for name in ['a.txt', 'b.txt', 'c.txt', 'd.txt']:
+            self.given_a_file('todo/' + name)
+
+    def tearDown(self):
+        self.dozup_queue.close()
+        shutil.rmtree(self.dir_path)
+
+    def test_claims_files_in_own_shard_first(self):
+        self.dozup_queue = DozupQueue(self.dir_path, shard=(0, 2))
+
+        claimed = [self.dozup_queue.claim_file() for i in range(5)]
+
+        self.assertEqual(['b.txt', 'c.txt', 'd.txt', 'a.txt', None], claimed)
+
+    def test_steals_from_end_of_other_shards_once_own_is_empty(self):
+        metrics = Metrics()
+        self.dozup_queue = DozupQueue(self.dir_path, shard=(1, 2), metrics=metrics)
+
+        claimed = [self.dozup_queue.claim_file() for i in range(5)]
+
+        self.assertEqual(['a.txt', 'd.txt', 'c.txt', 'b.txt', None], claimed)
+        self.assertEqual(3, metrics.snapshot()['counters']['stolen'])
+
+    def test_finds_own_files_added_while_stealing_on_next_pass(self):
+        self.dozup_queue = DozupQueue(self.dir_path, shard=(1, 2))
+        self.dozup_queue.claim_file()
+        self.dozup_queue.claim_file()
+
+        self.given_a_file('todo/f.txt')
+
+        self.assertEqual('c.txt', self.dozup_queue.claim_file())
+        self.assertEqual('b.txt', self.dozup_queue.claim_file())
+        self.assertEqual('f.txt', self.dozup_queue.claim_file())
+
+
+class DozupQueueLaneTests(QueueTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupQueueTests.')
+        self.now = time.time()
+
+    def tearDown(self):
+        self.dozup_queue.close()
+        shutil.rmtree(self.dir_path)
+
+    def given_a_file_of_age(self, relative_path, age):
+        self.given_a_file(relative_path)
+        mtime = self.now - age
+        os.utime(os.path.join(self.dir_path, relative_path), (mtime, mtime))
+
+    def test_claims_oldest_file_first(self):
+        self.given_a_file_of_age('todo/a/new.txt', 10)
+        self.given_a_file_of_age('todo/b/old.txt', 300)
+        self.given_a_file_of_age('todo/middling.txt', 60)
+        self.dozup_queue = DozupQueue(self.dir_path, lanes=[])
+
+        claimed = [self.dozup_queue.claim_file() for i in range(4)]
+
+        self.assertEqual(['b/old.txt', 'middling.txt', 'a/new.txt', None], claimed)
+
+    def test_claims_from_lanes_in_order(self):
+        self.given_a_file_of_age('todo/bulk/old.txt', 300)
+        self.given_a_file_of_age('todo/other.txt', 400)
+        self.given_a_file_of_age('todo/urgent/new.txt', 10)
+        self.given_a_file_of_age('todo/urgent/old.txt', 100)
+        self.given_a_file_of_age('todo/normal/new.txt', 20)
+        self.dozup_queue = DozupQueue(self.dir_path, lanes=['urgent', 'normal'])
+
+        claimed = [self.dozup_queue.claim_file() for i in range(6)]
+
+        self.assertEqual(
+            ['urgent/old.txt', 'urgent/new.txt', 'normal/new.txt', 'other.txt', 'bulk/old.txt', None],
+            claimed)
+
+    def test_urgent_file_overtakes_backlog_after_rescan_interval(self):
+        for i in range(3):
+            self.given_a_file_of_age('todo/bulk/f%d.txt' % i, 300 - i)
+        self.dozup_queue = DozupQueue(self.dir_path, poll_interval=5.0, lanes=['urgent'])
+        self.assertEqual('bulk/f0.txt', self.dozup_queue.claim_file())
+
+        self.given_a_file_of_age('todo/urgent/late.txt', 0)
+
+        self.assertEqual('bulk/f1.txt', self.dozup_queue.claim_file())
+        with patch('time.time', return_value=self.now + 6):
+            self.assertEqual('urgent/late.txt', self.dozup_queue.claim_file())
+        self.assertEqual('bulk/f2.txt', self.dozup_queue.claim_file())
+
+    def test_does_not_rescan_tree_for_each_claim(self):
+        for i in range(10):
+            self.given_a_file_of_age('todo/d%d/f%d.txt' % (i % 3, i), i)
+        self.dozup_queue = DozupQueue(self.dir_path, lanes=[])
+
+        with patch('dozup.queue.scandir', side_effect=scandir) as mock_scandir:
+            while self.dozup_queue.claim_file():
+                pass
+
+        # One pass over root and 3 subdirectories, plus the final empty pass.
+        self.assertEqual(4 + 4, mock_scandir.call_count)
+
+
+class DozupQueueLeaseTests(QueueTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupQueueTests.')
+        self.dozup_queue = DozupQueue(self.dir_path, lease_timeout=60)
+        self.now = time.time()
+
+    def tearDown(self):
+        self.dozup_queue.close()
+        shutil.rmtree(self.dir_path)
+
+    def given_a_claimed_file(self, relative_path, owner=None, age=0):
+        self.given_a_file('doing/' + relative_path)
+        if owner is not None:
+            dir_path, name = os.path.split(relative_path)
+            lease_path = os.path.join(self.dir_path, 'doing', dir_path, '.%s.lease' % name)
+            with open(lease_path, 'w') as strm:
+                strm.write(owner + '\n')
+            os.utime(lease_path, (self.now - age, self.now - age))
+
+    def then_lease_should_exist(self, file_path, exists=True):
+        dir_path, name = os.path.split(file_path)
+        lease_path = os.path.join(self.dir_path, 'doing', dir_path, '.%s.lease' % name)
+        self.assertEqual(exists, os.path.exists(lease_path))
+        return lease_path
+
+    def test_claim_has_lease_naming_owner(self):
+        self.given_a_file('todo/foo/bar.txt')
+
+        self.when_claiming_file()
+
+        with open(self.then_lease_should_exist('foo/bar.txt')) as strm:
+            self.assertEqual('%s %d' % (local_host_id(), os.getpid()), strm.read().strip())
+
+    def test_drops_lease_once_done(self):
+        self.given_a_file('todo/foo/bar.txt')
+
+        self.when_iterating_over_tasks()
+
+        self.then_file_should_be_done('foo/bar.txt')
+        self.then_lease_should_exist('foo/bar.txt', False)
+
+    def test_starts_heartbeat_once_until_closed(self):
+        self.given_a_file('todo/foo/bar.txt')
+        self.given_a_file('todo/foo/baz.txt')
+
+        with patch.object(self.dozup_queue, 'start_heartbeat', wraps=self.dozup_queue.start_heartbeat) as mock_start:
+            self.when_iterating_over_tasks()
+        heartbeat_stop = self.dozup_queue.heartbeat_stop
+        self.dozup_queue.close()
+
+        self.assertEqual(1, mock_start.call_count)
+        self.assertTrue(heartbeat_stop.is_set())
+        self.assertIsNone(self.dozup_queue.heartbeat_stop)
+
+    def test_renews_leases(self):
+        self.given_a_file('todo/foo/bar.txt')
+        self.when_claiming_file()
+        lease_path = self.then_lease_should_exist('foo/bar.txt')
+        os.utime(lease_path, (self.now - 50, self.now - 50))
+
+        self.dozup_queue.renew_leases()
+
+        self.assertAlmostEqual(self.now, os.stat(lease_path).st_mtime, delta=5)
+
+    def test_recovers_claim_with_stale_lease(self):
+        self.given_a_claimed_file('foo/bar.txt', 'elsewhere 123', age=61)
+
+        recovered = self.dozup_queue.recover_claims()
+
+        self.assertEqual(['foo/bar.txt'], recovered)
+        self.then_file_should_be_todo('foo/bar.txt')
+        self.then_lease_should_exist('foo/bar.txt', False)
+
+    def test_leaves_claim_with_fresh_lease(self):
+        self.given_a_claimed_file('foo/bar.txt', 'elsewhere 123', age=10)
+
+        self.assertEqual([], self.dozup_queue.recover_claims())
+        self.then_file_should_be_claimed('foo/bar.txt')
+
+    def test_recovers_claim_of_exited_process_on_this_host(self):
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        self.given_a_claimed_file('foo/bar.txt', '%s %d' % (local_host_id(), process.pid), age=10)
+
+        self.assertEqual(['foo/bar.txt'], self.dozup_queue.recover_claims())
+
+    def test_leaves_own_claims(self):
+        self.given_a_file('todo/foo/bar.txt')
+        self.when_claiming_file()
+        os.utime(self.then_lease_should_exist('foo/bar.txt'), (self.now - 61, self.now - 61))
+
+        self.assertEqual([], self.dozup_queue.recover_claims())
+
+    def test_recovers_claim_without_lease_only_once_old(self):
+        self.given_a_claimed_file('foo/bar.txt')
+
+        self.assertEqual([], self.dozup_queue.recover_claims())
+        with patch('time.time', return_value=self.now + 61):
+            self.assertEqual(['foo/bar.txt'], self.dozup_queue.recover_claims())
+
+    def test_carries_on_if_file_recovered_from_under_it(self):
+        self.given_a_file('todo/foo/bar.txt')
+
+        for task in self.dozup_queue.iter_tasks():
+            # Recovered and claimed again by another process.
+            os.mkdir(os.path.join(self.dir_path, 'elsewhere'))
+            os.rename(
+                os.path.join(self.dir_path, 'doing/foo/bar.txt'),
+                os.path.join(self.dir_path, 'elsewhere/bar.txt'))
+
+        self.assertFalse(os.path.exists(os.path.join(self.dir_path, 'done', 'foo', 'bar.txt')))
+        self.then_lease_should_exist('foo/bar.txt', False)
+
+
+class DozupQueueRetryTests(QueueTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupQueueTests.')
+        self.dozup_queue = DozupQueue(self.dir_path, retry_delay=30)
+        self.now = time.time()
+
+    def tearDown(self):
+        self.dozup_queue.close()
+        shutil.rmtree(self.dir_path)
+
+    def test_parks_file_and_carries_on_if_task_pushed_back(self):
+        self.given_a_file('todo/foo/bar.txt', 'content of bar')
+        self.given_a_file('todo/goo/baz.txt', 'content of baz')
+
+        self.when_iterating_over_tasks_pushing_back_those_in('foo')
+
+        self.then_tasks_should_have_names_and_contents(set([
+            ('foo/bar.txt', 'content of bar'),
+            ('goo/baz.txt', 'content of baz'),
+        ]))
+        self.then_file_should_be_parked('foo/bar.txt', 1, self.now + 30)
+        self.then_file_should_be_done('goo/baz.txt')
+
+    def test_parks_zip_if_task_pushed_back(self):
+        self.given_a_zip_archive('todo/ar0000/ar000001.zip', [
+            ('ar000001/bee.txt', 'forst'),
+        ])
+
+        self.when_iterating_over_tasks_pushing_them_back()
+
+        self.then_file_should_be_parked('ar0000/ar000001.zip', 1, self.now + 30)
+
+    def test_parks_unreadable_archive_and_carries_on(self):
+        self.given_a_file('todo/a.tgz', 'not a tar')
+        self.given_a_file('todo/b.txt', 'content of b')
+
+        self.when_iterating_over_tasks()
+
+        self.then_tasks_should_have_names_and_contents(set([('b.txt', 'content of b')]))
+        self.then_file_should_be_parked('a.tgz', 1, self.now + 30)
+        self.then_file_should_be_done('b.txt')
+
+    def test_does_not_claim_parked_file_until_due(self):
+        self.given_a_file('todo/foo/bar.txt', 'content of bar')
+        self.when_iterating_over_tasks_pushing_them_back()
+
+        self.assertFalse(self.dozup_queue.claim_file())
+        with patch('time.time', return_value=self.now + 31):
+            self.assertEqual('foo/bar.txt', self.dozup_queue.claim_file())
+
+    def test_doubles_delay_with_each_attempt(self):
+        self.given_a_file('todo/foo/bar.txt', 'content of bar')
+        self.when_iterating_over_tasks_pushing_them_back()
+        with patch('time.time', return_value=self.now + 31):
+            self.when_iterating_over_tasks_pushing_them_back()
+
+        self.then_file_should_be_parked('foo/bar.txt', 2, self.now + 31 + 60)
+
+    def test_finds_files_parked_by_other_processes(self):
+        self.given_a_file('todo/foo/bar.txt', 'content of bar')
+        self.when_iterating_over_tasks_pushing_them_back()
+
+        other_queue = DozupQueue(self.dir_path, retry_delay=30)
+        with patch('time.time', return_value=self.now + 31):
+            self.assertEqual('foo/bar.txt', other_queue.claim_file())
+        other_queue.close()
+
+    def test_forgets_attempts_once_done(self):
+        self.given_a_file('todo/foo/bar.txt', 'content of bar')
+        self.when_iterating_over_tasks_pushing_them_back()
+        with patch('time.time', return_value=self.now + 31):
+            self.when_iterating_over_tasks()
+
+        self.then_file_should_be_done('foo/bar.txt')
+        self.assertFalse(os.path.exists(os.path.join(self.dir_path, 'retry', 'foo', '.bar.txt.retry')))
+
+    def then_file_should_be_parked(self, file_path, attempts, due):
+        self.assertFalse(os.path.exists(os.path.join(self.dir_path, 'doing', file_path)))
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, 'retry', file_path)))
+        actual_attempts, actual_due = self.dozup_queue.read_retry_sidecar(file_path)
+        self.assertEqual(attempts, actual_attempts)
+        self.assertAlmostEqual(due, actual_due, delta=5)
@@ -0,0 +1,209 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock, patch
+
+from dozup import DozupQueue
+from dozup.cli import stats
+from dozup.stats import BacklogStats
+
+
+class BacklogStatsTests(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupBacklogStatsTests.')
+        self.stats = BacklogStats(os.path.join(self.dir_path, 'stats.sqlite3'))
+
+    def tearDown(self):
+        self.stats.close()
+        shutil.rmtree(self.dir_path)
+
+    def test_counts_pending_files_once(self):
+        self.given_pending([('a.txt', 10, 1000.0), ('b.txt', 20, 2000.0)])
+        self.given_pending([('a.txt', 10, 1000.0)])
+
+        with patch('time.time', return_value=1600.0):
+            counts = self.stats.read()
+
+        self.assertEqual(2, counts['pending_files'])
+        self.assertEqual(30, counts['pending_bytes'])
+        self.assertEqual(600.0, counts['oldest_pending_seconds'])
+
+    def test_ignores_files_claimed_since_being_listed(self):
+        self.given_pending([('a.txt', 10, 1000.0)])
+
+        self.stats.add_pending([('a.txt', 10, 1000.0), ('b.txt', 20, 2000.0)], os.path.join(self.dir_path, 'todo'))
+
+        self.assertEqual(1, self.stats.read()['pending_files'])
+
+    def test_moves_claimed_files_to_in_flight(self):
+        self.given_pending([('a.txt', 10, 1000.0), ('b.txt', 20, 2000.0)])
+
+        self.stats.claimed(['a.txt'])
+
+        counts = self.stats.read()
+        self.assertEqual(1, counts['pending_files'])
+        self.assertEqual(20, counts['pending_bytes'])
+        self.assertEqual(1, counts['in_flight_files'])
+
+    def test_counts_done_files_and_tasks(self):
+        self.given_pending([('a.zip', 10, 1000.0)])
+        self.stats.claimed(['a.zip'])
+
+        self.stats.finished(3)
+
+        counts = self.stats.read()
+        self.assertEqual(0, counts['in_flight_files'])
+        self.assertEqual(1, counts['done_files'])
+        self.assertEqual(3, counts['done_tasks'])
+
+    def test_counts_pushed_back_files_as_pending_again(self):
+        self.given_pending([('a.txt', 10, 1000.0)])
+        self.stats.claimed(['a.txt'])
+
+        self.stats.returned('a.txt', 10, 1000.0, is_pushed_back=True)
+
+        counts = self.stats.read()
+        self.assertEqual(1, counts['pending_files'])
+        self.assertEqual(0, counts['in_flight_files'])
+        self.assertEqual(1, counts['pushed_back_files'])
+
+    def test_writes_claims_and_finishes_together(self):
+        self.given_pending([('a.txt', 10, 1000.0)])
+        self.stats.flush_interval = 60.0
+        other = BacklogStats(os.path.join(self.dir_path, 'stats.sqlite3'))
+
+        self.stats.claimed(['a.txt'])
+        self.stats.finished(1)
+        before_flush = other.read()
+        self.stats.read()
+        after_flush = other.read()
+        other.close()
+
+        self.assertEqual((1, 0), (before_flush['pending_files'], before_flush['done_files']))
+        self.assertEqual((0, 1), (after_flush['pending_files'], after_flush['done_files']))
+
+    def test_keeps_counts_between_instances(self):
+        self.given_pending([('a.txt', 10, 1000.0)])
+        self.stats.close()
+
+        self.stats = BacklogStats(os.path.join(self.dir_path, 'stats.sqlite3'))
+
+        self.assertEqual(1, self.stats.read()['pending_files'])
+
+    def test_resync_recounts_files_waiting_and_in_flight(self):
+        self.given_pending([('gone.txt', 10, 1000.0)])
+        os.remove(os.path.join(self.dir_path, 'todo', 'gone.txt'))
+        self.stats.finished(1)
+        self.given_file(os.path.join('todo', 'a', 'b.txt'), b'12345')
+        self.given_file(os.path.join('retry', 'c.txt'), b'123')
+        self.given_file(os.path.join('retry', '.c.txt.retry'), b'{}')
+        self.given_file(os.path.join('doing', 'd.txt'), b'1')
+
+        self.stats.resync(
+            [os.path.join(self.dir_path, 'todo'), os.path.join(self.dir_path, 'retry')],
+            os.path.join(self.dir_path, 'doing'))
+
+        counts = self.stats.read()
+        self.assertEqual(2, counts['pending_files'])
+        self.assertEqual(8, counts['pending_bytes'])
+        self.assertEqual(1, counts['in_flight_files'])
+        self.assertEqual(1, counts['done_files'])
+
+    def given_pending(self, files):
+        for file_path, size, modified_at in files:
+            self.given_file(os.path.join('todo', file_path), b'x' * size)
+        self.stats.add_pending(files, os.path.join(self.dir_path, 'todo'))
+
+    def given_file(self, rel_path, content):
+        file_path = os.path.join(self.dir_path, rel_path)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(file_path, 'wb') as strm:
+            strm.write(content)
+
+
+class DozupQueueStatsTests(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupQueueStatsTests.')
+        self.stats = BacklogStats(os.path.join(self.dir_path, 'stats.sqlite3'))
+        self.dozup_queue = DozupQueue(self.dir_path, stats=self.stats)
+
+    def tearDown(self):
+        self.dozup_queue.close()
+        self.stats.close()
+        shutil.rmtree(self.dir_path)
+
+    def given_a_file(self, relative_path, content=b'content'):
+        file_path = os.path.join(self.dir_path, 'todo', relative_path)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(file_path, 'wb') as strm:
+            strm.write(content)
+
+    def test_counts_files_as_they_are_claimed_and_done(self):
+        self.given_a_file('a.txt')
+        self.given_a_file('b.txt')
+
+        tasks = self.dozup_queue.iter_tasks()
+        next(tasks)
+        counts = self.stats.read()
+        self.assertEqual(1, counts['pending_files'])
+        self.assertEqual(1, counts['in_flight_files'])
+
+        for task in tasks:
+            pass
+
+        counts = self.stats.read()
+        self.assertEqual(0, counts['pending_files'])
+        self.assertEqual(0, counts['in_flight_files'])
+        self.assertEqual(2, counts['done_files'])
+        self.assertEqual(2, counts['done_tasks'])
+
+    def test_counts_pushed_back_file_as_pending(self):
+        self.given_a_file('a.txt')
+
+        for task in self.dozup_queue.iter_tasks():
+            task.push_back()
+
+        counts = self.stats.read()
+        self.assertEqual(1, counts['pending_files'])
+        self.assertEqual(7, counts['pending_bytes'])
+        self.assertEqual(0, counts['in_flight_files'])
+        self.assertEqual(1, counts['pushed_back_files'])
+
+    def test_counts_released_file_as_pending(self):
+        self.given_a_file('a.txt')
+
+        tasks = self.dozup_queue.iter_tasks()
+        next(tasks)
+        tasks.close()
+
+        counts = self.stats.read()
+        self.assertEqual(1, counts['pending_files'])
+        self.assertEqual(0, counts['in_flight_files'])
+        self.assertEqual(0, counts['pushed_back_files'])
+
+
+class StatsCommandTests(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupStatsCommandTests.')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def test_prints_counts_after_resync(self):
+        os.makedirs(os.path.join(self.dir_path, 'todo'))
+        with open(os.path.join(self.dir_path, 'todo', 'a.txt'), 'wb') as strm:
+            strm.write(b'content')
+        out = Mock()
+
+        stats([self.dir_path, '--resync'], out)
+
+        lines = ''.join(args[0] for args, kwargs in out.write.call_args_list).splitlines()
+        self.assertIn('pending_bytes 7', lines)
+        self.assertIn('pending_files 1', lines)
+        self.assertIn('done_files 0', lines)
@@ -0,0 +1,54 @@
+# -*- coding: UTF-8 -*-
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from dozup.hooks import Hooks
+from dozup.trace import TraceWriter
+
+
+class TraceWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupTraceWriterTests.')
+        self.path = os.path.join(self.dir_path, 'trace.json')
+        self.writer = TraceWriter(self.path)
+        self.hooks = Hooks()
+        self.hooks.register(self.writer.record)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path)
+
+    def when_closed_and_read(self):
+        self.writer.close()
+        with open(self.path) as strm:
+            return json.load(strm)
+
+    def test_writes_slices_for_file_and_post(self):
+        self.writer.record('claimed', 'a.zip', 100.0, {})
+        self.writer.record('opened', 'a.zip/1.txt', 101.0, {'file_path': 'a.zip'})
+        self.writer.record('post_start', 'a.zip/1.txt', 102.0, {})
+        self.writer.record('post_end', 'a.zip/1.txt', 104.0, {'status': 201})
+        self.writer.record('done', 'a.zip', 105.0, {'tasks': 1})
+
+        trace_events = self.when_closed_and_read()
+
+        self.assertEqual(['M', 'i', 'X', 'X'], [e['ph'] for e in trace_events])
+        self.assertEqual('MainThread', trace_events[0]['args']['name'])
+        post, file = trace_events[2:]
+        self.assertEqual(('a.zip/1.txt', 'post', 102e6, 2e6), (post['name'], post['cat'], post['ts'], post['dur']))
+        self.assertEqual(201, post['args']['status'])
+        self.assertEqual(('a.zip', 'file', 101e6, 4e6), (file['name'], file['cat'], file['ts'], file['dur']))
+        self.assertEqual('done', file['args']['outcome'])
+
+    def test_writes_events_from_hooks(self):
+        self.hooks.emit('claimed', 'a.txt')
+
+        trace_events = self.when_closed_and_read()
+
+        self.assertEqual({'path': 'a.txt'}, trace_events[-1]['args'])
+
+    def test_writes_valid_json_when_empty(self):
+        self.assertEqual([], self.when_closed_and_read())
@@ -0,0 +1,115 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock
+
+from dozup import DozupQueue
+from dozup.transform import TransformError, TransformStage, load_transform
+
+
+def shout(name, content):
+    if b'bad' in content:
+        raise ValueError('bad content in %s' % name)
+    return content.upper()
+
+
+def decode(name, content):
+    return content.decode('UTF-8')
+
+
+class TransformStageTests(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupTransformTests.')
+        self.dozup_queue = DozupQueue(self.dir_path)
+        self.stage = TransformStage(shout, processes=2, prefetch=2)
+
+    def tearDown(self):
+        self.stage.close()
+        self.dozup_queue.close()
+        shutil.rmtree(self.dir_path)
+
+    def given_a_file(self, relative_path, content):
+        file_path = os.path.join(self.dir_path, 'todo', relative_path)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(file_path, 'wb') as strm:
+            strm.write(content)
+
+    def test_yields_tasks_in_order_with_content_transformed(self):
+        for name in ['a.txt', 'b.txt', 'c.txt']:
+            self.given_a_file(name, b'content of ' + name.encode('UTF-8'))
+
+        tasks = [(task.name, task.input.read()) for task in self.stage.iter_tasks(self.dozup_queue)]
+
+        self.assertEqual([
+            ('a.txt', b'CONTENT OF A.TXT'),
+            ('b.txt', b'CONTENT OF B.TXT'),
+            ('c.txt', b'CONTENT OF C.TXT'),
+        ], tasks)
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, 'done', 'c.txt')))
+
+    def test_submits_next_task_as_each_is_yielded(self):
+        for name in ['a.txt', 'b.txt', 'c.txt', 'd.txt', 'e.txt']:
+            self.given_a_file(name, b'content of ' + name.encode('UTF-8'))
+        self.stage.pool.apply_async = Mock(wraps=self.stage.pool.apply_async)
+
+        tasks = self.stage.iter_tasks(self.dozup_queue)
+        next(tasks)
+        self.assertEqual(3, self.stage.pool.apply_async.call_count)
+        next(tasks)
+        self.assertEqual(4, self.stage.pool.apply_async.call_count)
+        tasks.close()
+
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, 'done', 'a.txt')))
+        for name in ['b.txt', 'c.txt', 'd.txt', 'e.txt']:
+            self.assertTrue(os.path.exists(os.path.join(self.dir_path, 'todo', name)))
+
+    def test_pushes_back_task_whose_transform_fails(self):
+        self.given_a_file('a.txt', b'bad content')
+        self.given_a_file('b.txt', b'good content')
+
+        names = [task.name for task in self.stage.iter_tasks(self.dozup_queue)]
+
+        self.assertEqual(['b.txt'], names)
+        self.assertEqual([TransformError('a.txt', 'ValueError: bad content in a.txt')], list(self.stage.errors))
+        self.assertIsNone(self.stage.errors[0].status_code)
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, 'todo', 'a.txt')))
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, 'done', 'b.txt')))
+
+    def test_pushes_back_task_whose_transform_returns_text(self):
+        self.stage.transform = decode
+        self.given_a_file('a.txt', b'content')
+
+        names = [task.name for task in self.stage.iter_tasks(self.dozup_queue)]
+
+        self.assertEqual([], names)
+        message = 'TypeError: transform returned %s, not bytes' % type(u'').__name__
+        self.assertEqual([TransformError('a.txt', message)], list(self.stage.errors))
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, 'todo', 'a.txt')))
+
+    def test_pushed_back_task_keeps_its_claim(self):
+        self.given_a_file('a.txt', b'content')
+
+        for task in self.stage.iter_tasks(self.dozup_queue):
+            task.push_back()
+
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, 'todo', 'a.txt')))
+
+    def test_transforms_batch(self):
+        self.given_a_file('a.txt', b'bad content')
+        self.given_a_file('b.txt', b'good content')
+
+        batches = self.dozup_queue.iter_batches(2)
+        batch = self.stage.transform_batch(next(batches))
+        batches.close()
+
+        self.assertEqual([('b.txt', b'GOOD CONTENT')], [(task.name, task.input.read()) for task in batch])
+
+    def test_loads_transform_by_name(self):
+        self.assertIs(shout, load_transform('tests.test_transform:shout'))
+        with self.assertRaises(ValueError):
+            load_transform('tests.test_transform')
@@ -0,0 +1,131 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from dozup import DozupQueue
+from dozup.watch import InotifyWatcher, PollingWatcher, create_watcher, decode_path, encode_path
+
+
+class WatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupWatchTests.')
+        self.watcher = create_watcher(self.dir_path)
+        if not isinstance(self.watcher, InotifyWatcher):
+            self.skipTest('inotify is not available')
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.dir_path)
+
+    def test_lists_existing_files_when_watching_starts(self):
+        self.given_a_file('a/b.txt')
+        self.given_a_file('c.txt')
+
+        file_paths = self.watcher.add_tree('')
+
+        self.assertEqual(set(['a/b.txt', 'c.txt']), set(file_paths))
+
+    def test_reports_file_once_written(self):
+        self.watcher.add_tree('')
+        self.given_a_file('a.txt')
+
+        self.assertEqual(['a.txt'], self.watcher.wait(1.0))
+
+    def test_reports_file_in_new_subdirectory(self):
+        self.watcher.add_tree('')
+        os.makedirs(os.path.join(self.dir_path, 'a'))
+        self.assertEqual([], self.watcher.wait(1.0))
+
+        self.given_a_file('a/b.txt')
+
+        self.assertEqual(['a/b.txt'], self.watcher.wait(1.0))
+
+    def test_returns_empty_list_on_timeout(self):
+        self.watcher.add_tree('')
+
+        self.assertEqual([], self.watcher.wait(0.01))
+
+    def given_a_file(self, relative_path, content=b'content'):
+        subdir_path = os.path.join(self.dir_path, os.path.dirname(relative_path))
+        if not os.path.exists(subdir_path):
+            os.makedirs(subdir_path)
+        with open(os.path.join(self.dir_path, relative_path), 'wb') as strm:
+            strm.write(content)
+
+
+class PollingWatcherTests(unittest.TestCase):
+    def test_asks_for_rescan_after_interval(self):
+        watcher = PollingWatcher('/nonexistent', poll_interval=0.01)
+
+        self.assertIsNone(watcher.add_tree(''))
+        self.assertIsNone(watcher.wait())
+
+
+class PathEncodingTests(unittest.TestCase):
+    def test_encodes_text_and_bytes_paths(self):
+        self.assertEqual(b'todo/a.txt', encode_path(u'todo/a.txt'))
+        self.assertEqual(b'todo/a.txt', encode_path(b'todo/a.txt'))
+
+    def test_decodes_to_native_string(self):
+        self.assertEqual(str('a.txt'), decode_path(b'a.txt'))
+        self.assertEqual(str('a.txt'), decode_path(u'a.txt'))
+        self.assertIsInstance(decode_path(u'a.txt'), str)
+
+
+class QueueWatchTests(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp('.test', 'DozupWatchTests.')
+        self.dozup_queue = DozupQueue(self.dir_path, poll_interval=0.01)
+
+    def tearDown(self):
+        self.dozup_queue.close()
+        shutil.rmtree(self.dir_path)
+
+    def test_waits_for_files_instead_of_stopping(self):
+        self.given_a_file('todo/a.txt')
+
+        names = []
+        for task in self.dozup_queue.iter_tasks(watch=True):
+            names.append(task.name)
+            if len(names) == 1:
+                self.given_a_file_later('todo/b/c.txt')
+            else:
+                break
+
+        self.assertEqual(['a.txt', 'b/c.txt'], names)
+        self.assertTrue(os.path.exists(os.path.join(self.dir_path, 'done', 'a.txt')))
+
+    def test_urgent_arrival_overtakes_backlog(self):
+        if not isinstance(create_watcher(self.dir_path), InotifyWatcher):
+            self.skipTest('inotify is not available')
+        self.dozup_queue = DozupQueue(self.dir_path, poll_interval=0.01, lanes=['urgent'])
+        for i in range(3):
+            self.given_a_file('todo/bulk/f%d.txt' % i)
+
+        names = []
+        for task in self.dozup_queue.iter_tasks(watch=True):
+            names.append(task.name)
+            if len(names) == 1:
+                self.given_a_file('todo/urgent/late.txt')
+            elif len(names) == 4:
+                break
+
+        self.assertEqual('urgent/late.txt', names[1])
+
+    def given_a_file(self, relative_path, content=b'content'):
+        subdir_path = os.path.join(self.dir_path, os.path.dirname(relative_path))
+        if not os.path.exists(subdir_path):
+            os.makedirs(subdir_path)
+        with open(os.path.join(self.dir_path, relative_path), 'wb') as strm:
+            strm.write(content)
+
+    def given_a_file_later(self, relative_path):
+        def create():
+            time.sleep(0.05)
+            self.given_a_file(relative_path)
+        threading.Thread(target=create).start()